@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+#
+# apksign.py - part of the FDroid server tools
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Sign APKs in-process with RSA keys from a PKCS#12 keystore.
+
+This makes the same kind of signatures as `apksigner sign` with its
+default settings: a JAR signature (v1) when the APK supports Android
+versions before 7.0, plus APK Signature Scheme v2 and v3 signatures.
+The ZIP entries are copied and aligned by apksigcopier, like apksigner
+does it.  Opening a keystore and starting a JVM for every APK is what
+makes apksigner slow when signing lots of APKs, so load_pkcs12_keys()
+reads all the keys once.
+"""
+
+import base64
+import hashlib
+import os
+import re
+import struct
+import zipfile
+
+from pyasn1.codec.der import decoder, encoder
+from pyasn1.error import PyAsn1Error
+from pyasn1.type import char, namedtype, tag, univ
+from pyasn1_modules import rfc2315
+
+from . import apksigcopier
+from . import apksigverify
+from . import signindex
+
+OID_PKCS8_SHROUDED_KEY_BAG = '1.2.840.113549.1.12.10.1.2'
+OID_FRIENDLY_NAME = '1.2.840.113549.1.9.20'
+
+APK_SIGNING_BLOCK_MAGIC = b'APK Sig Block 42'
+SIGNATURE_RSA_PKCS1_V1_5_WITH_SHA256 = 0x0103
+SIGNATURE_RSA_PKCS1_V1_5_WITH_SHA512 = 0x0104
+CREATED_BY = '1.0 (Android)'
+
+
+class UnsupportedKeystore(Exception):
+    """The keystore or key cannot be used in-process, use apksigner."""
+
+
+class _SafeBag(univ.Sequence):
+    """PKCS#12 SafeBag, see RFC 7292."""
+
+    componentType = namedtype.NamedTypes(
+        namedtype.NamedType('bagId', univ.ObjectIdentifier()),
+        namedtype.NamedType(
+            'bagValue',
+            univ.Any().subtype(
+                explicitTag=tag.Tag(tag.tagClassContext, tag.tagFormatConstructed, 0)
+            ),
+        ),
+        namedtype.OptionalNamedType(
+            'bagAttributes', univ.SetOf(componentType=rfc2315.Attribute())
+        ),
+    )
+
+
+def _get_data(content_info):
+    """Get the bytes of a PKCS#7 ContentInfo of type data, or None."""
+    if content_info['contentType'] != rfc2315.data:
+        return None
+    return bytes(
+        decoder.decode(content_info['content'], asn1Spec=univ.OctetString())[0]
+    )
+
+
+def load_pkcs12_keys(keystore, storepass, keypass=None):
+    """Load all the RSA keys and their certificates from a PKCS#12 keystore.
+
+    The certificates are decrypted by cryptography.  It only returns
+    the first key, so the key bags are read here, they are not
+    encrypted as a whole in the keystores that Java and OpenSSL make.
+
+    Returns
+    -------
+    dict
+        alias -> (private key, certificate)
+
+    Raises
+    ------
+    UnsupportedKeystore
+        If it is not a PKCS#12 keystore that can be read in-process.
+    """
+    try:
+        from cryptography.hazmat.primitives.asymmetric import rsa
+        from cryptography.hazmat.primitives.serialization import (
+            load_der_private_key,
+            pkcs12,
+        )
+    except ImportError as e:
+        raise UnsupportedKeystore(str(e)) from e
+
+    with open(keystore, 'rb') as fp:
+        data = fp.read()
+    try:
+        p12 = pkcs12.load_pkcs12(data, storepass.encode())
+    except (ValueError, TypeError) as e:
+        # e.g. a JKS keystore
+        raise UnsupportedKeystore('Cannot load %s: %s' % (keystore, e)) from e
+    certs = dict()
+    for cert in ([p12.cert] if p12.cert else []) + list(p12.additional_certs):
+        if cert.friendly_name:
+            certs[cert.friendly_name.decode()] = cert.certificate
+
+    keys = dict()
+    try:
+        pfx = decoder.decode(data)[0]
+        auth_safe = decoder.decode(
+            encoder.encode(pfx[1]), asn1Spec=rfc2315.ContentInfo()
+        )[0]
+        contents = decoder.decode(
+            _get_data(auth_safe),
+            asn1Spec=univ.SequenceOf(componentType=rfc2315.ContentInfo()),
+        )[0]
+        for content_info in contents:
+            safe_contents = _get_data(content_info)
+            if safe_contents is None:
+                continue  # encrypted, i.e. the certificates
+            bags = decoder.decode(
+                safe_contents, asn1Spec=univ.SequenceOf(componentType=_SafeBag())
+            )[0]
+            for bag in bags:
+                if bag['bagId'] != univ.ObjectIdentifier(OID_PKCS8_SHROUDED_KEY_BAG):
+                    continue
+                alias = None
+                for attribute in bag['bagAttributes']:
+                    if str(attribute['type']) == OID_FRIENDLY_NAME:
+                        value = bytes(attribute['values'][0])
+                        alias = str(decoder.decode(value, asn1Spec=char.BMPString())[0])
+                if alias is None or alias not in certs:
+                    continue
+                try:
+                    key = load_der_private_key(
+                        bytes(bag['bagValue']), (keypass or storepass).encode()
+                    )
+                except (ValueError, TypeError):
+                    continue  # e.g. a key with its own password
+                cert = certs[alias]
+                if (
+                    isinstance(key, rsa.RSAPrivateKey)
+                    and key.public_key().public_numbers()
+                    == cert.public_key().public_numbers()
+                ):
+                    keys[alias] = (key, cert)
+    except (PyAsn1Error, IndexError, TypeError) as e:
+        raise UnsupportedKeystore('Cannot parse %s: %s' % (keystore, e)) from e
+    return keys
+
+
+def _lp(data):
+    """Prefix data with its length as uint32."""
+    return struct.pack('<I', len(data)) + data
+
+
+def _lp_sequence(items):
+    return _lp(b''.join(_lp(item) for item in items))
+
+
+def _v1_signer_name(alias):
+    """Make the name of the JAR signature files like apksigner does."""
+    return re.sub(r'[^A-Za-z0-9_-]', '_', alias[:8].upper())
+
+
+def _b64digest(hash_name, data):
+    return base64.b64encode(hashlib.new(hash_name, data).digest()).decode()
+
+
+def make_v1_signature_files(apkfile, key, cert, signer_name, min_sdk_version):
+    """Make the JAR signature files for an APK that also has v2/v3 signatures.
+
+    Returns
+    -------
+    list
+        (ZipInfo, data) of MANIFEST.MF, the .SF and the .RSA files
+    """
+    if min_sdk_version >= apksigverify.ANDROID_JELLY_BEAN_MR2:
+        hash_name, digest_name = 'sha256', 'SHA-256'
+    else:
+        hash_name, digest_name = 'sha1', 'SHA1'
+    header = signindex._manifest_header
+
+    manifest = header('Manifest-Version', '1.0') + header('Created-By', CREATED_BY)
+    manifest += b'\r\n'
+    sf_sections = b''
+    with zipfile.ZipFile(apkfile) as apk:
+        for name in sorted(i.filename for i in apk.infolist() if not i.is_dir()):
+            h = hashlib.new(hash_name)
+            with apk.open(name) as fp:
+                for chunk in iter(lambda: fp.read(apksigverify.CHUNK_SIZE), b''):
+                    h.update(chunk)
+            section = (
+                header('Name', name)
+                + header(digest_name + '-Digest', base64.b64encode(h.digest()).decode())
+                + b'\r\n'
+            )
+            manifest += section
+            sf_sections += (
+                header('Name', name)
+                + header(digest_name + '-Digest', _b64digest(hash_name, section))
+                + b'\r\n'
+            )
+    sf = (
+        header('Signature-Version', '1.0')
+        + header('Created-By', CREATED_BY)
+        + header(digest_name + '-Digest-Manifest', _b64digest(hash_name, manifest))
+        + header('X-Android-APK-Signed', '2, 3')
+        + b'\r\n'
+        + sf_sections
+    )
+    signature_block = signindex._pkcs7_signature_block(
+        sf, key, cert, sha256=hash_name == 'sha256'
+    )
+    return [
+        (zipfile.ZipInfo('META-INF/MANIFEST.MF'), manifest),
+        (zipfile.ZipInfo('META-INF/%s.SF' % signer_name), sf),
+        (zipfile.ZipInfo('META-INF/%s.RSA' % signer_name), signature_block),
+    ]
+
+
+def _signature_algorithm(key):
+    """Choose the signature algorithm like apksigner does for RSA keys."""
+    if key.key_size > 3072:
+        return SIGNATURE_RSA_PKCS1_V1_5_WITH_SHA512, 'sha512'
+    return SIGNATURE_RSA_PKCS1_V1_5_WITH_SHA256, 'sha256'
+
+
+def _make_signer(scheme, key, cert_der, content_digest, attributes):
+    """Make one v2 or v3 signer for the APK Signing Block."""
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import padding
+
+    algorithm, hash_name = _signature_algorithm(key)
+    digests = _lp_sequence([struct.pack('<I', algorithm) + _lp(content_digest)])
+    certs = _lp_sequence([cert_der])
+    if scheme == 3:
+        sdk_versions = struct.pack('<II', apksigverify.ANDROID_P, 0x7FFFFFFF)
+    else:
+        sdk_versions = b''
+    signed_data = digests + certs + sdk_versions + _lp_sequence(attributes)
+    signature = key.sign(
+        signed_data, padding.PKCS1v15(), getattr(hashes, hash_name.upper())()
+    )
+    public_key = key.public_key().public_bytes(
+        serialization.Encoding.DER, serialization.PublicFormat.SubjectPublicKeyInfo
+    )
+    return (
+        _lp(signed_data)
+        + sdk_versions
+        + _lp_sequence([struct.pack('<I', algorithm) + _lp(signature)])
+        + _lp(public_key)
+    )
+
+
+def make_signing_block(apkfile, key, cert_der):
+    """Make an APK Signing Block with v2 and v3 signatures for apkfile.
+
+    Returns
+    -------
+    (offset, block) as apksigcopier.patch_v2_sig() takes it
+    """
+    zip_data = apksigcopier.zip_data(apkfile)
+    hash_name = _signature_algorithm(key)[1]
+    content_digest = apksigverify.compute_content_digests(
+        apkfile, zip_data, zip_data.cd_offset, [hash_name]
+    )[hash_name]
+    # tells verifiers that the v3 signature must not be stripped
+    stripping_protection = struct.pack(
+        '<II', apksigverify.STRIPPING_PROTECTION_ATTR_ID, 3
+    )
+    pairs = b''
+    for scheme, block_id, attributes in (
+        (2, apksigverify.APK_SIGNATURE_SCHEME_V2_BLOCK_ID, [stripping_protection]),
+        (3, apksigverify.APK_SIGNATURE_SCHEME_V3_BLOCK_ID, []),
+    ):
+        signer = _make_signer(scheme, key, cert_der, content_digest, attributes)
+        value = struct.pack('<I', block_id) + _lp_sequence([signer])
+        pairs += struct.pack('<Q', len(value)) + value
+    size = struct.pack('<Q', len(pairs) + 8 + len(APK_SIGNING_BLOCK_MAGIC))
+    return zip_data.cd_offset, size + pairs + size + APK_SIGNING_BLOCK_MAGIC
+
+
+def sign_apk(unsigned_path, signed_path, key, cert, alias, min_sdk_version):
+    """Sign an APK with v1 (if needed), v2 and v3 signatures.
+
+    Parameters
+    ----------
+    unsigned_path
+        path to the APK to sign, any JAR signature files are left out
+    signed_path
+        where to write the signed and aligned APK
+    key
+        the RSA private key
+    cert
+        the X.509 certificate of the key
+    alias
+        the key alias, the JAR signature files are named after it
+    min_sdk_version
+        the minSdkVersion of the APK, as int
+    """
+    from cryptography.hazmat.primitives import serialization
+
+    cert_der = cert.public_bytes(serialization.Encoding.DER)
+    tmp_path = signed_path + '.tmp'
+    try:
+        date_time = apksigcopier.copy_apk(unsigned_path, tmp_path)
+        if min_sdk_version < apksigverify.ANDROID_N:
+            meta = make_v1_signature_files(
+                tmp_path, key, cert, _v1_signer_name(alias), min_sdk_version
+            )
+            apksigcopier.patch_meta(meta, tmp_path, date_time=date_time)
+        apksigcopier.patch_v2_sig(make_signing_block(tmp_path, key, cert_der), tmp_path)
+        os.replace(tmp_path, signed_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
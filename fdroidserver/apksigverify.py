@@ -0,0 +1,696 @@
+#!/usr/bin/env python3
+#
+# apksigverify.py - part of the FDroid server tools
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Verify APK Signature Scheme v1, v2 and v3 signatures in-process.
+
+This follows the rules of apksigner's ApkVerifier closely enough to
+give the same answer for the APKs that F-Droid deals with, without
+starting a JVM for each APK.  Whenever an APK uses something that is
+not implemented here, e.g. MD5 digests, key rotation or APK Signature
+Scheme v3.1, verify_apk_signature() returns None so that the caller
+can fall back to apksigner.
+
+https://source.android.com/security/apksigning
+"""
+
+import base64
+import hashlib
+import re
+import struct
+import zipfile
+
+from pyasn1.codec.der import decoder, encoder
+from pyasn1.error import PyAsn1Error
+from pyasn1_modules import rfc2315
+
+from . import apksigcopier
+from .exception import VerificationException
+
+APK_SIGNATURE_SCHEME_V2_BLOCK_ID = 0x7109871A
+APK_SIGNATURE_SCHEME_V3_BLOCK_ID = 0xF05368C0
+APK_SIGNATURE_SCHEME_V31_BLOCK_ID = 0x1B93AD61
+STRIPPING_PROTECTION_ATTR_ID = 0xBEEFF00D
+PROOF_OF_ROTATION_ATTR_ID = 0x3BA06F8C
+
+ANDROID_JELLY_BEAN_MR2 = 18
+ANDROID_LOLLIPOP = 21
+ANDROID_N = 24
+ANDROID_P = 28
+
+CHUNK_SIZE = 1024 * 1024
+
+# v2/v3 signature algorithm ID -> (key type, hash, padding, content digest)
+SIGNATURE_ALGORITHMS = {
+    0x0101: ('RSA', 'sha256', 'PSS', 'sha256'),
+    0x0102: ('RSA', 'sha512', 'PSS', 'sha512'),
+    0x0103: ('RSA', 'sha256', 'PKCS1', 'sha256'),
+    0x0104: ('RSA', 'sha512', 'PKCS1', 'sha512'),
+    0x0201: ('EC', 'sha256', None, 'sha256'),
+    0x0202: ('EC', 'sha512', None, 'sha512'),
+    0x0301: ('DSA', 'sha256', None, 'sha256'),
+    0x0421: ('RSA', 'sha256', 'PKCS1', 'verity'),
+    0x0423: ('EC', 'sha256', None, 'verity'),
+    0x0425: ('DSA', 'sha256', None, 'verity'),
+}
+
+# JAR signature digest OIDs and their names in MANIFEST.MF and .SF files
+DIGEST_OIDS = {
+    '1.3.14.3.2.26': 'sha1',
+    '2.16.840.1.101.3.4.2.4': 'sha224',
+    '2.16.840.1.101.3.4.2.1': 'sha256',
+    '2.16.840.1.101.3.4.2.2': 'sha384',
+    '2.16.840.1.101.3.4.2.3': 'sha512',
+}
+MANIFEST_DIGESTS = {
+    'SHA1': 'sha1',
+    'SHA-1': 'sha1',
+    'SHA-256': 'sha256',
+    'SHA-384': 'sha384',
+    'SHA-512': 'sha512',
+}
+OID_MESSAGE_DIGEST = '1.2.840.113549.1.9.4'
+
+V1_SIGNATURE_BLOCK_REGEX = re.compile(r'^META-INF/[^/]+\.(RSA|DSA|EC)$')
+V1_META_REGEX = re.compile(
+    r'^META-INF/([^/]+\.(SF|RSA|DSA|EC)|MANIFEST\.MF|SIG-[^/]*)$'
+)
+
+
+class UnsupportedSignature(Exception):
+    """The APK uses a feature that is not implemented here."""
+
+
+def _hash(name, data=b''):
+    """Return a hashlib object, or raise UnsupportedSignature."""
+    try:
+        return hashlib.new(name, data)
+    except ValueError as e:
+        raise UnsupportedSignature(str(e)) from e
+
+
+def _lp(data, what):
+    """Split a uint32 length-prefixed value off the front of data."""
+    if len(data) < 4:
+        raise VerificationException('Truncated ' + what)
+    (length,) = struct.unpack('<I', data[:4])
+    if length > len(data) - 4:
+        raise VerificationException('Truncated ' + what)
+    return data[4 : 4 + length], data[4 + length :]
+
+
+def _lp_sequence(data, what):
+    """Parse a length-prefixed sequence of length-prefixed values."""
+    items = []
+    sequence, rest = _lp(data, what)
+    while sequence:
+        item, sequence = _lp(sequence, what)
+        items.append(item)
+    return items, rest
+
+
+def _u32(data, what):
+    if len(data) < 4:
+        raise VerificationException('Truncated ' + what)
+    return struct.unpack('<I', data[:4])[0], data[4:]
+
+
+def get_signing_block_pairs(sig_block):
+    """Return the ID-value pairs of an APK Signing Block as a dict."""
+    pairs = dict()
+    data = sig_block[8:-24]
+    while data:
+        if len(data) < 12:
+            raise VerificationException('Truncated APK Signing Block pair')
+        (length,) = struct.unpack('<Q', data[:8])
+        if length < 4 or length > len(data) - 8:
+            raise VerificationException('Invalid APK Signing Block pair length')
+        (block_id,) = struct.unpack('<I', data[8:12])
+        pairs[block_id] = data[12 : 8 + length]
+        data = data[8 + length :]
+    return pairs
+
+
+def _load_public_key(public_key):
+    from cryptography.hazmat.primitives.serialization import load_der_public_key
+
+    try:
+        return load_der_public_key(public_key)
+    except ValueError as e:
+        raise UnsupportedSignature('Cannot load public key: %s' % e) from e
+
+
+def _load_certificate(cert):
+    from cryptography import x509
+
+    try:
+        return x509.load_der_x509_certificate(cert)
+    except ValueError as e:
+        raise UnsupportedSignature('Cannot load certificate: %s' % e) from e
+
+
+def _key_type(key):
+    from cryptography.hazmat.primitives.asymmetric import dsa, ec, rsa
+
+    if isinstance(key, rsa.RSAPublicKey):
+        return 'RSA'
+    if isinstance(key, ec.EllipticCurvePublicKey):
+        return 'EC'
+    if isinstance(key, dsa.DSAPublicKey):
+        return 'DSA'
+    raise UnsupportedSignature('Unsupported key type: %s' % type(key).__name__)
+
+
+def _spki(key):
+    from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
+
+    return key.public_bytes(Encoding.DER, PublicFormat.SubjectPublicKeyInfo)
+
+
+def _verify_signature(key, signature, data, hash_name, padding_name=None):
+    """Check a raw signature, returns whether it is valid."""
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import ec, padding
+
+    try:
+        algorithm = getattr(hashes, hash_name.upper())()
+    except AttributeError as e:
+        raise UnsupportedSignature('Unsupported hash: ' + hash_name) from e
+    key_type = _key_type(key)
+    try:
+        if key_type == 'RSA':
+            if padding_name == 'PSS':
+                pad = padding.PSS(
+                    mgf=padding.MGF1(algorithm), salt_length=algorithm.digest_size
+                )
+            else:
+                pad = padding.PKCS1v15()
+            key.verify(signature, data, pad, algorithm)
+        elif key_type == 'EC':
+            key.verify(signature, data, ec.ECDSA(algorithm))
+        else:
+            key.verify(signature, data, algorithm)
+    except InvalidSignature:
+        return False
+    return True
+
+
+def compute_content_digests(apkfile, zip_data, sb_offset, algorithms):
+    """Compute the chunked content digests that v2 and v3 signatures cover.
+
+    The ZIP entries, the central directory and the End of Central
+    Directory (with the central directory offset pointing to the APK
+    Signing Block) are each split into 1 MiB chunks.  Each chunk is
+    hashed, then the chunk digests are hashed together.
+    """
+    cd_size = zip_data.eocd_offset - zip_data.cd_offset
+    eocd = bytearray(zip_data.cd_and_eocd[cd_size:])
+    eocd[16:20] = struct.pack('<I', sb_offset)
+
+    def _sections():
+        with open(apkfile, 'rb') as fp:
+            remaining = sb_offset
+            while remaining > 0:
+                chunk = fp.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise VerificationException('Truncated ZIP entries')
+                remaining -= len(chunk)
+                yield chunk
+        cd = zip_data.cd_and_eocd[:cd_size]
+        for section in (cd, bytes(eocd)):
+            for i in range(0, len(section), CHUNK_SIZE):
+                yield section[i : i + CHUNK_SIZE]
+
+    chunk_digests = {name: [] for name in algorithms}
+    for chunk in _sections():
+        prefix = b'\xa5' + struct.pack('<I', len(chunk))
+        for name in algorithms:
+            chunk_digests[name].append(_hash(name, prefix + chunk).digest())
+    digests = dict()
+    for name, chunks in chunk_digests.items():
+        h = _hash(name, b'\x5a' + struct.pack('<I', len(chunks)))
+        for d in chunks:
+            h.update(d)
+        digests[name] = h.digest()
+    return digests
+
+
+def _verify_v2_v3_signer(signer, scheme, expected_digests):
+    """Verify the signature of a v2 or v3 signer.
+
+    The content digests that the signer signed are added to
+    expected_digests, they are checked against the APK afterwards.
+
+    Returns
+    -------
+    (certificate, stripping protection scheme ID) of the signer.
+    """
+    what = 'APK Signature Scheme v%d signer' % scheme
+    signed_data, rest = _lp(signer, what)
+    if scheme == 3:
+        min_sdk, rest = _u32(rest, what)
+        max_sdk, rest = _u32(rest, what)
+    signatures, rest = _lp_sequence(rest, what)
+    public_key_bytes, rest = _lp(rest, what)
+
+    public_key = _load_public_key(public_key_bytes)
+    key_type = _key_type(public_key)
+    signature_algorithms = []
+    verified = 0
+    for record in signatures:
+        algorithm, record = _u32(record, what)
+        signature, _ignored = _lp(record, what)
+        signature_algorithms.append(algorithm)
+        if algorithm not in SIGNATURE_ALGORITHMS:
+            continue
+        algorithm_key_type, hash_name, padding_name, _ignored = SIGNATURE_ALGORITHMS[
+            algorithm
+        ]
+        if algorithm_key_type != key_type:
+            raise VerificationException(
+                '%s: signature algorithm does not match key type' % what
+            )
+        if not _verify_signature(
+            public_key, signature, signed_data, hash_name, padding_name
+        ):
+            raise VerificationException('%s: signature did not verify' % what)
+        verified += 1
+    if not verified:
+        raise UnsupportedSignature('%s: no supported signature algorithm' % what)
+
+    digests, rest = _lp_sequence(signed_data, what)
+    certificates, rest = _lp_sequence(rest, what)
+    if scheme == 3:
+        signed_min_sdk, rest = _u32(rest, what)
+        signed_max_sdk, rest = _u32(rest, what)
+        if (min_sdk, max_sdk) != (signed_min_sdk, signed_max_sdk):
+            raise VerificationException('%s: SDK versions do not match' % what)
+    attributes, rest = _lp_sequence(rest, what)
+
+    digest_algorithms = []
+    expected = dict()
+    for record in digests:
+        algorithm, record = _u32(record, what)
+        digest, _ignored = _lp(record, what)
+        digest_algorithms.append(algorithm)
+        content_digest = SIGNATURE_ALGORITHMS.get(algorithm, (None,) * 4)[3]
+        if content_digest and content_digest != 'verity':
+            expected[content_digest] = digest
+    if digest_algorithms != signature_algorithms:
+        raise VerificationException(
+            '%s: digest and signature algorithms do not match' % what
+        )
+    if not expected:
+        raise UnsupportedSignature('%s: no supported digest algorithm' % what)
+    for name, digest in expected.items():
+        if expected_digests.setdefault(name, digest) != digest:
+            raise VerificationException('%s: digests do not match' % what)
+
+    if not certificates:
+        raise VerificationException('%s: no certificates' % what)
+    cert = _load_certificate(certificates[0])
+    if _spki(cert.public_key()) != _spki(public_key):
+        raise VerificationException('%s: public key does not match certificate' % what)
+
+    stripping_protection = None
+    for attribute in attributes:
+        attribute_id, value = _u32(attribute, what)
+        if attribute_id == PROOF_OF_ROTATION_ATTR_ID:
+            raise UnsupportedSignature('%s: key rotation' % what)
+        if attribute_id == STRIPPING_PROTECTION_ATTR_ID:
+            stripping_protection, _ignored = _u32(value, what)
+    return certificates[0], stripping_protection
+
+
+def verify_v2_v3(block, scheme, min_sdk_version, expected_digests):
+    """Verify the signer of an APK Signature Scheme v2 or v3 block.
+
+    This only checks the signature, the content digests that were
+    added to expected_digests still need to be compared to the APK.
+
+    Returns
+    -------
+    (certificate, stripping protection scheme ID) of the signer.
+    """
+    what = 'APK Signature Scheme v%d block' % scheme
+    signers, _ignored = _lp_sequence(block, what)
+    if not signers:
+        raise VerificationException('%s: no signers' % what)
+    if len(signers) > 1:
+        # v2 multiple signers and v3 SDK ranges are not implemented
+        raise UnsupportedSignature('%s: multiple signers' % what)
+    if scheme == 3:
+        sdk_versions = _lp(signers[0], what)[1]
+        min_sdk, sdk_versions = _u32(sdk_versions, what)
+        max_sdk, sdk_versions = _u32(sdk_versions, what)
+        if min_sdk > max(min_sdk_version, ANDROID_P) or max_sdk != 0x7FFFFFFF:
+            raise UnsupportedSignature('%s: limited SDK range' % what)
+    return _verify_v2_v3_signer(signers[0], scheme, expected_digests)
+
+
+def parse_manifest(data):
+    """Parse a JAR MANIFEST.MF or signature file.
+
+    Returns
+    -------
+    A list of (attributes, raw bytes) per section, starting with the
+    main section.  The raw bytes include the empty line that ends the
+    section, since that is what the JAR signature digests cover.
+    """
+    sections = []
+    attributes = dict()
+    start = 0
+    last = None
+    for m in re.finditer(rb'([^\r\n]*)(\r\n|\r|\n|$)', data):
+        if m.start() == len(data) and not m.group(0):
+            break
+        line = m.group(1)
+        if not line:
+            if attributes or not sections:
+                sections.append((attributes, data[start : m.end()]))
+            attributes = dict()
+            start = m.end()
+            last = None
+        elif line.startswith(b' '):
+            if last is None:
+                raise VerificationException('Invalid continuation line in manifest')
+            attributes[last] += line[1:].decode('utf-8')
+        else:
+            name, sep, value = line.decode('utf-8').partition(':')
+            if not sep:
+                raise VerificationException('Invalid line in manifest: ' + name)
+            last = name.strip()
+            attributes[last] = value.strip()
+    if attributes or start < len(data):
+        sections.append((attributes, data[start:]))
+    return sections
+
+
+def _get_digests(attributes, suffix, min_sdk_version):
+    """Get all the supported digests of a manifest section.
+
+    Raises UnsupportedSignature if there are only unsupported ones,
+    and returns an empty list if there are none.
+    """
+    digests = []
+    found = False
+    for key, value in attributes.items():
+        if not key.endswith(suffix):
+            continue
+        found = True
+        name = MANIFEST_DIGESTS.get(key[: -len(suffix)].upper())
+        if not name:
+            continue
+        if name != 'sha1' and min_sdk_version < ANDROID_JELLY_BEAN_MR2:
+            continue
+        digests.append((name, value))
+    if found and not digests:
+        raise UnsupportedSignature('No supported digest in %s' % list(attributes))
+    return digests
+
+
+def _check_digests(digests, data):
+    for name, value in digests:
+        if base64.b64encode(_hash(name, data).digest()).decode() != value:
+            return False
+    return True
+
+
+def _verify_pkcs7(signature_block, signed_file, min_sdk_version):
+    """Verify a JAR Signature Block File, returns the signer's DER certificate."""
+    try:
+        content = decoder.decode(signature_block, asn1Spec=rfc2315.ContentInfo())[0]
+        if content['contentType'] != rfc2315.signedData:
+            raise VerificationException(
+                'Signature Block File is not PKCS#7 signed data'
+            )
+        signed_data = decoder.decode(content['content'], asn1Spec=rfc2315.SignedData())[
+            0
+        ]
+        signer_infos = signed_data['signerInfos']
+        if len(signer_infos) != 1:
+            raise UnsupportedSignature('Signature Block File with multiple signers')
+        signer_info = signer_infos[0]
+        serial = int(signer_info['issuerAndSerialNumber']['serialNumber'])
+        certificates = [
+            encoder.encode(c['certificate']) for c in signed_data['certificates']
+        ]
+        digest_oid = str(signer_info['digestAlgorithm']['algorithm'])
+        encrypted_digest = bytes(signer_info['encryptedDigest'])
+        authenticated_attributes = signer_info['authenticatedAttributes']
+        if authenticated_attributes.hasValue():
+            attributes = dict()
+            for attribute in authenticated_attributes:
+                values = attribute['values']
+                attributes[str(attribute['type'])] = values[0] if values else None
+            # signed as a SET OF, not with the implicit [0] tag it has here
+            attributes_der = bytearray(encoder.encode(authenticated_attributes))
+            attributes_der[0] = 0x31
+        else:
+            attributes = None
+    except PyAsn1Error as e:
+        raise VerificationException('Invalid Signature Block File: %s' % e) from e
+
+    hash_name = DIGEST_OIDS.get(digest_oid)
+    if not hash_name:
+        raise UnsupportedSignature('Unsupported digest algorithm ' + digest_oid)
+    cert_der = None
+    for c in certificates:
+        cert = _load_certificate(c)
+        if cert.serial_number == serial:
+            cert_der = c
+            break
+    if not cert_der:
+        raise VerificationException('Signer certificate not found')
+    public_key = cert.public_key()
+    key_type = _key_type(public_key)
+    if min_sdk_version < ANDROID_JELLY_BEAN_MR2 and (
+        hash_name != 'sha1' or key_type == 'EC'
+    ):
+        raise UnsupportedSignature('Algorithms need API level checks')
+    if min_sdk_version < ANDROID_LOLLIPOP and hash_name != 'sha1' and key_type != 'RSA':
+        raise UnsupportedSignature('Algorithms need API level checks')
+
+    if attributes is None:
+        signed = signed_file
+    else:
+        try:
+            message_digest = decoder.decode(bytes(attributes[OID_MESSAGE_DIGEST]))[0]
+        except (KeyError, TypeError, PyAsn1Error) as e:
+            raise VerificationException('No messageDigest attribute') from e
+        if bytes(message_digest) != _hash(hash_name, signed_file).digest():
+            raise VerificationException('Signature file digest does not match')
+        signed = bytes(attributes_der)
+    if not _verify_signature(public_key, encrypted_digest, signed, hash_name):
+        raise VerificationException('JAR signature did not verify')
+    return cert_der
+
+
+def verify_v1(apk, infos, min_sdk_version, v2_v3_present):
+    """Verify the JAR signatures of an APK.
+
+    Returns
+    -------
+    The set of the DER certificates of the signers.
+    """
+    names = [info.filename for info in infos]
+    if 'META-INF/MANIFEST.MF' not in names:
+        raise VerificationException('Missing META-INF/MANIFEST.MF')
+    manifest_data = apk.read('META-INF/MANIFEST.MF')
+    manifest = parse_manifest(manifest_data)
+    entries = dict()
+    for attributes, raw in manifest[1:]:
+        name = attributes.get('Name')
+        if name is None:
+            raise VerificationException('Manifest section without Name')
+        if name in entries:
+            raise VerificationException('Duplicate manifest entry: ' + name)
+        entries[name] = (attributes, raw)
+
+    signature_blocks = [n for n in names if V1_SIGNATURE_BLOCK_REGEX.match(n)]
+    if not signature_blocks:
+        raise VerificationException('No JAR signatures')
+    signers = set()
+    signed_by_all = None
+    for block in signature_blocks:
+        sf_name = block.rsplit('.', 1)[0] + '.SF'
+        if sf_name not in names:
+            raise VerificationException('Missing ' + sf_name)
+        sf_data = apk.read(sf_name)
+        signers.add(_verify_pkcs7(apk.read(block), sf_data, min_sdk_version))
+        sf = parse_manifest(sf_data)
+        sf_main = sf[0][0]
+
+        apk_signed = sf_main.get('X-Android-APK-Signed')
+        if apk_signed:
+            for scheme_id in apk_signed.split(','):
+                scheme_id = scheme_id.strip()
+                if scheme_id in ('2', '3') and int(scheme_id) not in v2_v3_present:
+                    raise VerificationException(
+                        'APK Signature Scheme v%s signature was stripped' % scheme_id
+                    )
+
+        whole = _get_digests(sf_main, '-Digest-Manifest', min_sdk_version)
+        if whole and _check_digests(whole, manifest_data):
+            signed = set(entries)
+        else:
+            main = _get_digests(
+                sf_main, '-Digest-Manifest-Main-Attributes', min_sdk_version
+            )
+            if main and not _check_digests(main, manifest[0][1]):
+                raise VerificationException(
+                    sf_name + ': main attributes digest mismatch'
+                )
+            signed = set()
+            for attributes, _ignored in sf[1:]:
+                name = attributes.get('Name')
+                if name not in entries:
+                    raise VerificationException(
+                        '%s: entry not in manifest: %s' % (sf_name, name)
+                    )
+                digests = _get_digests(attributes, '-Digest', min_sdk_version)
+                if not digests:
+                    raise VerificationException(
+                        '%s: no digest for %s' % (sf_name, name)
+                    )
+                if not _check_digests(digests, entries[name][1]):
+                    raise VerificationException(
+                        '%s: digest mismatch for %s' % (sf_name, name)
+                    )
+                signed.add(name)
+        signed_by_all = signed if signed_by_all is None else signed_by_all & signed
+
+    for info in infos:
+        name = info.filename
+        if name.endswith('/') or V1_META_REGEX.match(name):
+            continue
+        if name not in entries:
+            raise VerificationException('Entry not in manifest: ' + name)
+        if name not in signed_by_all:
+            raise VerificationException('Entry not signed by all signers: ' + name)
+        digests = _get_digests(entries[name][0], '-Digest', min_sdk_version)
+        if not digests:
+            raise VerificationException('No digest for entry: ' + name)
+        hashers = [(_hash(digest_name), value) for digest_name, value in digests]
+        with apk.open(info) as fp:
+            for chunk in iter(lambda: fp.read(CHUNK_SIZE), b''):
+                for h, _ignored in hashers:
+                    h.update(chunk)
+        for h, value in hashers:
+            if base64.b64encode(h.digest()).decode() != value:
+                raise VerificationException('Digest mismatch for entry: ' + name)
+    missing = set(entries) - set(names)
+    if missing:
+        raise VerificationException('Manifest entry not in APK: ' + sorted(missing)[0])
+    return signers
+
+
+def verify_apk_signature(apkfile, min_sdk_version):
+    """Verify the signatures of an APK like `apksigner verify` does.
+
+    Parameters
+    ----------
+    apkfile
+        path to the APK
+    min_sdk_version
+        the lowest Android SDK version the signatures must work on, as int
+
+    Returns
+    -------
+    True if the APK was verified, or None when the APK uses something
+    that is not implemented here, so apksigner must decide.
+
+    Raises
+    ------
+    VerificationException
+        If the APK's signature is not valid.
+    """
+    try:
+        return _verify_apk_signature(apkfile, min_sdk_version)
+    except UnsupportedSignature:
+        return None
+    except ImportError:
+        return None
+    except (apksigcopier.APKSigCopierError, zipfile.BadZipFile, OSError) as e:
+        raise VerificationException(str(e)) from e
+
+
+def _verify_apk_signature(apkfile, min_sdk_version):
+    zip_data = apksigcopier.zip_data(apkfile)
+    extracted = apksigcopier.extract_v2_sig(apkfile, expected=False)
+    if extracted:
+        sb_offset, sig_block = extracted
+        pairs = get_signing_block_pairs(sig_block)
+    else:
+        sb_offset, pairs = None, dict()
+    if APK_SIGNATURE_SCHEME_V31_BLOCK_ID in pairs:
+        raise UnsupportedSignature('APK Signature Scheme v3.1')
+
+    present = [
+        scheme
+        for scheme, block_id in (
+            (2, APK_SIGNATURE_SCHEME_V2_BLOCK_ID),
+            (3, APK_SIGNATURE_SCHEME_V3_BLOCK_ID),
+        )
+        if block_id in pairs
+    ]
+    certs = dict()
+    expected_digests = dict()
+    if 3 in present:
+        certs[3], _ignored = verify_v2_v3(
+            pairs[APK_SIGNATURE_SCHEME_V3_BLOCK_ID],
+            3,
+            min_sdk_version,
+            expected_digests,
+        )
+    # Android P and newer ignore v2 signatures when there is a v3 one
+    if 2 in present and (min_sdk_version < ANDROID_P or 3 not in present):
+        certs[2], stripping_protection = verify_v2_v3(
+            pairs[APK_SIGNATURE_SCHEME_V2_BLOCK_ID],
+            2,
+            min_sdk_version,
+            expected_digests,
+        )
+        if stripping_protection == 3 and 3 not in present:
+            raise VerificationException(
+                'APK Signature Scheme v3 signature was stripped'
+            )
+    if expected_digests:
+        digests = compute_content_digests(
+            apkfile, zip_data, sb_offset, list(expected_digests)
+        )
+        if digests != expected_digests:
+            raise VerificationException('APK integrity check failed')
+
+    # Android N and newer only check JAR signatures without v2 or v3 ones
+    if min_sdk_version < ANDROID_N or not present:
+        with zipfile.ZipFile(apkfile) as apk:
+            infos = apk.infolist()
+            names = [info.filename for info in infos]
+            if len(names) != len(set(names)):
+                raise VerificationException('Duplicate ZIP entries')
+            v1_signers = verify_v1(apk, infos, min_sdk_version, present)
+        if len(v1_signers) > 1:
+            raise UnsupportedSignature('multiple JAR signers')
+        certs[1] = v1_signers.pop()
+    elif 3 in present and 2 not in present and min_sdk_version < ANDROID_P:
+        # Android N to O MR1 ignore v3 signatures, apksigner knows the rules
+        raise UnsupportedSignature('APK Signature Scheme v3 without v2')
+
+    if len(set(certs.values())) > 1:
+        raise VerificationException('Signing certificates do not match between schemes')
+    return True
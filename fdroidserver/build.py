@@ -20,9 +20,11 @@
 import os
 import shutil
 import glob
+import io
 import subprocess
 import posixpath
 import re
+import shlex
 import tarfile
 import threading
 import traceback
@@ -30,12 +32,19 @@ import time
 import requests
 import tempfile
 import argparse
+import collections
+import multiprocessing
+import multiprocessing.connection
+import pickle
+import signal
 from configparser import ConfigParser
 import logging
 from gettext import ngettext
 
 from . import _
+from . import buildcache
 from . import common
+from . import mavencache
 from . import net
 from . import metadata
 from . import scanner
@@ -49,6 +58,127 @@ except ImportError:
     pass
 
 
+# VCS metadata and caches that are never sent to the build server
+TAR_EXCLUDE = ('.bzr', '.git', '.hg', '.svn', '__pycache__')
+
+
+def tar_filter(tarinfo):
+    """Leave out VCS metadata and caches, for TarFile.add()."""
+    if posixpath.basename(tarinfo.name) in TAR_EXCLUDE:
+        return None
+    return tarinfo
+
+
+def tar_add_bytes(tar, arcname, data, mode=0o644):
+    """Add a file with the given contents to a tar stream."""
+    tarinfo = tarfile.TarInfo(arcname)
+    tarinfo.size = len(data)
+    tarinfo.mode = mode
+    tarinfo.mtime = int(time.time())
+    tar.addfile(tarinfo, io.BytesIO(data))
+
+
+def tar_add_dir(tar, arcname):
+    """Add an empty directory to a tar stream."""
+    tarinfo = tarfile.TarInfo(arcname)
+    tarinfo.type = tarfile.DIRTYPE
+    tarinfo.mode = 0o755
+    tarinfo.mtime = int(time.time())
+    tar.addfile(tarinfo)
+
+
+def get_fdroidserver_files(serverpath):
+    """Get the files of fdroidserver that the build server needs to run it.
+
+    Returns
+    -------
+    a sorted list of the local path and the path on the server of each file and dir
+    """
+    files = [(os.path.join(serverpath, '..', f), posixpath.join('fdroidserver', f))
+             for f in ('fdroid', 'gradlew-fdroid')]
+    for root, dirs, filenames in os.walk(serverpath):
+        dirs[:] = sorted(d for d in dirs if d not in TAR_EXCLUDE)
+        relroot = os.path.relpath(root, os.path.dirname(serverpath))
+        arcroot = posixpath.join('fdroidserver', *relroot.split(os.sep))
+        files.append((root, arcroot))
+        for f in sorted(filenames):
+            files.append((os.path.join(root, f), posixpath.join(arcroot, f)))
+    return files
+
+
+def send_tar_stream(sshs, dest_dir, add_files):
+    """Send files to the build server in one compressed tar stream, over one SSH channel.
+
+    The tar stream is written as it is sent, so nothing is stored
+    locally, and it is extracted on the server into dest_dir as it
+    arrives.
+
+    Parameters
+    ----------
+    add_files
+        function that is called with the TarFile to add the files to
+    """
+    chan = sshs.get_transport().open_session()
+    try:
+        chan.exec_command('mkdir -p {dir} && tar -x -z -p -f - -C {dir}'
+                          .format(dir=shlex.quote(dest_dir)))
+        try:
+            with chan.makefile('wb', net.CHUNK_SIZE) as fp:
+                with tarfile.open(fileobj=fp, mode='w|gz') as tar:
+                    add_files(tar)
+        except OSError as e:
+            # when tar fails on the server, the channel is closed
+            logging.debug('Could not send files to the build server: %s' % e)
+        chan.shutdown_write()
+        if chan.recv_exit_status() != 0:
+            with chan.makefile_stderr('rb') as fp:
+                stderr = fp.read().decode('utf-8', errors='replace')
+            raise BuildException(_('Could not send files to the build server'), stderr)
+    finally:
+        chan.close()
+
+
+def receive_tar_stream(sshs, src_dir, files):
+    """Get files from the build server in one compressed tar stream, over one SSH channel.
+
+    Parameters
+    ----------
+    files
+        dict of the path of each file on the server, relative to
+        src_dir, to the local path to save it to.  Files that are not
+        on the server are skipped.
+
+    Returns
+    -------
+    the set of the files that were received
+    """
+    names = ' '.join(shlex.quote(f) for f in sorted(files))
+    chan = sshs.get_transport().open_session()
+    received = set()
+    try:
+        chan.exec_command('cd {dir} && for f in {names}; do [ -f "$f" ] && echo "$f"; done'
+                          ' | tar -c -z -f - -T -'
+                          .format(dir=shlex.quote(src_dir), names=names))
+        try:
+            with chan.makefile('rb', net.CHUNK_SIZE) as fp:
+                with tarfile.open(fileobj=fp, mode='r|gz') as tar:
+                    for tarinfo in tar:
+                        if tarinfo.isfile() and tarinfo.name in files:
+                            with tar.extractfile(tarinfo) as src, \
+                                    open(files[tarinfo.name], 'wb') as dest:
+                                shutil.copyfileobj(src, dest, net.CHUNK_SIZE)
+                            received.add(tarinfo.name)
+        except tarfile.TarError as e:
+            with chan.makefile_stderr('rb') as fp:
+                stderr = fp.read().decode('utf-8', errors='replace')
+            raise BuildException(_('Could not get files from the build server'),
+                                 str(e) + '\n' + stderr) from e
+        chan.recv_exit_status()
+    finally:
+        chan.close()
+    return received
+
+
 # Note that 'force' here also implies test mode.
 def build_server(app, build, vcs, build_dir, output_dir, log_dir, force):
     """Do a build on the builder vm.
@@ -66,7 +196,7 @@ def build_server(app, build, vcs, build_dir, output_dir, log_dir, force):
         target folder for the build result
     force
     """
-    global buildserverid
+    global buildserverid, builder_dir
 
     try:
         paramiko
@@ -77,7 +207,14 @@ def build_server(app, build, vcs, build_dir, output_dir, log_dir, force):
     else:
         logging.getLogger("paramiko").setLevel(logging.WARN)
 
-    sshinfo = vmtools.get_clean_builder('builder')
+    if vm_pool is not None:
+        pooled = vm_pool.acquire()
+        builder_dir = pooled.srvdir
+        sshinfo = pooled.sshinfo
+    else:
+        pooled = None
+        builder_dir = 'builder'
+        sshinfo = vmtools.get_clean_builder(builder_dir)
 
     output = None
     try:
@@ -85,12 +222,12 @@ def build_server(app, build, vcs, build_dir, output_dir, log_dir, force):
             try:
                 buildserverid = subprocess.check_output(['vagrant', 'ssh', '-c',
                                                          'cat /home/vagrant/buildserverid'],
-                                                        cwd='builder').strip().decode()
+                                                        cwd=builder_dir).strip().decode()
                 logging.debug(_('Fetched buildserverid from VM: {buildserverid}')
                               .format(buildserverid=buildserverid))
             except Exception as e:
                 if type(buildserverid) is not str or not re.match('^[0-9a-f]{40}$', buildserverid):
-                    logging.info(subprocess.check_output(['vagrant', 'status'], cwd="builder"))
+                    logging.info(subprocess.check_output(['vagrant', 'status'], cwd=builder_dir))
                     raise FDroidException("Could not obtain buildserverid from buldserver VM. "
                                           "(stored inside the buildserver VM at '/home/vagrant/buildserverid') "
                                           "Please reset your buildserver, the setup VM is broken.") from e
@@ -105,119 +242,74 @@ def build_server(app, build, vcs, build_dir, output_dir, log_dir, force):
 
         homedir = posixpath.join('/home', sshinfo['user'])
 
-        # Get an SFTP connection...
-        ftp = sshs.open_sftp()
-        ftp.get_channel().settimeout(60)
-
-        # Put all the necessary files in place...
-        ftp.chdir(homedir)
-
-        # Helper to copy the contents of a directory to the server...
-        def send_dir(path):
-            logging.debug("rsyncing " + path + " to " + ftp.getcwd())
-            # TODO this should move to `vagrant rsync` from >= v1.5
-            try:
-                subprocess.check_output(['rsync', '--recursive', '--perms', '--links', '--quiet', '--rsh='
-                                         + 'ssh -o StrictHostKeyChecking=no'
-                                         + ' -o UserKnownHostsFile=/dev/null'
-                                         + ' -o LogLevel=FATAL'
-                                         + ' -o IdentitiesOnly=yes'
-                                         + ' -o PasswordAuthentication=no'
-                                         + ' -p ' + str(sshinfo['port'])
-                                         + ' -i ' + sshinfo['idfile'],
-                                         path,
-                                         sshinfo['user'] + "@" + sshinfo['hostname'] + ":" + ftp.getcwd()],
-                                        stderr=subprocess.STDOUT)
-            except subprocess.CalledProcessError as e:
-                raise FDroidException(str(e), e.output.decode())
-
         logging.info("Preparing server for build...")
         serverpath = os.path.abspath(os.path.dirname(__file__))
-        ftp.mkdir('fdroidserver')
-        ftp.chdir('fdroidserver')
-        ftp.put(os.path.join(serverpath, '..', 'fdroid'), 'fdroid')
-        ftp.put(os.path.join(serverpath, '..', 'gradlew-fdroid'), 'gradlew-fdroid')
-        ftp.chmod('fdroid', 0o755)  # nosec B103 permissions are appropriate
-        ftp.chmod('gradlew-fdroid', 0o755)  # nosec B103 permissions are appropriate
-        send_dir(os.path.join(serverpath))
-        ftp.chdir(homedir)
-
-        ftp.put(os.path.join(serverpath, '..', 'buildserver',
-                             'config.buildserver.yml'), 'config.yml')
-        ftp.chmod('config.yml', 0o600)
-
-        # Copy over the ID (head commit hash) of the fdroidserver in use...
-        with open(os.path.join(os.getcwd(), 'tmp', 'fdroidserverid'), 'wb') as fp:
-            fp.write(subprocess.check_output(['git', 'rev-parse', 'HEAD'],
-                                             cwd=serverpath))
-        ftp.put('tmp/fdroidserverid', 'fdroidserverid')
-
-        # Copy the metadata - just the file for this app...
-        ftp.mkdir('metadata')
-        ftp.mkdir('srclibs')
-        ftp.chdir('metadata')
-        ftp.put(app.metadatapath, os.path.basename(app.metadatapath))
-
-        # And patches if there are any...
-        if os.path.exists(os.path.join('metadata', app.id)):
-            send_dir(os.path.join('metadata', app.id))
-
-        ftp.chdir(homedir)
-        # Create the build directory...
-        ftp.mkdir('build')
-        ftp.chdir('build')
-        ftp.mkdir('extlib')
-        ftp.mkdir('srclib')
-        # Copy any extlibs that are required...
-        if build.extlibs:
-            ftp.chdir(posixpath.join(homedir, 'build', 'extlib'))
-            for lib in build.extlibs:
-                lib = lib.strip()
-                libsrc = os.path.join('build', 'extlib', lib)
-                if not os.path.exists(libsrc):
-                    raise BuildException("Missing extlib {0}".format(libsrc))
-                lp = lib.split(os.sep)
-                for d in lp[:-1]:
-                    if d not in ftp.listdir():
-                        ftp.mkdir(d)
-                    ftp.chdir(d)
-                ftp.put(libsrc, lp[-1])
-                for _ignored in lp[:-1]:
-                    ftp.chdir('..')
-        # Copy any srclibs that are required...
+        fdroidserver_files = get_fdroidserver_files(serverpath)
+
+        # the ID (head commit hash) of the fdroidserver in use
+        fdroidserver_id = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=serverpath)
+        with open(os.path.join(serverpath, '..', 'buildserver', 'config.buildserver.yml'), 'rb') as fp:
+            buildserver_config = fp.read()
+
         srclibpaths = []
         if build.srclibs:
             for lib in build.srclibs:
                 srclibpaths.append(
                     common.getsrclib(lib, os.path.join('build', 'srclib'), basepath=True, prepare=False))
-
         # If one was used for the main source, add that too.
         basesrclib = vcs.getsrclib()
         if basesrclib:
             srclibpaths.append(basesrclib)
-        for name, number, lib in srclibpaths:
-            logging.info("Sending srclib '%s'" % lib)
-            ftp.chdir(posixpath.join(homedir, 'build', 'srclib'))
-            if not os.path.exists(lib):
-                raise BuildException("Missing srclib directory '" + lib + "'")
-            fv = '.fdroidvcs-' + name
-            ftp.put(os.path.join('build', 'srclib', fv), fv)
-            send_dir(lib)
-            # Copy the metadata file too...
-            ftp.chdir(posixpath.join(homedir, 'srclibs'))
-            srclibsfile = os.path.join('srclibs', name + '.yml')
-            if os.path.isfile(srclibsfile):
-                ftp.put(srclibsfile, os.path.basename(srclibsfile))
-            else:
-                raise BuildException(_('cannot find required srclibs: "{path}"')
-                                     .format(path=srclibsfile))
-        # Copy the main app source code
-        # (no need if it's a srclib)
-        if (not basesrclib) and os.path.exists(build_dir):
-            ftp.chdir(posixpath.join(homedir, 'build'))
-            fv = '.fdroidvcs-' + app.id
-            ftp.put(os.path.join('build', fv), fv)
-            send_dir(build_dir)
+
+        # Everything goes in one tar stream, which is written as it is sent
+        def add_files(tar):
+            for path, arcname in fdroidserver_files:
+                tar.add(path, arcname=arcname, recursive=False)
+            tar_add_bytes(tar, 'config.yml', buildserver_config, mode=0o600)
+            tar_add_bytes(tar, 'fdroidserverid', fdroidserver_id)
+
+            # Copy the metadata - just the file for this app, and patches if there are any...
+            tar.add(app.metadatapath,
+                    arcname=posixpath.join('metadata', os.path.basename(app.metadatapath)))
+            if os.path.exists(os.path.join('metadata', app.id)):
+                tar.add(os.path.join('metadata', app.id),
+                        arcname=posixpath.join('metadata', app.id), filter=tar_filter)
+
+            for d in ('srclibs', 'build/extlib', 'build/srclib'):
+                tar_add_dir(tar, d)
+            # Copy any extlibs that are required...
+            for lib in build.extlibs:
+                lib = lib.strip()
+                libsrc = os.path.join('build', 'extlib', lib)
+                if not os.path.exists(libsrc):
+                    raise BuildException("Missing extlib {0}".format(libsrc))
+                tar.add(libsrc, arcname=posixpath.join('build', 'extlib', lib))
+            # Copy any srclibs that are required...
+            for name, number, lib in srclibpaths:
+                logging.info("Sending srclib '%s'" % lib)
+                if not os.path.exists(lib):
+                    raise BuildException("Missing srclib directory '" + lib + "'")
+                fv = '.fdroidvcs-' + name
+                tar.add(os.path.join('build', 'srclib', fv), arcname=posixpath.join('build', 'srclib', fv))
+                # the objects in the local git cache are not on the server
+                common.dissociate_git_objects(lib)
+                tar.add(lib, arcname=posixpath.join('build', 'srclib', os.path.basename(lib)))
+                # Copy the metadata file too...
+                srclibsfile = os.path.join('srclibs', name + '.yml')
+                if os.path.isfile(srclibsfile):
+                    tar.add(srclibsfile, arcname=posixpath.join('srclibs', os.path.basename(srclibsfile)))
+                else:
+                    raise BuildException(_('cannot find required srclibs: "{path}"')
+                                         .format(path=srclibsfile))
+            # Copy the main app source code
+            # (no need if it's a srclib)
+            if (not basesrclib) and os.path.exists(build_dir):
+                fv = '.fdroidvcs-' + app.id
+                tar.add(os.path.join('build', fv), arcname=posixpath.join('build', fv))
+                common.dissociate_git_objects(build_dir)
+                tar.add(build_dir, arcname=posixpath.join('build', os.path.basename(build_dir)))
+
+        send_tar_stream(sshs, homedir, add_files)
 
         # Execute the build script...
         logging.info("Starting build...")
@@ -267,38 +359,36 @@ def build_server(app, build, vcs, build_dir, output_dir, log_dir, force):
             raise BuildException(message.format(app.id, build.versionName),
                                  str(output, 'utf-8'))
 
-        # Retreive logs...
-        toolsversion_log = common.get_toolsversion_logname(app, build)
-        try:
-            ftp.chdir(posixpath.join(homedir, log_dir))
-            ftp.get(toolsversion_log, os.path.join(log_dir, toolsversion_log))
-            logging.debug('retrieved %s', toolsversion_log)
-        except Exception as e:
-            logging.warning('could not get %s from builder vm: %s' % (toolsversion_log, e))
-
-        # Retrieve the built files...
+        # Retrieve the logs and the built files...
         logging.info("Retrieving build output...")
-        if force:
-            ftp.chdir(posixpath.join(homedir, 'tmp'))
-        else:
-            ftp.chdir(posixpath.join(homedir, 'unsigned'))
+        toolsversion_log = common.get_toolsversion_logname(app, build)
         apkfile = common.get_release_filename(app, build)
         tarball = common.getsrcname(app, build)
-        try:
-            ftp.get(apkfile, os.path.join(output_dir, apkfile))
-            if not options.notarball:
-                ftp.get(tarball, os.path.join(output_dir, tarball))
-        except Exception:
+        remote_output_dir = 'tmp' if force else 'unsigned'
+        files = {
+            posixpath.join(log_dir, toolsversion_log): os.path.join(log_dir, toolsversion_log),
+            posixpath.join(remote_output_dir, apkfile): os.path.join(output_dir, apkfile),
+        }
+        if not options.notarball:
+            files[posixpath.join(remote_output_dir, tarball)] = os.path.join(output_dir, tarball)
+        received = receive_tar_stream(sshs, homedir, files)
+        if posixpath.join(log_dir, toolsversion_log) in received:
+            logging.debug('retrieved %s', toolsversion_log)
+        else:
+            logging.warning('could not get %s from builder vm' % toolsversion_log)
+        if set(files) - received - {posixpath.join(log_dir, toolsversion_log)}:
             raise BuildException(
                 "Build failed for {0}:{1} - missing output files".format(
                     app.id, build.versionName), str(output, 'utf-8'))
-        ftp.close()
 
     finally:
-        # Suspend the build server.
-        vm = vmtools.get_build_vm('builder')
-        logging.info('destroying buildserver after build')
-        vm.destroy()
+        if pooled is not None:
+            logging.info('recycling buildserver after build')
+            vm_pool.release(pooled)
+        else:
+            vm = vmtools.get_build_vm(builder_dir)
+            logging.info('destroying buildserver after build')
+            vm.destroy()
 
         # deploy logfile to repository web server
         if output:
@@ -450,6 +540,8 @@ def build_local(app, build, vcs, build_dir, output_dir, log_dir, srclib_dir, ext
         cmd = [config['gradle']]
         if build.gradleprops:
             cmd += ['-P' + kv for kv in build.gradleprops]
+        if common.maven_cache is not None:
+            cmd += ['--init-script', common.maven_cache.init_script]
 
         cmd += ['clean']
         p = FDroidPopen(cmd, cwd=root_dir, envs={"GRADLE_VERSION_DIR": config['gradle_version_dir'], "CACHEDIR": config['cachedir']})
@@ -672,6 +764,8 @@ def build_local(app, build, vcs, build_dir, output_dir, log_dir, srclib_dir, ext
         cmd = [config['gradle']]
         if build.gradleprops:
             cmd += ['-P' + kv for kv in build.gradleprops]
+        if common.maven_cache is not None:
+            cmd += ['--init-script', common.maven_cache.init_script]
 
         cmd += gradletasks
 
@@ -827,6 +921,28 @@ def build_local(app, build, vcs, build_dir, output_dir, log_dir, srclib_dir, ext
                     os.path.join(output_dir, tarname))
 
 
+def needs_build(app, build, output_dir, repo_dir, also_check_dir, test):
+    """Check whether a build is enabled and its APK is not there yet."""
+    dest_file = common.get_release_filename(app, build)
+
+    dest = os.path.join(output_dir, dest_file)
+    dest_repo = os.path.join(repo_dir, dest_file)
+
+    if not test:
+        if os.path.exists(dest) or os.path.exists(dest_repo):
+            return False
+
+        if also_check_dir:
+            dest_also = os.path.join(also_check_dir, dest_file)
+            if os.path.exists(dest_also):
+                return False
+
+    if build.disable and not options.force:
+        return False
+
+    return True
+
+
 def trybuild(app, build, build_dir, output_dir, log_dir, also_check_dir,
              srclib_dir, extlib_dir, tmp_dir, repo_dir, vcs, test,
              server, force, onserver, refresh):
@@ -853,26 +969,42 @@ def trybuild(app, build, build_dir, output_dir, log_dir, also_check_dir,
     Boolean
         True if the build was done, False if it wasn't necessary.
     """
-    dest_file = common.get_release_filename(app, build)
+    if not needs_build(app, build, output_dir, repo_dir, also_check_dir, test):
+        return False
 
+    dest_file = common.get_release_filename(app, build)
     dest = os.path.join(output_dir, dest_file)
-    dest_repo = os.path.join(repo_dir, dest_file)
-
-    if not test:
-        if os.path.exists(dest) or os.path.exists(dest_repo):
-            return False
-
-        if also_check_dir:
-            dest_also = os.path.join(also_check_dir, dest_file)
-            if os.path.exists(dest_also):
-                return False
-
-    if build.disable and not options.force:
-        return False
 
     logging.info("Building version %s (%s) of %s" % (
         build.versionName, build.versionCode, app.id))
 
+    # The build server VM has its own tools, so only local builds are cached
+    cache = None
+    if not (test or server or onserver or options.no_build_cache):
+        cache = buildcache.get_build_cache(config)
+    if cache:
+        cache_files = {
+            dest_file: dest,
+            common.getsrcname(app, build): os.path.join(output_dir, common.getsrcname(app, build)),
+            'toolsversion.log': os.path.join(log_dir, common.get_toolsversion_logname(app, build)),
+        }
+        try:
+            cache_key, cache_data = buildcache.build_cache_key(app, build, vcs, srclib_dir,
+                                                               extlib_dir, refresh)
+        except (FDroidException, OSError) as e:
+            logging.info(_("Not using the build cache: {error}").format(error=e))
+            cache = None
+    if cache:
+        try:
+            restored = buildcache.restore(cache, cache_key, cache_files)
+        except (OSError, ValueError, requests.exceptions.RequestException) as e:
+            logging.warning(_("Could not read the build cache: {error}").format(error=e))
+            restored = False
+        if restored and os.path.exists(dest):
+            logging.info(_("Restored {apkfilename} from the build cache")
+                         .format(apkfilename=dest_file))
+            return True
+
     if server:
         # When using server mode, still keep a local cache of the repo, by
         # grabbing the source now.
@@ -885,14 +1017,340 @@ def trybuild(app, build, build_dir, output_dir, log_dir, also_check_dir,
         build_server(app, build, vcs, build_dir, output_dir, log_dir, force)
     else:
         build_local(app, build, vcs, build_dir, output_dir, log_dir, srclib_dir, extlib_dir, tmp_dir, force, onserver, refresh)
+
+    if cache:
+        with open(cache_files['toolsversion.log'], 'w') as fp:
+            fp.write(common.get_android_tools_version_log())
+        try:
+            buildcache.save(cache, cache_key, cache_data, cache_files)
+        except (OSError, requests.exceptions.RequestException) as e:
+            logging.warning(_("Could not save the build in the build cache: {error}")
+                            .format(error=e))
+    return True
+
+
+def build_one(app, build, vcs, build_dir, output_dir, log_dir, also_check_dir,
+              srclib_dir, extlib_dir, tmp_dir, repo_dir, binaries_dir):
+    """Build one version of an app, and compare it to the developer's binary, if any.
+
+    Returns
+    -------
+    True if the build was done, False if it wasn't necessary.
+    """
+    logging.info("Using %s" % vcs.clientversion())
+    logging.debug("Checking " + build.versionName)
+    if not trybuild(app, build, build_dir, output_dir, log_dir,
+                    also_check_dir, srclib_dir, extlib_dir,
+                    tmp_dir, repo_dir, vcs, options.test,
+                    options.server, options.force,
+                    options.onserver, options.refresh):
+        return False
+
+    if app.Binaries is not None:
+        # This is an app where we build from source, and
+        # verify the APK contents against a developer's
+        # binary. We get that binary now, and save it
+        # alongside our built one in the 'unsigend'
+        # directory.
+        if not os.path.isdir(binaries_dir):
+            os.makedirs(binaries_dir)
+            logging.info("Created directory for storing "
+                         "developer supplied reference "
+                         "binaries: '{path}'"
+                         .format(path=binaries_dir))
+        url = app.Binaries
+        url = url.replace('%v', build.versionName)
+        url = url.replace('%c', str(build.versionCode))
+        logging.info("...retrieving " + url)
+        of = re.sub(r'\.apk$', '.binary.apk', common.get_release_filename(app, build))
+        of = os.path.join(binaries_dir, of)
+        try:
+            net.download_file(url, local_filename=of)
+        except requests.exceptions.HTTPError as e:
+            raise FDroidException(
+                'Downloading Binaries from %s failed.' % url) from e
+
+        # Now we check whether the build can be verified to
+        # match the supplied binary or not. Should the
+        # comparison fail, we mark this build as a failure
+        # and remove everything from the unsigend folder.
+        with tempfile.TemporaryDirectory() as tmpdir:
+            unsigned_apk = \
+                common.get_release_filename(app, build)
+            unsigned_apk = \
+                os.path.join(output_dir, unsigned_apk)
+            compare_result = \
+                common.verify_apks(of, unsigned_apk, tmpdir)
+            if compare_result:
+                if options.test:
+                    logging.warning(_('Keeping failed build "{apkfilename}"')
+                                    .format(apkfilename=unsigned_apk))
+                else:
+                    logging.debug('removing %s', unsigned_apk)
+                    os.remove(unsigned_apk)
+                logging.debug('removing %s', of)
+                os.remove(of)
+                compare_result = compare_result.split('\n')
+                line_count = len(compare_result)
+                compare_result = compare_result[:299]
+                if line_count > len(compare_result):
+                    line_difference = \
+                        line_count - len(compare_result)
+                    compare_result.append('%d more lines ...' %
+                                          line_difference)
+                compare_result = '\n'.join(compare_result)
+                raise FDroidException('compared built binary '
+                                      'to supplied reference '
+                                      'binary but failed',
+                                      compare_result)
+            else:
+                logging.info('compared built binary to '
+                             'supplied reference binary '
+                             'successfully')
+
+    pop_toolsversion_log(app, build, log_dir)
+    return True
+
+
+def pop_toolsversion_log(app, build, log_dir):
+    """Read and remove the tools version log that a build server left, if any."""
+    toolslog = os.path.join(log_dir,
+                            common.get_toolsversion_logname(app, build))
+    if options.onserver or not os.path.exists(toolslog):
+        return None
+    with open(toolslog, 'r') as f:
+        tools_version_log = ''.join(f.readlines())
+    os.remove(toolslog)
+    return tools_version_log
+
+
+def handle_build_error(app, build, e, exc_text, failed_builds, log_dir, tools_version_log):
+    """Log a failed build, and record it in failed_builds.
+
+    The tools version log from the build server is preferred over the
+    given tools_version_log, if the build got that far.
+    """
+    appid = app.id
+    tools_version_log = pop_toolsversion_log(app, build, log_dir) or tools_version_log
+    if isinstance(e, VCSException):
+        reason = str(e).split('\n', 1)[0] if options.verbose else str(e)
+        logging.error("VCS error while building app %s: %s" % (
+            appid, reason))
+    elif isinstance(e, FDroidException):
+        tstamp = time.strftime("%Y-%m-%d %H:%M:%SZ", time.gmtime())
+        with open(os.path.join(log_dir, appid + '.log'), 'a+') as f:
+            f.write('\n\n============================================================\n')
+            f.write('versionCode: %s\nversionName: %s\ncommit: %s\n' %
+                    (build.versionCode, build.versionName, build.commit))
+            f.write('Build completed at '
+                    + tstamp + '\n')
+            f.write('\n' + tools_version_log + '\n')
+            f.write(str(e))
+        logging.error("Could not build app %s: %s" % (appid, e))
+    else:
+        logging.error("Could not build app %s due to unknown error: %s" % (
+            appid, exc_text))
+    if options.stop:
+        logging.debug("Error encoutered, stopping by user request.")
+        common.force_exit(1)
+    add_failed_builds_entry(failed_builds, appid, build, e)
+    common.deploy_build_log_with_rsync(appid, build.versionCode, exc_text)
+
+
+def _build_resources(app, build, srclib_dir):
+    """Get the dirs that a build works in, which no other build can use meanwhile."""
+    resources = {str(common.get_build_dir(app))}
+    for spec in build.srclibs:
+        name = common.parse_srclib_spec(spec)[0]
+        resources.add(os.path.join(srclib_dir, name))
+    return resources
+
+
+def _free_memory():
+    """Get the available memory in bytes, or None if it is not known."""
+    try:
+        with open('/proc/meminfo') as fp:
+            for line in fp:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def resources_available(build_dir):
+    """Check whether there is enough free memory and disk to start another build."""
+    min_memory = common.parse_human_readable_size(config['build_min_free_memory'])
+    free_memory = _free_memory()
+    if free_memory is not None and free_memory < min_memory:
+        logging.debug(_('Waiting for free memory to start another build'))
+        return False
+    min_disk = common.parse_human_readable_size(config['build_min_free_disk'])
+    if shutil.disk_usage(build_dir).free < min_disk:
+        logging.debug(_('Waiting for free disk space to start another build'))
+        return False
     return True
 
 
+def _build_process(conn, app, build, output_dir, log_dir, also_check_dir,
+                   srclib_dir, extlib_dir, tmp_dir, repo_dir, binaries_dir):
+    """Run one build in a child process, and send the outcome back through conn."""
+    os.setsid()  # so that a timeout can kill everything the build started
+    try:
+        vcs, build_dir = common.setup_vcs(app)
+        built = build_one(app, build, vcs, build_dir, output_dir, log_dir,
+                          also_check_dir, srclib_dir, extlib_dir,
+                          tmp_dir, repo_dir, binaries_dir)
+        conn.send((built, None, None))
+    except Exception as e:
+        exc_text = traceback.format_exc()
+        try:
+            pickle.dumps(e)
+        except Exception:
+            e = BuildException(str(e))
+        conn.send((False, e, exc_text))
+    finally:
+        conn.close()
+
+
+def _kill_build(job):
+    try:
+        os.killpg(job['process'].pid, signal.SIGKILL)
+    except OSError:
+        job['process'].kill()
+    job['process'].join()
+
+
+def build_in_parallel(apps, jobs, endtime, status_output, output_dir, log_dir,
+                      also_check_dir, srclib_dir, extlib_dir, tmp_dir, repo_dir,
+                      binaries_dir):
+    """Run the builds of several apps at the same time, each in its own process.
+
+    The builds of an app run one after the other, since they share its
+    build dir.  Builds that use the same srclib also wait for each
+    other.  Another build is only started while there is enough free
+    memory and disk space.  Each build is killed when it runs longer
+    than its timeout.  The status JSON is updated as builds finish.
+
+    Returns
+    -------
+    True if the builds were stopped because the global build time was reached
+    """
+    failed_builds = status_output['failedBuilds']
+    build_succeeded = status_output['successfulBuilds']
+    build_succeeded_ids = status_output['successfulBuildIds']
+
+    # only start processes for builds that need to be done
+    queues = collections.OrderedDict()
+    for appid, app in apps.items():
+        builds = [build for build in app.get('Builds', [])
+                  if needs_build(app, build, output_dir, repo_dir, also_check_dir, options.test)]
+        if builds:
+            queues[appid] = collections.deque(builds)
+
+    context = multiprocessing.get_context('fork')
+    running = []
+    max_build_time_reached = False
+    try:
+        while queues or running:
+            busy = set()
+            for job in running:
+                busy |= job['resources']
+            for appid in list(queues):
+                if len(running) >= jobs:
+                    break
+                if time.time() > endtime:
+                    max_build_time_reached = True
+                    queues.clear()
+                    break
+                app = apps[appid]
+                build = queues[appid][0]
+                resources = _build_resources(app, build, srclib_dir)
+                if resources & busy:
+                    continue
+                if running and not resources_available('build'):
+                    break
+                queues[appid].popleft()
+                if not queues[appid]:
+                    del queues[appid]
+
+                timeout = 7200 if build.timeout is None else int(build.timeout)
+                tools_version_log = common.get_android_tools_version_log()
+                parent_conn, child_conn = context.Pipe(duplex=False)
+                process = context.Process(
+                    target=_build_process,
+                    args=(child_conn, app, build, output_dir, log_dir, also_check_dir,
+                          srclib_dir, extlib_dir, tmp_dir, repo_dir, binaries_dir))
+                process.start()
+                child_conn.close()
+                running.append({
+                    'app': app,
+                    'build': build,
+                    'process': process,
+                    'conn': parent_conn,
+                    'resources': resources,
+                    'timeout': timeout,
+                    'deadline': time.time() + timeout if timeout > 0 else None,
+                    'tools_version_log': tools_version_log,
+                })
+                busy |= resources
+                common.write_running_status_json(status_output)
+
+            if not running:
+                continue
+            deadlines = [job['deadline'] for job in running if job['deadline']]
+            wait = min(deadlines) - time.time() if deadlines else None
+            multiprocessing.connection.wait(
+                [job['conn'] for job in running] + [job['process'].sentinel for job in running],
+                timeout=None if wait is None else max(0, wait))
+
+            for job in list(running):
+                app = job['app']
+                build = job['build']
+                if job['conn'].poll():
+                    try:
+                        built, e, exc_text = job['conn'].recv()
+                    except EOFError:
+                        built, e, exc_text = False, None, None
+                    job['process'].join()
+                elif not job['process'].is_alive():
+                    built, e, exc_text = False, None, None
+                elif job['deadline'] and time.time() > job['deadline']:
+                    _kill_build(job)
+                    built = False
+                    e = BuildException(_('Build timed out after {timeout} seconds')
+                                       .format(timeout=job['timeout']))
+                    exc_text = str(e)
+                else:
+                    continue
+                running.remove(job)
+                job['conn'].close()
+                if e is None and not built and job['process'].exitcode:
+                    e = BuildException(_('Build process exited with {code}')
+                                       .format(code=job['process'].exitcode))
+                    exc_text = str(e)
+                if e is not None:
+                    if options.stop:
+                        for other in running:
+                            _kill_build(other)
+                    handle_build_error(app, build, e, exc_text, failed_builds, log_dir,
+                                       job['tools_version_log'])
+                elif built:
+                    build_succeeded.append(app)
+                    build_succeeded_ids.append([app['id'], build.versionCode])
+                common.write_running_status_json(status_output)
+    finally:
+        for job in running:
+            _kill_build(job)
+
+    return max_build_time_reached
+
+
 def force_halt_build(timeout):
     """Halt the currently running Vagrant VM, to be called from a Timer."""
     logging.error(_('Force halting build after {0} sec timeout!').format(timeout))
     timeout_event.set()
-    vm = vmtools.get_build_vm('builder')
+    vm = vmtools.get_build_vm(builder_dir)
     vm.halt()
 
 
@@ -929,6 +1387,10 @@ def parse_commandline():
                         help=_("Don't create a source tarball, useful when testing a build"))
     parser.add_argument("--no-refresh", dest="refresh", action="store_false", default=True,
                         help=_("Don't refresh the repository, useful when testing a build with no internet connection"))
+    parser.add_argument("--no-build-cache", action="store_true", default=False,
+                        help=_("Don't use the build cache"))
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help=_("Run up to this many builds of different apps at the same time"))
     parser.add_argument("-f", "--force", action="store_true", default=False,
                         help=_("Force build of disabled apps, and carries on regardless of scan problems. Only allowed in test mode."))
     parser.add_argument("-a", "--all", action="store_true", default=False,
@@ -953,6 +1415,8 @@ options = None
 config = None
 buildserverid = None
 fdroidserverid = None
+builder_dir = 'builder'
+vm_pool = None
 start_timestamp = time.gmtime()
 status_output = None
 timeout_event = threading.Event()
@@ -960,7 +1424,7 @@ timeout_event = threading.Event()
 
 def main():
 
-    global options, config, buildserverid, fdroidserverid
+    global options, config, buildserverid, fdroidserverid, vm_pool
 
     options, parser = parse_commandline()
 
@@ -990,6 +1454,8 @@ def main():
         options.server = True
     if options.reset_server and not options.server:
         parser.error("option %s: Using --reset-server without --server makes no sense" % "reset-server")
+    if options.jobs > 1 and (options.server or options.onserver):
+        parser.error("option %s: Parallel builds are only supported for local builds" % "jobs")
 
     if options.onserver or not options.server:
         for d in ['build-tools', 'platform-tools', 'tools']:
@@ -1073,6 +1539,14 @@ def main():
                 app['Builds'] = [build]
                 break
 
+    if options.server and config['build_vm_pool_size'] > 0:
+        vm_pool = vmtools.BuildVmPool('builder', config['build_vm_pool_size'])
+
+    # Builds run on the build server get their Maven artifacts there
+    if config['maven_cache'] and not options.server:
+        common.maven_cache = mavencache.MavenCache(config['maven_cache'])
+        common.maven_cache.start()
+
     # Build applications...
     failed_builds = []
     build_succeeded = []
@@ -1082,168 +1556,72 @@ def main():
     status_output['successfulBuildIds'] = build_succeeded_ids
     # Only build for 72 hours, then stop gracefully.
     endtime = time.time() + 72 * 60 * 60
-    max_build_time_reached = False
-    for appid, app in apps.items():
-
-        first = True
-
-        for build in app.get('Builds', []):
-            if time.time() > endtime:
-                max_build_time_reached = True
-                break
-
-            # Enable watchdog timer (2 hours by default).
-            if build.timeout is None:
-                timeout = 7200
-            else:
-                timeout = int(build.timeout)
-            if options.server and timeout > 0:
-                logging.debug(_('Setting {0} sec timeout for this build').format(timeout))
-                timer = threading.Timer(timeout, force_halt_build, [timeout])
-                timeout_event.clear()
-                timer.start()
-            else:
-                timer = None
+    if options.jobs > 1:
+        if build_in_parallel(apps, options.jobs, endtime, status_output, output_dir, log_dir,
+                             also_check_dir, srclib_dir, extlib_dir, tmp_dir, repo_dir,
+                             binaries_dir):
+            status_output['maxBuildTimeReached'] = True
+            logging.info("Stopping after global build timeout...")
+    else:
+        max_build_time_reached = False
+        for appid, app in apps.items():
 
-            tools_version_log = ''
-            if not options.onserver:
-                tools_version_log = common.get_android_tools_version_log()
-                common.write_running_status_json(status_output)
-            try:
+            first = True
 
-                # For the first build of a particular app, we need to set up
-                # the source repo. We can reuse it on subsequent builds, if
-                # there are any.
-                if first:
-                    vcs, build_dir = common.setup_vcs(app)
-                    first = False
-
-                logging.info("Using %s" % vcs.clientversion())
-                logging.debug("Checking " + build.versionName)
-                if trybuild(app, build, build_dir, output_dir, log_dir,
-                            also_check_dir, srclib_dir, extlib_dir,
-                            tmp_dir, repo_dir, vcs, options.test,
-                            options.server, options.force,
-                            options.onserver, options.refresh):
-                    toolslog = os.path.join(log_dir,
-                                            common.get_toolsversion_logname(app, build))
-                    if not options.onserver and os.path.exists(toolslog):
-                        with open(toolslog, 'r') as f:
-                            tools_version_log = ''.join(f.readlines())
-                        os.remove(toolslog)
-
-                    if app.Binaries is not None:
-                        # This is an app where we build from source, and
-                        # verify the APK contents against a developer's
-                        # binary. We get that binary now, and save it
-                        # alongside our built one in the 'unsigend'
-                        # directory.
-                        if not os.path.isdir(binaries_dir):
-                            os.makedirs(binaries_dir)
-                            logging.info("Created directory for storing "
-                                         "developer supplied reference "
-                                         "binaries: '{path}'"
-                                         .format(path=binaries_dir))
-                        url = app.Binaries
-                        url = url.replace('%v', build.versionName)
-                        url = url.replace('%c', str(build.versionCode))
-                        logging.info("...retrieving " + url)
-                        of = re.sub(r'\.apk$', '.binary.apk', common.get_release_filename(app, build))
-                        of = os.path.join(binaries_dir, of)
-                        try:
-                            net.download_file(url, local_filename=of)
-                        except requests.exceptions.HTTPError as e:
-                            raise FDroidException(
-                                'Downloading Binaries from %s failed.' % url) from e
-
-                        # Now we check whether the build can be verified to
-                        # match the supplied binary or not. Should the
-                        # comparison fail, we mark this build as a failure
-                        # and remove everything from the unsigend folder.
-                        with tempfile.TemporaryDirectory() as tmpdir:
-                            unsigned_apk = \
-                                common.get_release_filename(app, build)
-                            unsigned_apk = \
-                                os.path.join(output_dir, unsigned_apk)
-                            compare_result = \
-                                common.verify_apks(of, unsigned_apk, tmpdir)
-                            if compare_result:
-                                if options.test:
-                                    logging.warning(_('Keeping failed build "{apkfilename}"')
-                                                    .format(apkfilename=unsigned_apk))
-                                else:
-                                    logging.debug('removing %s', unsigned_apk)
-                                    os.remove(unsigned_apk)
-                                logging.debug('removing %s', of)
-                                os.remove(of)
-                                compare_result = compare_result.split('\n')
-                                line_count = len(compare_result)
-                                compare_result = compare_result[:299]
-                                if line_count > len(compare_result):
-                                    line_difference = \
-                                        line_count - len(compare_result)
-                                    compare_result.append('%d more lines ...' %
-                                                          line_difference)
-                                compare_result = '\n'.join(compare_result)
-                                raise FDroidException('compared built binary '
-                                                      'to supplied reference '
-                                                      'binary but failed',
-                                                      compare_result)
-                            else:
-                                logging.info('compared built binary to '
-                                             'supplied reference binary '
-                                             'successfully')
+            for build in app.get('Builds', []):
+                if time.time() > endtime:
+                    max_build_time_reached = True
+                    break
 
-                    build_succeeded.append(app)
-                    build_succeeded_ids.append([app['id'], build.versionCode])
+                # Enable watchdog timer (2 hours by default).
+                if build.timeout is None:
+                    timeout = 7200
+                else:
+                    timeout = int(build.timeout)
+                if options.server and timeout > 0:
+                    logging.debug(_('Setting {0} sec timeout for this build').format(timeout))
+                    timer = threading.Timer(timeout, force_halt_build, [timeout])
+                    timeout_event.clear()
+                    timer.start()
+                else:
+                    timer = None
+
+                tools_version_log = ''
+                if not options.onserver:
+                    tools_version_log = common.get_android_tools_version_log()
+                    common.write_running_status_json(status_output)
+                try:
+
+                    # For the first build of a particular app, we need to set up
+                    # the source repo. We can reuse it on subsequent builds, if
+                    # there are any.
+                    if first:
+                        vcs, build_dir = common.setup_vcs(app)
+                        first = False
+
+                    if build_one(app, build, vcs, build_dir, output_dir, log_dir,
+                                 also_check_dir, srclib_dir, extlib_dir,
+                                 tmp_dir, repo_dir, binaries_dir):
+                        build_succeeded.append(app)
+                        build_succeeded_ids.append([app['id'], build.versionCode])
+
+                except Exception as e:
+                    handle_build_error(app, build, e, traceback.format_exc(),
+                                       failed_builds, log_dir, tools_version_log)
+
+                if timer:
+                    timer.cancel()  # kill the watchdog timer
+
+            if max_build_time_reached:
+                status_output['maxBuildTimeReached'] = True
+                logging.info("Stopping after global build timeout...")
+                break
 
-            except VCSException as vcse:
-                reason = str(vcse).split('\n', 1)[0] if options.verbose else str(vcse)
-                logging.error("VCS error while building app %s: %s" % (
-                    appid, reason))
-                if options.stop:
-                    logging.debug("Error encoutered, stopping by user request.")
-                    common.force_exit(1)
-                add_failed_builds_entry(failed_builds, appid, build, vcse)
-                common.deploy_build_log_with_rsync(
-                    appid, build.versionCode, "".join(traceback.format_exc())
-                )
-            except FDroidException as e:
-                tstamp = time.strftime("%Y-%m-%d %H:%M:%SZ", time.gmtime())
-                with open(os.path.join(log_dir, appid + '.log'), 'a+') as f:
-                    f.write('\n\n============================================================\n')
-                    f.write('versionCode: %s\nversionName: %s\ncommit: %s\n' %
-                            (build.versionCode, build.versionName, build.commit))
-                    f.write('Build completed at '
-                            + tstamp + '\n')
-                    f.write('\n' + tools_version_log + '\n')
-                    f.write(str(e))
-                logging.error("Could not build app %s: %s" % (appid, e))
-                if options.stop:
-                    logging.debug("Error encoutered, stopping by user request.")
-                    common.force_exit(1)
-                add_failed_builds_entry(failed_builds, appid, build, e)
-                common.deploy_build_log_with_rsync(
-                    appid, build.versionCode, "".join(traceback.format_exc())
-                )
-            except Exception as e:
-                logging.error("Could not build app %s due to unknown error: %s" % (
-                    appid, traceback.format_exc()))
-                if options.stop:
-                    logging.debug("Error encoutered, stopping by user request.")
-                    common.force_exit(1)
-                add_failed_builds_entry(failed_builds, appid, build, e)
-                common.deploy_build_log_with_rsync(
-                    appid, build.versionCode, "".join(traceback.format_exc())
-                )
-
-            if timer:
-                timer.cancel()  # kill the watchdog timer
-
-        if max_build_time_reached:
-            status_output['maxBuildTimeReached'] = True
-            logging.info("Stopping after global build timeout...")
-            break
+    if vm_pool is not None:
+        vm_pool.close()
+    if common.maven_cache is not None:
+        common.maven_cache.stop()
+        status_output['mavenCache'] = common.maven_cache.stats()
 
     for app in build_succeeded:
         logging.info("success: %s" % (app.id))
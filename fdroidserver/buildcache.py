@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+#
+# buildcache.py - part of the FDroid server tools
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Cache the results of builds, keyed by everything that goes into them.
+
+The key is the SHA-256 of the resolved commit IDs of the app and its
+srclibs, the build recipe, the extlibs and patches, and the versions of
+the installed Android tools.  If any of those cannot be pinned down,
+e.g. because a srclib is not in git, the build is not cached.
+
+A cache entry is a directory named after the key, with the output files
+and a build.json listing them with their SHA-256.  build.json is written
+last, so an entry without it is incomplete and ignored.  The cache can
+be a local directory, or a URL to a server that supports GET and PUT,
+like nginx with WebDAV.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import urllib.parse
+
+import requests
+
+from . import _
+from . import common
+from . import metadata
+from . import net
+from .exception import FDroidException
+
+# bump this when a change in fdroidserver can change the output of a
+# build that otherwise has the same inputs
+BUILD_CACHE_VERSION = 1
+
+MANIFEST = 'build.json'
+
+
+class LocalBuildCache:
+    """A build cache in a local directory, which can be shared, e.g. over NFS."""
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+
+    def _path(self, key, name):
+        return os.path.join(self.path, key[:2], key, name)
+
+    def fetch(self, key, name, dest):
+        """Copy a file of a cache entry to dest, return whether it was there."""
+        src = self._path(key, name)
+        if not os.path.isfile(src):
+            return False
+        shutil.copyfile(src, dest + '.tmp')
+        os.replace(dest + '.tmp', dest)
+        return True
+
+    def store(self, key, name, src):
+        dest = self._path(key, name)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        shutil.copyfile(src, dest + '.tmp')
+        os.replace(dest + '.tmp', dest)
+
+
+class HttpBuildCache:
+    """A build cache on a web server that accepts PUT requests."""
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+
+    def _url(self, key, name):
+        return '/'.join((self.url, key[:2], key, urllib.parse.quote(name)))
+
+    def fetch(self, key, name, dest):
+        try:
+            net.download_file(self._url(key, name), local_filename=dest)
+        except requests.exceptions.HTTPError as e:
+            if e.response is not None and e.response.status_code == 404:
+                return False
+            raise
+        return True
+
+    def store(self, key, name, src):
+        with open(src, 'rb') as fp:
+            r = net.get_session().put(self._url(key, name), data=fp, timeout=600)
+        r.raise_for_status()
+
+
+def get_build_cache(config):
+    """Get the backend for the build_cache set in config, or None if unset."""
+    location = config.get('build_cache')
+    if not location:
+        return None
+    if urllib.parse.urlparse(location).scheme in ('http', 'https'):
+        return HttpBuildCache(location)
+    return LocalBuildCache(location)
+
+
+def _sha256_files(paths):
+    return {str(p): common.sha256sum(str(p)) for p in sorted(paths)}
+
+
+def _resolve_commit(vcs, rev, refresh):
+    """Fetch a git repo without a checkout, then get the commit ID of rev."""
+    if vcs.repotype() != 'git':
+        raise FDroidException(
+            _('{vcs} repos cannot be cached').format(vcs=vcs.repotype())
+        )
+    vcs.gotorevision(rev, refresh, checkout=False)
+    commit = vcs.getref(rev or 'origin/HEAD')
+    if not commit:
+        raise FDroidException(_('Cannot resolve {rev}').format(rev=rev))
+    return commit
+
+
+def build_cache_key(app, build, vcs, srclib_dir, extlib_dir, refresh=True):
+    """Calculate the cache key for a build.
+
+    This fetches the source repos, so that branch names and tags
+    are resolved to what they are now.
+
+    Returns
+    -------
+    the key as a hex string, and the data it was made from
+    """
+    srclibs = dict()
+    for spec in build.srclibs:
+        name, ref, _number, _subdir = common.parse_srclib_spec(spec)
+        srclib_vcs = common.getsrclib(spec, srclib_dir, raw=True)
+        srclibs[spec] = [
+            metadata.srclibs[name],
+            _resolve_commit(srclib_vcs, ref, refresh),
+        ]
+
+    extlibs = [os.path.join(extlib_dir, lib.strip()) for lib in build.extlibs]
+    patches = [os.path.join('metadata', app.id, p) for p in build.patch]
+
+    data = {
+        'version': BUILD_CACHE_VERSION,
+        'appid': app.id,
+        'commit': _resolve_commit(vcs, build.commit, refresh),
+        'build': build,
+        'srclibs': srclibs,
+        'extlibs': _sha256_files(extlibs),
+        'patches': _sha256_files(patches),
+        'tools': sorted(common.get_android_tools_versions()),
+    }
+    encoded = json.dumps(data, sort_keys=True, default=str).encode()
+    return hashlib.sha256(encoded).hexdigest(), data
+
+
+def restore(cache, key, files):
+    """Restore the output of a cached build.
+
+    Parameters
+    ----------
+    files
+        dict of the name of each file in the cache entry to where it
+        should be restored.  Files that are not in the entry are skipped.
+
+    Returns
+    -------
+    True if the entry was complete and its files were restored
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        manifest_path = os.path.join(tmpdir, MANIFEST)
+        if not cache.fetch(key, MANIFEST, manifest_path):
+            return False
+        with open(manifest_path) as fp:
+            manifest = json.load(fp)
+        fetched = dict()
+        for name, sha256 in manifest['files'].items():
+            if name not in files:
+                continue
+            path = os.path.join(tmpdir, name)
+            if not cache.fetch(key, name, path) or common.sha256sum(path) != sha256:
+                logging.warning(_('Build cache entry {key} is broken').format(key=key))
+                return False
+            fetched[name] = path
+        for name, path in fetched.items():
+            os.makedirs(os.path.dirname(files[name]) or '.', exist_ok=True)
+            shutil.move(path, files[name])
+    return True
+
+
+def save(cache, key, data, files):
+    """Store the output files of a build in the cache, with build.json last.
+
+    Parameters
+    ----------
+    files
+        dict of the name of each file in the cache entry to the file to
+        store.  Files that do not exist are skipped.
+    """
+    manifest = {'key': data, 'files': dict()}
+    for name, path in files.items():
+        if os.path.isfile(path):
+            cache.store(key, name, path)
+            manifest['files'][name] = common.sha256sum(path)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        manifest_path = os.path.join(tmpdir, MANIFEST)
+        with open(manifest_path, 'w') as fp:
+            json.dump(manifest, fp, indent=2, sort_keys=True, default=str)
+        cache.store(key, MANIFEST, manifest_path)
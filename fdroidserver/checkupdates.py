@@ -17,13 +17,17 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import concurrent.futures
+import contextlib
+import hashlib
+import json
 import os
 import re
-import urllib.request
-import urllib.error
 import time
 import subprocess
 import sys
+import tempfile
+import threading
 from argparse import ArgumentParser
 import traceback
 import html
@@ -31,6 +35,7 @@ from distutils.version import LooseVersion
 import logging
 import copy
 import urllib.parse
+import requests
 from pathlib import Path
 
 from . import _
@@ -40,6 +45,54 @@ from . import net
 from .exception import VCSException, NoSubmodulesException, FDroidException, MetaDataException
 
 
+# apps are checked in parallel, but each host only gets a few connections
+# at a time, only one thread at a time writes the metadata, and only one
+# uses each checkout, e.g. build/srclib/<name> shared by srclib apps
+_host_semaphores = dict()
+_host_semaphores_lock = threading.Lock()
+_metadata_lock = threading.Lock()
+_build_dir_locks = dict()
+_build_dir_locks_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def host_limit(url):
+    """Wait for a free connection slot to the host of url.
+
+    The number of slots per host is set by --jobs-per-host.  Local
+    paths and URLs that cannot be parsed are not limited.
+    """
+    host = None
+    if isinstance(url, str):
+        try:
+            host = urllib.parse.urlparse(url).hostname
+        except ValueError:
+            pass
+        if not host and re.match(r'[^/]+@[^/:]+:', url):  # git@host:path
+            host = url.split('@', 1)[1].split(':', 1)[0]
+    if not host:
+        yield
+        return
+    with _host_semaphores_lock:
+        if host not in _host_semaphores:
+            slots = getattr(options, 'jobs_per_host', None)
+            if not isinstance(slots, int) or slots < 1:
+                slots = 1
+            _host_semaphores[host] = threading.BoundedSemaphore(slots)
+        semaphore = _host_semaphores[host]
+    with semaphore:
+        yield
+
+
+def build_dir_lock(app):
+    """Get the lock for the local checkout that app is checked in."""
+    build_dir = str(common.get_build_dir(app))
+    with _build_dir_locks_lock:
+        if build_dir not in _build_dir_locks:
+            _build_dir_locks[build_dir] = threading.Lock()
+        return _build_dir_locks[build_dir]
+
+
 # Check for a new version by looking at a document retrieved via HTTP.
 # The app's Update Check Data field is used to provide the information
 # required.
@@ -58,9 +111,9 @@ def check_http(app):
             raise FDroidException(_('UpdateCheckData has invalid URL: {url}').format(url=urlcode))
 
     logging.debug("...requesting {0}".format(urlcode))
-    req = urllib.request.Request(urlcode, None, headers=net.HEADERS)
-    resp = urllib.request.urlopen(req, None, 20)  # nosec B310 scheme is filtered above
-    page = resp.read().decode('utf-8')
+    with host_limit(urlcode):
+        content, _ignored = net.http_get(urlcode, timeout=20)
+    page = content.decode('utf-8')
 
     m = re.search(codeex, page)
     if not m:
@@ -69,9 +122,9 @@ def check_http(app):
 
     if urlver != '.':
         logging.debug("...requesting {0}".format(urlver))
-        req = urllib.request.Request(urlver, None)
-        resp = urllib.request.urlopen(req, None, 20)  # nosec B310 scheme is filtered above
-        page = resp.read().decode('utf-8')
+        with host_limit(urlver):
+            content, _ignored = net.http_get(urlver, timeout=20)
+        page = content.decode('utf-8')
 
     m = re.search(verex, page)
     if not m:
@@ -85,6 +138,122 @@ def check_http(app):
     return (version, vercode)
 
 
+# The files that are needed to find the version of an app, for reading
+# them straight from git without checking out each revision.
+MANIFEST_FILE_NAMES = (
+    'AndroidManifest.xml',
+    'pom.xml',
+    'build.gradle',
+    'build.gradle.kts',
+    'build-extras.gradle',
+)
+VALUES_XML_REGEX = re.compile(r'(.*/)?res/(.*/)?values/[^/]+\.xml')
+
+
+def read_from_objects(repotype, last_build):
+    """Whether the files can be read from the VCS without a checkout.
+
+    Submodules are not part of the git objects of the app's repo, so
+    they still need a checkout.
+    """
+    return repotype == 'git' and not last_build.submodules
+
+
+@contextlib.contextmanager
+def revision_dir(vcs, build_dir, rev, from_objects, extra_paths=()):
+    """Provide a directory with the files of rev that contain the version.
+
+    When reading from the VCS objects, only the manifests, gradle
+    files, string resources and extra_paths are written to a temporary
+    directory, without touching the working tree in build_dir.
+    Otherwise rev is checked out in build_dir.
+    """
+    if not from_objects:
+        with host_limit(vcs.remote):
+            vcs.gotorevision(rev)
+        yield build_dir
+        return
+
+    def _match(path):
+        return (
+            os.path.basename(path) in MANIFEST_FILE_NAMES
+            or VALUES_XML_REGEX.fullmatch(path)
+            or path in extra_paths
+        )
+
+    with tempfile.TemporaryDirectory(prefix='fdroid-checkupdates-') as tmpdir:
+        vcs.exportfiles(rev, tmpdir, _match)
+        yield Path(tmpdir)
+
+
+def _check_tag(app, tag, root_dir, last_build, htag, hcode, hver):
+    """Look for the version in the files of one tag, checked out in root_dir.
+
+    Returns
+    -------
+    the tag, version code and version of the highest version so far
+    """
+    if app.UpdateCheckData:
+        filecode, codeex, filever, verex = app.UpdateCheckData.split('|')
+
+        if filecode:
+            filecode = root_dir / filecode
+            if not filecode.is_file():
+                logging.debug("UpdateCheckData file {0} not found in tag {1}".format(filecode, tag))
+                return htag, hcode, hver
+            filecontent = filecode.read_text()
+        else:
+            filecontent = tag
+
+        vercode = tag
+        if codeex:
+            m = re.search(codeex, filecontent)
+            if not m:
+                return htag, hcode, hver
+
+            vercode = m.group(1).strip()
+
+        if filever:
+            if filever != '.':
+                filever = root_dir / filever
+                if filever.is_file():
+                    filecontent = filever.read_text()
+                else:
+                    logging.debug("UpdateCheckData file {0} not found in tag {1}".format(filever, tag))
+        else:
+            filecontent = tag
+
+        version = tag
+        if verex:
+            m = re.search(verex, filecontent)
+            if m:
+                version = m.group(1)
+
+        logging.debug("UpdateCheckData found version {0} ({1})"
+                      .format(version, vercode))
+        i_vercode = common.version_code_string_to_int(vercode)
+        if i_vercode > common.version_code_string_to_int(hcode):
+            htag = tag
+            hcode = str(i_vercode)
+            hver = version
+    else:
+        for subdir in possible_subdirs(app, root_dir):
+            paths = common.manifest_paths(root_dir / subdir, last_build.gradle)
+            version, vercode, _package = common.parse_androidmanifests(paths, app)
+            if version == 'Unknown' or version == 'Ignore':
+                version = tag
+            if vercode:
+                logging.debug("Manifest exists in subdir '{0}'. Found version {1} ({2})"
+                              .format(subdir, version, vercode))
+                i_vercode = common.version_code_string_to_int(vercode)
+                if i_vercode > common.version_code_string_to_int(hcode):
+                    htag = tag
+                    hcode = str(i_vercode)
+                    hver = version
+
+    return htag, hcode, hver
+
+
 def check_tags(app, pattern):
     """Check for a new version by looking at the tags in the source repo.
 
@@ -108,9 +277,11 @@ def check_tags(app, pattern):
     # Set up vcs interface and make sure we have the latest code...
     vcs = common.getvcs(app.RepoType, app.Repo, build_dir)
 
-    vcs.gotorevision(None)
-
     last_build = app.get_last_build()
+    from_objects = read_from_objects(repotype, last_build)
+
+    with host_limit(vcs.remote):
+        vcs.gotorevision(None, checkout=not from_objects)
 
     try_init_submodules(app, last_build, vcs)
 
@@ -138,68 +309,16 @@ def check_tags(app, pattern):
         tags = tags[:5]
         logging.debug("Latest tags: " + ','.join(tags))
 
+    extra_paths = []
+    if app.UpdateCheckData:
+        filecode, _codeex, filever, _verex = app.UpdateCheckData.split('|')
+        extra_paths = [os.path.normpath(f) for f in (filecode, filever) if f and f != '.']
+
     for tag in tags:
         logging.debug("Check tag: '{0}'".format(tag))
-        vcs.gotorevision(tag)
-
-        if app.UpdateCheckData:
-            filecode, codeex, filever, verex = app.UpdateCheckData.split('|')
-
-            if filecode:
-                filecode = build_dir / filecode
-                if not filecode.is_file():
-                    logging.debug("UpdateCheckData file {0} not found in tag {1}".format(filecode, tag))
-                    continue
-                filecontent = filecode.read_text()
-            else:
-                filecontent = tag
-
-            vercode = tag
-            if codeex:
-                m = re.search(codeex, filecontent)
-                if not m:
-                    continue
-
-                vercode = m.group(1).strip()
-
-            if filever:
-                if filever != '.':
-                    filever = build_dir / filever
-                    if filever.is_file():
-                        filecontent = filever.read_text()
-                    else:
-                        logging.debug("UpdateCheckData file {0} not found in tag {1}".format(filever, tag))
-            else:
-                filecontent = tag
-
-            version = tag
-            if verex:
-                m = re.search(verex, filecontent)
-                if m:
-                    version = m.group(1)
-
-            logging.debug("UpdateCheckData found version {0} ({1})"
-                          .format(version, vercode))
-            i_vercode = common.version_code_string_to_int(vercode)
-            if i_vercode > common.version_code_string_to_int(hcode):
-                htag = tag
-                hcode = str(i_vercode)
-                hver = version
-        else:
-            for subdir in possible_subdirs(app):
-                root_dir = build_dir / subdir
-                paths = common.manifest_paths(root_dir, last_build.gradle)
-                version, vercode, _package = common.parse_androidmanifests(paths, app)
-                if version == 'Unknown' or version == 'Ignore':
-                    version = tag
-                if vercode:
-                    logging.debug("Manifest exists in subdir '{0}'. Found version {1} ({2})"
-                                  .format(subdir, version, vercode))
-                    i_vercode = common.version_code_string_to_int(vercode)
-                    if i_vercode > common.version_code_string_to_int(hcode):
-                        htag = tag
-                        hcode = str(i_vercode)
-                        hver = version
+        with revision_dir(vcs, build_dir, tag, from_objects, extra_paths) as root_dir:
+            htag, hcode, hver = _check_tag(app, tag, root_dir, last_build,
+                                           htag, hcode, hver)
 
     if hver:
         if htag != tags[0]:
@@ -218,6 +337,30 @@ def check_tags(app, pattern):
     raise FDroidException(_("Couldn't find any version information"))
 
 
+def _check_manifests(app, root_dir, last_build):
+    """Find the highest version in the manifests under root_dir.
+
+    Returns
+    -------
+    the package ID, version code and version
+    """
+    hpak = None
+    hver = None
+    hcode = "0"
+    for subdir in possible_subdirs(app, root_dir):
+        paths = common.manifest_paths(root_dir / subdir, last_build.gradle)
+        version, vercode, package = common.parse_androidmanifests(paths, app)
+        if vercode:
+            logging.debug("Manifest exists in subdir '{0}'. Found version {1} ({2})"
+                          .format(subdir, version, vercode))
+            i_vercode = common.version_code_string_to_int(vercode)
+            if i_vercode > common.version_code_string_to_int(hcode):
+                hpak = package
+                hcode = str(i_vercode)
+                hver = version
+    return hpak, hcode, hver
+
+
 def check_repomanifest(app, branch=None):
     """Check for a new version by looking at the AndroidManifest.xml at the HEAD of the source repo.
 
@@ -235,38 +378,33 @@ def check_repomanifest(app, branch=None):
     # Set up vcs interface and make sure we have the latest code...
     vcs = common.getvcs(app.RepoType, app.Repo, build_dir)
 
-    if repotype == 'git':
-        if branch:
-            branch = 'origin/' + branch
-        vcs.gotorevision(branch)
-    elif repotype == 'git-svn':
-        vcs.gotorevision(branch)
-    elif repotype == 'hg':
-        vcs.gotorevision(branch)
-    elif repotype == 'bzr':
-        vcs.gotorevision(None)
-
     last_build = metadata.Build()
     if app.get('Builds', []):
         last_build = app.get('Builds', [])[-1]
+    from_objects = read_from_objects(repotype, last_build)
+
+    with host_limit(vcs.remote):
+        if repotype == 'git':
+            if branch:
+                branch = 'origin/' + branch
+            if from_objects:
+                vcs.gotorevision(None, checkout=False)
+            else:
+                vcs.gotorevision(branch)
+        elif repotype == 'git-svn':
+            vcs.gotorevision(branch)
+        elif repotype == 'hg':
+            vcs.gotorevision(branch)
+        elif repotype == 'bzr':
+            vcs.gotorevision(None)
 
     try_init_submodules(app, last_build, vcs)
 
-    hpak = None
-    hver = None
-    hcode = "0"
-    for subdir in possible_subdirs(app):
-        root_dir = build_dir / subdir
-        paths = common.manifest_paths(root_dir, last_build.gradle)
-        version, vercode, package = common.parse_androidmanifests(paths, app)
-        if vercode:
-            logging.debug("Manifest exists in subdir '{0}'. Found version {1} ({2})"
-                          .format(subdir, version, vercode))
-            i_vercode = common.version_code_string_to_int(vercode)
-            if i_vercode > common.version_code_string_to_int(hcode):
-                hpak = package
-                hcode = str(i_vercode)
-                hver = version
+    if from_objects:
+        with revision_dir(vcs, build_dir, branch, from_objects) as root_dir:
+            hpak, hcode, hver = _check_manifests(app, root_dir, last_build)
+    else:
+        hpak, hcode, hver = _check_manifests(app, build_dir, last_build)
 
     if not hpak:
         raise FDroidException(_("Couldn't find package ID"))
@@ -289,7 +427,8 @@ def check_repotrunk(app):
     # Set up vcs interface and make sure we have the latest code...
     vcs = common.getvcs(app.RepoType, app.Repo, build_dir)
 
-    vcs.gotorevision(None)
+    with host_limit(vcs.remote):
+        vcs.gotorevision(None)
 
     ref = vcs.getref()
     return (ref, ref)
@@ -299,15 +438,16 @@ def check_repotrunk(app):
 # Returns (None, "a message") if this didn't work, or (version, None) for
 # the details of the current version.
 def check_gplay(app):
-    time.sleep(15)
     url = 'https://play.google.com/store/apps/details?id=' + app.id
     headers = {'User-Agent': 'Mozilla/5.0 (X11; Linux i686; rv:18.0) Gecko/20100101 Firefox/18.0'}
-    req = urllib.request.Request(url, None, headers)
     try:
-        resp = urllib.request.urlopen(req, None, 20)  # nosec B310 URL base is hardcoded above
-        page = resp.read().decode()
-    except urllib.error.HTTPError as e:
-        return (None, str(e.code))
+        with host_limit(url):
+            time.sleep(15)
+            resp = net.get_session().get(url, headers=headers, timeout=20)
+        resp.raise_for_status()
+        page = resp.content.decode()
+    except requests.exceptions.HTTPError as e:
+        return (None, str(e.response.status_code))
     except Exception as e:
         return (None, 'Failed:' + str(e))
 
@@ -351,11 +491,14 @@ def dirs_with_manifest(startdir):
             yield Path(root)
 
 
-# Tries to find a new subdir starting from the root build_dir. Returns said
-# subdir relative to the build dir if found, None otherwise.
-def possible_subdirs(app):
+# Tries to find a new subdir starting from the root build_dir, or from
+# root_dir if the files are somewhere else. Returns said subdir relative
+# to the build dir if found, None otherwise.
+def possible_subdirs(app, root_dir=None):
 
-    if app.RepoType == 'srclib':
+    if root_dir is not None:
+        build_dir = Path(root_dir)
+    elif app.RepoType == 'srclib':
         build_dir = Path('build/srclib') / app.Repo
     else:
         build_dir = Path('build') / app.id
@@ -390,21 +533,27 @@ def fetch_autoname(app, tag):
     else:
         build_dir = Path('build') / app.id
 
-    try:
-        vcs = common.getvcs(app.RepoType, app.Repo, build_dir)
-        vcs.gotorevision(tag)
-    except VCSException:
-        return None
-
     last_build = app.get_last_build()
+    if app.RepoType == 'srclib':
+        repotype = common.getsrclibvcs(app.Repo)
+    else:
+        repotype = app.RepoType
+    from_objects = read_from_objects(repotype, last_build)
 
     logging.debug("...fetch auto name from " + str(build_dir))
     new_name = None
-    for subdir in possible_subdirs(app):
-        root_dir = build_dir / subdir
-        new_name = common.fetch_real_name(root_dir, last_build.gradle)
-        if new_name is not None:
-            break
+    try:
+        vcs = common.getvcs(app.RepoType, app.Repo, build_dir)
+        if from_objects:
+            with host_limit(vcs.remote):
+                vcs.gotorevision(None, checkout=False)
+        with revision_dir(vcs, build_dir, tag, from_objects) as root_dir:
+            for subdir in possible_subdirs(app, root_dir):
+                new_name = common.fetch_real_name(root_dir / subdir, last_build.gradle)
+                if new_name is not None:
+                    break
+    except VCSException:
+        return None
     commitmsg = None
     if new_name:
         logging.debug("...got autoname '" + new_name + "'")
@@ -541,15 +690,16 @@ def checkupdates_app(app):
             )
 
     if commitmsg:
-        metadata.write_metadata(app.metadatapath, app)
-        if options.commit:
-            logging.info("Commiting update for " + app.metadatapath)
-            gitcmd = ["git", "commit", "-m", commitmsg]
-            if 'auto_author' in config:
-                gitcmd.extend(['--author', config['auto_author']])
-            gitcmd.extend(["--", app.metadatapath])
-            if subprocess.call(gitcmd) != 0:
-                raise FDroidException("Git commit failed")
+        with _metadata_lock:
+            metadata.write_metadata(app.metadatapath, app)
+            if options.commit:
+                logging.info("Commiting update for " + app.metadatapath)
+                gitcmd = ["git", "commit", "-m", commitmsg]
+                if 'auto_author' in config:
+                    gitcmd.extend(['--author', config['auto_author']])
+                gitcmd.extend(["--", app.metadatapath])
+                if subprocess.call(gitcmd) != 0:
+                    raise FDroidException("Git commit failed")
 
 
 def status_update_json(processed, failed):
@@ -568,6 +718,123 @@ options = None
 start_timestamp = time.gmtime()
 
 
+# bump this when a change in checkupdates can give different results
+# for the same upstream source, so the whole state cache is invalidated
+CHECK_STATE_VERSION = 1
+
+
+def _check_state_path(app):
+    if not app.id or not config or not config.get('cachedir'):
+        return None
+    return os.path.join(config['cachedir'], 'checkupdates', app.id + '.json')
+
+
+def _metadata_hash(app):
+    data = json.dumps([CHECK_STATE_VERSION, bool(options.auto), app],
+                      sort_keys=True, default=str)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def remote_state(app):
+    """Get a cheap fingerprint of the upstream source of an app.
+
+    For git repos, these are all the refs from a single `git ls-remote`,
+    without fetching any objects.  For the HTTP mode, these are the
+    ETags of the Update Check Data URLs, from HEAD requests.
+
+    Returns
+    -------
+    a JSON-serializable fingerprint, or None if it is not possible to
+    tell whether the source changed without a full check
+    """
+    mode = app.UpdateCheckMode
+    if mode == 'HTTP':
+        try:
+            urlcode, _codeex, urlver, _verex = app.UpdateCheckData.split('|')
+        except (AttributeError, ValueError):
+            return None
+        etags = dict()
+        for url in (urlcode, urlver):
+            if url == '.' or url in etags:
+                continue
+            if urllib.parse.urlparse(url).scheme != 'https':
+                return None
+            with host_limit(url):
+                etag = net.http_get_etag(url, timeout=20)
+            if not etag:
+                return None
+            etags[url] = etag
+        return {'etags': etags}
+    elif mode.startswith('Tags') or mode.startswith('RepoManifest') or mode == 'RepoTrunk':
+        if app.RepoType == 'srclib':
+            build_dir = Path('build/srclib') / app.Repo
+        else:
+            build_dir = Path('build') / app.id
+        vcs = common.getvcs(app.RepoType, app.Repo, build_dir)
+        with host_limit(vcs.remote):
+            refs = vcs.remoterefs()
+        if refs is None:
+            return None
+        return {'remote': vcs.remote, 'refs': refs}
+    return None
+
+
+def load_check_state(app):
+    """Load what was seen upstream the last time app was checked, if anything."""
+    path = _check_state_path(app)
+    if not path:
+        return None
+    try:
+        with open(path) as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return None
+
+
+def save_check_state(app, upstream):
+    """Record upstream and the resulting metadata of a successful check."""
+    path = _check_state_path(app)
+    if not path:
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    state = {
+        'upstream': upstream,
+        'metadata': _metadata_hash(app),
+        'CurrentVersion': app.CurrentVersion,
+        'CurrentVersionCode': app.CurrentVersionCode,
+    }
+    with open(path + '.tmp', 'w') as fp:
+        json.dump(state, fp)
+    os.replace(path + '.tmp', path)
+
+
+def _process_app(app):
+    msg = _("Processing {appid}").format(appid=app.id)
+    logging.info(msg)
+
+    # Most apps do not change between two runs, so skip those where
+    # neither the upstream refs nor the metadata changed since the last
+    # successful check.
+    upstream = None
+    if _check_state_path(app) and app.UpdateCheckMode not in ('None', 'Static'):
+        try:
+            upstream = remote_state(app)
+        except Exception as e:
+            logging.debug("...could not get the state of upstream: {0}".format(e))
+        if upstream is not None:
+            state = load_check_state(app)
+            if (state and state.get('upstream') == upstream
+                    and state.get('metadata') == _metadata_hash(app)):
+                logging.info("...unchanged since the last check, at version {0}"
+                             .format(_getcvname(app)))
+                return
+
+    with build_dir_lock(app):
+        checkupdates_app(app)
+    if upstream is not None:
+        save_check_state(app, upstream)
+
+
 def main():
 
     global config, options
@@ -586,6 +853,10 @@ def main():
                         help=_("Run on git repo that has uncommitted changes"))
     parser.add_argument("--gplay", action="store_true", default=False,
                         help=_("Only print differences with the Play Store"))
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help=_("Number of apps to check at the same time"))
+    parser.add_argument("--jobs-per-host", type=int, default=4,
+                        help=_("Maximum number of connections to the same host"))
     metadata.add_metadata_arguments(parser)
     options = parser.parse_args()
     metadata.warnings_action = options.W
@@ -628,27 +899,31 @@ def main():
                                      .format(_getappname(app), version))
         return
 
-    processed = []
-    failed = dict()
-    exit_code = 0
+    todo = []
     for appid, app in apps.items():
-
         if options.autoonly and app.AutoUpdateMode in ('None', 'Static'):
             logging.debug(_("Nothing to do for {appid}.").format(appid=appid))
             continue
+        todo.append(appid)
 
-        msg = _("Processing {appid}").format(appid=appid)
-        logging.info(msg)
-
-        try:
-            checkupdates_app(app)
-            processed.append(appid)
-        except Exception as e:
-            msg = _("...checkupdate failed for {appid} : {error}").format(appid=appid, error=e)
-            logging.error(msg)
-            logging.debug(traceback.format_exc())
-            failed[appid] = str(e)
-            exit_code = 1
+    results = dict()
+    failed = dict()
+    exit_code = 0
+    jobs = max(1, options.jobs)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(_process_app, apps[appid]): appid for appid in todo}
+        for future in concurrent.futures.as_completed(futures):
+            appid = futures[future]
+            try:
+                future.result()
+                results[appid] = True
+            except Exception as e:
+                msg = _("...checkupdate failed for {appid} : {error}").format(appid=appid, error=e)
+                logging.error(msg)
+                logging.debug(traceback.format_exc())
+                failed[appid] = str(e)
+                exit_code = 1
+    processed = [appid for appid in todo if appid in results]
 
     status_update_json(processed, failed)
     sys.exit(exit_code)
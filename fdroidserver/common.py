@@ -31,9 +31,11 @@
 import git
 import io
 import os
+import errno
 import sys
 import re
 import ast
+import selectors
 import gzip
 import shutil
 import glob
@@ -51,6 +53,8 @@ import yaml
 import zipfile
 import tempfile
 import json
+import threading
+import contextlib
 from pathlib import Path
 
 # TODO change to only import defusedxml once its installed everywhere
@@ -63,7 +67,6 @@ from base64 import urlsafe_b64encode
 from binascii import hexlify
 from datetime import datetime, timedelta, timezone
 from distutils.version import LooseVersion
-from queue import Queue
 from zipfile import ZipFile
 
 from pyasn1.codec.der import decoder, encoder
@@ -76,9 +79,13 @@ import fdroidserver.lint
 from fdroidserver import _
 from fdroidserver.exception import FDroidException, VCSException, NoSubmodulesException,\
     BuildException, VerificationException, MetaDataException
-from .asynchronousfilereader import AsynchronousFileReader
 
-from . import apksigcopier
+from . import apksigcopier, apksign, apksigverify
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # not available on Windows
 
 
 # The path to this fdroidserver distribution
@@ -111,6 +118,9 @@ MAX_VERSION_CODE = 0x7fffffff  # Java's Integer.MAX_VALUE (2147483647)
 
 XMLNS_ANDROID = '{http://schemas.android.com/apk/res/android}'
 
+# from linux/fs.h: _IOW(0x94, 9, int), clone a file on a copy-on-write filesystem
+FICLONE = 0x40049409
+
 # https://docs.gitlab.com/ee/user/gitlab_com/#gitlab-pages
 GITLAB_COM_PAGES_MAX_SIZE = 1000000000
 
@@ -119,6 +129,8 @@ config = None
 options = None
 env = None
 orig_path = None
+# the mavencache.MavenCache that builds get their Maven artifacts from, if any
+maven_cache = None
 
 
 default_config = {
@@ -131,8 +143,11 @@ default_config = {
     'mvn3': "mvn",
     'gradle': os.path.join(FDROID_PATH, 'gradlew-fdroid'),
     'gradle_version_dir': str(Path.home() / '.cache/fdroidserver/gradle'),
+    'git_cache_dir': None,
     'sync_from_local_copy_dir': False,
     'allow_disabled_algorithms': False,
+    'apk_signature_verifier': 'apksigner',
+    'apk_signer': 'apksigner',
     'per_app_repos': False,
     'make_current_version_link': False,
     'current_version_name_source': 'Name',
@@ -143,7 +158,15 @@ default_config = {
     'stats_user': None,
     'stats_to_carbon': False,
     'repo_maxage': 0,
+    'index_diffs': 0,
+    'index_shards': False,
+    'index_compression': ['gz'],
     'build_server_always': False,
+    'build_vm_pool_size': 0,
+    'build_cache': None,
+    'build_min_free_memory': '4GiB',
+    'build_min_free_disk': '20GiB',
+    'maven_cache': None,
     'keystore': 'keystore.p12',
     'smartcardoptions': [],
     'char_limits': {
@@ -984,7 +1007,7 @@ class vcs:
     def clientversioncmd(self):
         return None
 
-    def gotorevision(self, rev, refresh=True):
+    def gotorevision(self, rev, refresh=True, checkout=True):
         """Take the local repository to a clean version of the given revision.
 
         Take the local repository to a clean version of the given
@@ -995,6 +1018,10 @@ class vcs:
         of the vcs object.  None is acceptable for 'rev' if you know
         you are cloning a clean copy of the repo - otherwise it must
         specify a valid revision.
+
+        With checkout=False, the repository is only cloned or updated,
+        for reading files straight from the VCS, e.g. with exportfiles().
+        VCS types that cannot do that still check out the revision.
         """
         if self.clone_failed:
             raise VCSException(_("Downloading the repository already failed once, not trying again."))
@@ -1030,7 +1057,10 @@ class vcs:
             self.refreshed = True
 
         try:
-            self.gotorevisionx(rev)
+            if checkout:
+                self.gotorevisionx(rev)
+            else:
+                self.fetchx()
         except FDroidException as e:
             exc = e
 
@@ -1052,6 +1082,28 @@ class vcs:
         """
         raise VCSException("This VCS type doesn't define gotorevisionx")
 
+    def fetchx(self):
+        """Clone or update the local repository, without a specific checkout.
+
+        Derived classes can implement this when they can read files
+        without checking them out, by default the latest revision is
+        checked out.
+        """
+        self.gotorevisionx(None)
+
+    def exportfiles(self, rev, dest, match):  # pylint: disable=unused-argument
+        """Write the files of a revision for which match(path) is True into dest."""
+        raise VCSException('exportfiles not supported for this vcs type')
+
+    def remoterefs(self):
+        """Get the refs of the remote repository, without fetching anything.
+
+        Returns
+        -------
+        dict of ref name -> commit ID, or None if this VCS cannot list them
+        """
+        return None
+
     # Initialise and update submodules
     def initsubmodules(self):
         raise VCSException('Submodules not supported for this vcs type')
@@ -1079,6 +1131,29 @@ class vcs:
         return self.srclib
 
 
+# The bare mirrors in the git object cache are shared by all checkouts of
+# the same remote, and by all threads and processes, so each is guarded by
+# a lock, and only refreshed once per run.
+_git_cache_locks = dict()
+_git_cache_lock = threading.Lock()
+_git_cache_refreshed = set()
+
+
+def dissociate_git_objects(path):
+    """Copy the objects borrowed from the git object cache into the repo at path.
+
+    This makes the repo self-contained, e.g. before it is copied to
+    another machine, like `git clone --dissociate` does.
+    """
+    alternates = os.path.join(path, '.git', 'objects', 'info', 'alternates')
+    if not os.path.exists(alternates):
+        return
+    p = FDroidPopen(['git', 'repack', '-a', '-d', '-q'], cwd=path, output=False)
+    if p.returncode != 0:
+        raise VCSException(_("Git repack failed"), p.output)
+    os.remove(alternates)
+
+
 class vcs_git(vcs):
 
     def repotype(self):
@@ -1087,7 +1162,7 @@ class vcs_git(vcs):
     def clientversioncmd(self):
         return ['git', '--version']
 
-    def git(self, args, envs=dict(), cwd=None, output=True):
+    def git(self, args, envs=dict(), cwd=None, output=True, stdin=None, binary=False):
         """Prevent git fetch/clone/submodule from hanging at the username/password prompt.
 
         While fetch/pull/clone respect the command line option flags,
@@ -1097,6 +1172,9 @@ class vcs_git(vcs):
         sticks.
 
         Also, because of CVE-2017-1000117, block all SSH URLs.
+
+        With binary, the output is the raw bytes of stdout only, for
+        commands like `git cat-file` that output file contents.
         """
         #
         # supported in git >= 2.3
@@ -1118,8 +1196,9 @@ class vcs_git(vcs):
             'SSH_ASKPASS': '/bin/true',
             'GIT_SSH': '/bin/false',  # for git < 2.3
         })
-        return FDroidPopen(['git', ] + git_config + args,
-                           envs=envs, cwd=cwd, output=output)
+        popen = FDroidPopenBytes if binary else FDroidPopen
+        return popen(['git', ] + git_config + args, envs=envs, cwd=cwd,
+                     output=output, stderr_to_stdout=not binary, stdin=stdin)
 
     def checkrepo(self):
         """No summary.
@@ -1135,14 +1214,81 @@ class vcs_git(vcs):
         if Path(result) != Path(self.local).resolve():
             raise VCSException('Repository mismatch')
 
-    def gotorevisionx(self, rev):
+    def object_cache_path(self):
+        """Get the path of the shared bare mirror of the remote, or None if disabled."""
+        cachedir = (config or {}).get('git_cache_dir')
+        if not cachedir:
+            return None
+        name = hashlib.sha256(self.remote.encode()).hexdigest() + '.git'
+        return os.path.join(os.path.expanduser(cachedir), name)
+
+    def update_object_cache(self):
+        """Create or refresh the shared bare mirror of the remote.
+
+        Checkouts borrow the objects from the mirror through git
+        alternates, so each remote is only downloaded once, no matter
+        how many apps, srclibs and tools use it.  The mirror never runs
+        gc, so objects that checkouts rely on are never removed.
+
+        Returns
+        -------
+        the path to the mirror, or None if it could not be created
+        """
+        mirror = self.object_cache_path()
+        if not mirror:
+            return None
+        with _git_cache_lock:
+            lock = _git_cache_locks.setdefault(mirror, threading.Lock())
+        with lock:
+            if mirror in _git_cache_refreshed:
+                return mirror if os.path.isdir(mirror) else None
+            _git_cache_refreshed.add(mirror)
+            os.makedirs(os.path.dirname(mirror), exist_ok=True)
+            with open(mirror + '.lock', 'w') as lockfile:
+                if fcntl is not None:
+                    fcntl.flock(lockfile, fcntl.LOCK_EX)
+                if os.path.isdir(mirror):
+                    p = self.git(['fetch', '--prune', '--quiet', 'origin'], cwd=mirror, output=False)
+                    if p.returncode != 0:
+                        logging.warning(_("Git cache update failed for {remote}")
+                                        .format(remote=self.remote))
+                    return mirror
+                tmp = mirror + '.tmp'
+                if os.path.exists(tmp):
+                    shutil.rmtree(tmp)
+                p = self.git(['clone', '--mirror', '--quiet', '--', self.remote, tmp], output=False)
+                if p.returncode != 0:
+                    shutil.rmtree(tmp, ignore_errors=True)
+                    logging.warning(_("Git cache clone failed for {remote}")
+                                    .format(remote=self.remote))
+                    return None
+                FDroidPopen(['git', 'config', 'gc.auto', '0'], cwd=tmp, output=False)
+                os.rename(tmp, mirror)
+                return mirror
+
+    def uses_object_cache(self):
+        """Whether the local repo borrows objects from the shared mirror."""
+        mirror = self.object_cache_path()
+        alternates = os.path.join(self.local, '.git', 'objects', 'info', 'alternates')
+        if not mirror or not os.path.exists(alternates):
+            return False
+        with open(alternates) as fp:
+            paths = [os.path.realpath(line.strip()) for line in fp]
+        return os.path.realpath(os.path.join(mirror, 'objects')) in paths
+
+    def fetchx(self):
         if not os.path.exists(self.local):
-            # Brand new checkout
-            p = self.git(['clone', '--', self.remote, str(self.local)])
+            # Brand new checkout, borrowing the objects from the cache
+            args = ['clone']
+            mirror = self.update_object_cache()
+            if mirror:
+                args += ['--reference', mirror]
+            p = self.git(args + ['--', self.remote, str(self.local)])
             if p.returncode != 0:
                 self.clone_failed = True
                 raise VCSException("Git clone failed", p.output)
             self.checkrepo()
+            self.refreshed = True
         else:
             self.checkrepo()
             # Discard any working tree changes
@@ -1163,6 +1309,8 @@ class vcs_git(vcs):
             if p.returncode != 0:
                 raise VCSException(_("Git clean failed"), p.output)
             if not self.refreshed:
+                if self.uses_object_cache():
+                    self.update_object_cache()
                 # Get latest commits and tags from remote
                 p = self.git(['fetch', 'origin'], cwd=self.local)
                 if p.returncode != 0:
@@ -1187,6 +1335,9 @@ class vcs_git(vcs):
                             logging.warning(_("Git remote set-head failed: \"%s\"")
                                             % p.output.strip() + '\n' + p2.output.strip())
                 self.refreshed = True
+
+    def gotorevisionx(self, rev):
+        self.fetchx()
         # origin/HEAD is the HEAD of the remote, e.g. the "default branch" on
         # a github repo. Most of the time this is the same as origin/master.
         rev = rev or 'origin/HEAD'
@@ -1198,6 +1349,70 @@ class vcs_git(vcs):
         if p.returncode != 0:
             raise VCSException(_("Git clean failed"), p.output)
 
+    def remoterefs(self):
+        """Get the branches and tags of the remote with a single `git ls-remote`."""
+        p = self.git(['ls-remote', '--', self.remote], output=False)
+        if p.returncode != 0:
+            raise VCSException(_("Git ls-remote failed"), p.output)
+        refs = dict()
+        for line in p.output.splitlines():
+            m = re.match(r'([0-9a-f]{40,64})\t(\S+)$', line)
+            if m:
+                refs[m.group(2)] = m.group(1)
+        return refs
+
+    def exportfiles(self, rev, dest, match):
+        """Write the files of rev for which match(path) is True into dest.
+
+        The files are read straight from the git objects with a single
+        `git cat-file --batch`, so the working tree and the index are
+        left alone.  Submodules and symlinks are skipped.
+
+        Returns
+        -------
+        list of the paths that were written, relative to dest
+        """
+        self.checkrepo()
+        rev = rev or 'origin/HEAD'
+        for treeish in (rev, 'origin/' + rev):
+            # like git checkout, also find remote branches by their name
+            p = self.git(['ls-tree', '-r', '-z', '--full-tree', treeish, '--'],
+                         cwd=self.local, output=False, binary=True)
+            if p.returncode == 0:
+                break
+        if p.returncode != 0:
+            raise VCSException(_("Git ls-tree of '%s' failed") % rev)
+        objects = []
+        for entry in p.output.split(b'\0'):
+            if not entry:
+                continue
+            info, path = entry.split(b'\t', 1)
+            mode, objtype, sha = info.split(b' ')
+            path = path.decode('utf-8', errors='surrogateescape')
+            if objtype == b'blob' and mode != b'120000' and match(path):
+                objects.append((sha, path))
+        if not objects:
+            return []
+
+        with tempfile.TemporaryFile() as fp:
+            fp.write(b''.join(sha + b'\n' for sha, _path in objects))
+            fp.seek(0)
+            p = self.git(['cat-file', '--batch'], cwd=self.local, output=False,
+                         stdin=fp, binary=True)
+        if p.returncode != 0:
+            raise VCSException(_("Git cat-file of '%s' failed") % rev)
+        stdout = p.output
+        pos = 0
+        for _sha, path in objects:
+            end = stdout.index(b'\n', pos)
+            size = int(stdout[pos:end].split(b' ')[2])
+            target = os.path.join(dest, path)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, 'wb') as fp:
+                fp.write(stdout[end + 1:end + 1 + size])
+            pos = end + 1 + size + 1
+        return [path for _sha, path in objects]
+
     def initsubmodules(self):
         self.checkrepo()
         submfile = os.path.join(self.local, '.gitmodules')
@@ -2741,10 +2956,40 @@ def get_native_code(apkfile):
     return sorted(list(archset))
 
 
+# command output up to this size is kept in memory, the rest goes to a temp file
+POPEN_OUTPUT_MEMORY_LIMIT = 8 * 1024 * 1024
+
+
 class PopenResult:
-    def __init__(self):
+    """The exit code and output of a command run with FDroidPopen().
+
+    The output can be kept in a file, which is only read when the output
+    is used.  If encoding is set, the output is decoded as str.
+    """
+
+    def __init__(self, output_file=None, encoding=None):
         self.returncode = None
-        self.output = None
+        self.encoding = encoding
+        self._output = None
+        self._output_file = output_file
+
+    @property
+    def output(self):
+        if self._output_file is not None:
+            self._output_file.seek(0)
+            self._output = self._output_file.read()
+            self._output_file.close()
+            self._output_file = None
+        if self.encoding and isinstance(self._output, bytes):
+            self._output = self._output.decode(self.encoding, 'ignore')
+        return self._output
+
+    @output.setter
+    def output(self, output):
+        if self._output_file is not None:
+            self._output_file.close()
+            self._output_file = None
+        self._output = output
 
 
 def SdkToolsPopen(commands, cwd=None, output=True):
@@ -2760,7 +3005,8 @@ def SdkToolsPopen(commands, cwd=None, output=True):
                        cwd=cwd, output=output)
 
 
-def FDroidPopenBytes(commands, cwd=None, envs=None, output=True, stderr_to_stdout=True):
+def FDroidPopenBytes(commands, cwd=None, envs=None, output=True, stderr_to_stdout=True,
+                     stdin=None):
     """
     Run a command and capture the possibly huge output as bytes.
 
@@ -2772,6 +3018,8 @@ def FDroidPopenBytes(commands, cwd=None, envs=None, output=True, stderr_to_stdou
         optionally specifies a working directory
     envs
         a optional dictionary of environment variables and their values
+    stdin
+        an optional file that the command reads its input from
 
     Returns
     -------
@@ -2791,51 +3039,51 @@ def FDroidPopenBytes(commands, cwd=None, envs=None, output=True, stderr_to_stdou
     logging.debug("> %s" % ' '.join(commands))
 
     stderr_param = subprocess.STDOUT if stderr_to_stdout else subprocess.PIPE
-    result = PopenResult()
     p = None
     try:
         cmd   = commands[0]
         shell = cmd.endswith('.cmd') or cmd.endswith('.bat')
 
         p = subprocess.Popen(commands, cwd=cwd, shell=shell, env=process_env,
-                             stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                             stdin=subprocess.DEVNULL if stdin is None else stdin,
+                             stdout=subprocess.PIPE,
                              stderr=stderr_param)
     except OSError as e:
         raise BuildException("OSError while trying to execute "
                              + ' '.join(commands) + ': ' + str(e))
 
-    # TODO are these AsynchronousFileReader threads always exiting?
-    if not stderr_to_stdout and options.verbose:
-        stderr_queue = Queue()
-        stderr_reader = AsynchronousFileReader(p.stderr, stderr_queue)
-
-        while not stderr_reader.eof():
-            while not stderr_queue.empty():
-                line = stderr_queue.get()
-                sys.stderr.buffer.write(line)
-                sys.stderr.flush()
-
-            time.sleep(0.1)
-
-    stdout_queue = Queue()
-    stdout_reader = AsynchronousFileReader(p.stdout, stdout_queue)
-    buf = io.BytesIO()
-
-    # Check the queue for output (until there is no more to get)
-    while not stdout_reader.eof():
-        while not stdout_queue.empty():
-            line = stdout_queue.get()
-            if output and options.verbose:
-                # Output directly to console
-                sys.stderr.buffer.write(line)
-                sys.stderr.flush()
-            buf.write(line)
-
-        time.sleep(0.1)
-
+    # the output can be huge, e.g. from gradle, so it goes to disk beyond a limit
+    buf = tempfile.SpooledTemporaryFile(max_size=POPEN_OUTPUT_MEMORY_LIMIT)
+    if os.name == 'nt':
+        # select() does not work on pipes on Windows
+        stdout, _stderr = p.communicate()
+        if output and options.verbose:
+            sys.stderr.buffer.write(stdout)
+            sys.stderr.flush()
+        buf.write(stdout)
+    else:
+        with selectors.DefaultSelector() as selector:
+            selector.register(p.stdout, selectors.EVENT_READ)
+            if not stderr_to_stdout:
+                selector.register(p.stderr, selectors.EVENT_READ)
+            # wake up whenever there is output, until the command closes its end
+            while selector.get_map():
+                for key, _events in selector.select():
+                    data = os.read(key.fd, 65536)
+                    if not data:
+                        selector.unregister(key.fileobj)
+                    elif key.fileobj is p.stdout:
+                        if output and options.verbose:
+                            # Output directly to console
+                            sys.stderr.buffer.write(data)
+                            sys.stderr.flush()
+                        buf.write(data)
+                    elif options.verbose:
+                        sys.stderr.buffer.write(data)
+                        sys.stderr.flush()
+
+    result = PopenResult(output_file=buf)
     result.returncode = p.wait()
-    result.output = buf.getvalue()
-    buf.close()
     # make sure all filestreams of the subprocess are closed
     for streamvar in ['stdin', 'stdout', 'stderr']:
         if hasattr(p, streamvar):
@@ -2845,7 +3093,8 @@ def FDroidPopenBytes(commands, cwd=None, envs=None, output=True, stderr_to_stdou
     return result
 
 
-def FDroidPopen(commands, cwd=None, envs=None, output=True, stderr_to_stdout=True):
+def FDroidPopen(commands, cwd=None, envs=None, output=True, stderr_to_stdout=True,
+                stdin=None):
     """
     Run a command and capture the possibly huge output as a str.
 
@@ -2857,13 +3106,15 @@ def FDroidPopen(commands, cwd=None, envs=None, output=True, stderr_to_stdout=Tru
         optionally specifies a working directory
     envs
         a optional dictionary of environment variables and their values
+    stdin
+        an optional file that the command reads its input from
 
     Returns
     -------
     A PopenResult.
     """
-    result = FDroidPopenBytes(commands, cwd, envs, output, stderr_to_stdout)
-    result.output = result.output.decode('utf-8', 'ignore')
+    result = FDroidPopenBytes(commands, cwd, envs, output, stderr_to_stdout, stdin)
+    result.encoding = 'utf-8'
     return result
 
 
@@ -2986,6 +3237,9 @@ def set_FDroidPopen_env(build=None):
         for n in ['ANDROID_NDK', 'NDK', 'ANDROID_NDK_HOME']:
             env[n] = build.ndk_path()
 
+    if maven_cache is not None:
+        env['FDROID_MAVEN_MIRROR'] = maven_cache.url
+
 
 def replace_build_vars(cmd, build):
     cmd = cmd.replace('$$COMMIT$$', build.commit)
@@ -3417,14 +3671,154 @@ def sign_apk(unsigned_path, signed_path, keyalias):
     cmd += ['--ks-key-alias', keyalias,
             '--in', unsigned_path,
             '--out', signed_path]
-    p = FDroidPopen(cmd, envs={
-        'FDROID_KEY_STORE_PASS': config['keystorepass'],
-        'FDROID_KEY_PASS': config.get('keypass', "")})
+    with keystore_lock.read():
+        p = FDroidPopen(cmd, envs={
+            'FDROID_KEY_STORE_PASS': config['keystorepass'],
+            'FDROID_KEY_PASS': config.get('keypass', "")})
     if p.returncode != 0:
         raise BuildException(_("Failed to sign application"), p.output)
     os.remove(unsigned_path)
 
 
+class ReadWriteLock:
+    """A lock that many threads can hold for reading, or one for writing.
+
+    Writers are preferred, so a steady stream of readers cannot keep a
+    writer waiting forever.  It is not reentrant.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+
+    @contextlib.contextmanager
+    def read(self):
+        with self._cond:
+            while self._writer or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def write(self):
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+
+# APKs are signed in parallel, which only reads the keystore, but
+# keytool must have it to itself to add keys to it
+keystore_lock = ReadWriteLock()
+
+_signing_keys_cache = dict()
+
+
+def _load_signing_keys():
+    """Load all the keys from the keystore for signing in-process.
+
+    This is only done when apk_signer is set to native.  The keys are
+    kept until the keystore file changes, e.g. when a new key is added
+    to it.
+
+    Returns
+    -------
+    dict of alias -> (key, certificate), or None if apksigner is needed
+    """
+    keystore = config.get('keystore')
+    if config.get('apk_signer', 'apksigner') != 'native' or keystore in (None, 'NONE'):
+        return None
+    with keystore_lock.read():
+        try:
+            cache_key = (os.path.realpath(keystore), os.path.getmtime(keystore))
+        except OSError:
+            return None
+        if cache_key in _signing_keys_cache:
+            return _signing_keys_cache[cache_key]
+    with keystore_lock.write():
+        # check again, another thread might have loaded it meanwhile
+        try:
+            cache_key = (os.path.realpath(keystore), os.path.getmtime(keystore))
+        except OSError:
+            return None
+        if cache_key not in _signing_keys_cache:
+            try:
+                keys = apksign.load_pkcs12_keys(
+                    keystore, config['keystorepass'], config.get('keypass')
+                )
+            except apksign.UnsupportedKeystore as e:
+                # not cached, so it is tried again after e.g. a new key
+                logging.debug(_('Using apksigner for signing: {error}').format(error=e))
+                return None
+            _signing_keys_cache.clear()
+            _signing_keys_cache[cache_key] = keys
+        return _signing_keys_cache[cache_key]
+
+
+def sign_apks(apks):
+    """Sign and zipalign a batch of unsigned APKs, deleting the unsigned ones.
+
+    With apk_signer set to native, the keystore is only opened once
+    for the whole batch, then RSA keys from PKCS#12 keystores are used
+    in-process.  When apksigner is installed, it checks each APK
+    signed in-process, and signs it itself if that check fails.
+    Otherwise, and for everything else like smartcards, JKS keystores
+    or other key types, apksigner is run for each APK via sign_apk().
+
+    Parameters
+    ----------
+    apks
+        list of (unsigned_path, signed_path, keyalias)
+
+    Returns
+    -------
+    dict of unsigned_path -> FDroidException for each APK that failed
+    """
+    keys = _load_signing_keys() or dict()
+    failed = dict()
+    for unsigned_path, signed_path, keyalias in apks:
+        try:
+            if keyalias in keys:
+                key, cert = keys[keyalias]
+                try:
+                    apk = _get_androguard_APK(unsigned_path)
+                    min_sdk_version = get_min_sdk_version(apk)
+                    apksign.sign_apk(unsigned_path, signed_path, key, cert, keyalias,
+                                     min_sdk_version)
+                    if (set_command_in_config('apksigner')
+                            and not _verify_apk_signature_apksigner(signed_path,
+                                                                    str(min_sdk_version))):
+                        os.remove(signed_path)
+                        raise FDroidException(_('apksigner cannot verify the signature'))
+                    os.remove(unsigned_path)
+                    continue
+                except (apksigcopier.APKSigCopierError, zipfile.BadZipFile,
+                        ValueError, FDroidException) as e:
+                    logging.warning(_('Signing {apk} in-process failed, using '
+                                      'apksigner: {error}')
+                                    .format(apk=unsigned_path, error=e))
+            sign_apk(unsigned_path, signed_path, keyalias)
+        except FDroidException as e:
+            failed[unsigned_path] = e
+    return failed
+
+
 def verify_apks(signed_apk, unsigned_apk, tmp_dir, v1_only=None):
     """Verify that two apks are the same.
 
@@ -3498,7 +3892,8 @@ def verify_deprecated_jar_signature(jar):
 
     Just to be safe, this never reuses the file, and locks down the
     file permissions while in use.  That should prevent a bad actor
-    from changing the settings during operation.
+    from changing the settings during operation.  Each call has its own
+    file, since JARs are verified in parallel.
 
     Raises
     ------
@@ -3507,14 +3902,11 @@ def verify_deprecated_jar_signature(jar):
 
     """
     error = _('JAR signature failed to verify: {path}').format(path=jar)
-    _java_security = os.path.join(os.getcwd(), '.java.security')
-    if os.path.exists(_java_security):
-        os.remove(_java_security)
-    with open(_java_security, 'w') as fp:
-        fp.write('jdk.jar.disabledAlgorithms=MD2, RSA keySize < 1024')
-    os.chmod(_java_security, 0o400)
-
+    fd, _java_security = tempfile.mkstemp(prefix='.java.security.')
     try:
+        with os.fdopen(fd, 'w') as fp:
+            fp.write('jdk.jar.disabledAlgorithms=MD2, RSA keySize < 1024')
+        os.chmod(_java_security, 0o400)
         cmd = [
             config['jarsigner'],
             '-J-Djava.security.properties=' + _java_security,
@@ -3533,9 +3925,69 @@ def verify_deprecated_jar_signature(jar):
             os.remove(_java_security)
 
 
+# (APK SHA-256, min_sdk_version) -> whether the signature verified
+_apk_signature_cache = dict()
+
+
 def verify_apk_signature(apk, min_sdk_version=None):
     """Verify the signature on an APK.
 
+    The signatures are verified with apksigner, unless the
+    apk_signature_verifier config option is set to native, then they
+    are verified in-process whenever possible, see
+    fdroidserver.apksigverify, or crosscheck to run both.  Results are
+    cached by the SHA-256 of the APK and min_sdk_version, since they
+    can only change with the file.
+
+    Returns
+    -------
+    Boolean
+        whether the APK was verified
+    """
+    key = (sha256sum(apk), min_sdk_version)
+    if key not in _apk_signature_cache:
+        _apk_signature_cache[key] = _verify_apk_signature(apk, min_sdk_version)
+    return _apk_signature_cache[key]
+
+
+def _verify_apk_signature(apk, min_sdk_version):
+    verifier = config.get('apk_signature_verifier', 'apksigner')
+    if verifier not in ('native', 'apksigner', 'crosscheck'):
+        raise FDroidException(
+            _('Unknown apk_signature_verifier: {verifier}').format(verifier=verifier)
+        )
+    result = None
+    error = None
+    if verifier != 'apksigner':
+        try:
+            if min_sdk_version:
+                sdk = int(min_sdk_version)
+            else:
+                sdk = get_min_sdk_version(_get_androguard_APK(apk))
+            result = apksigverify.verify_apk_signature(apk, sdk)
+        except VerificationException as e:
+            result = False
+            error = e
+        except Exception as e:
+            logging.debug(_('Cannot verify {path} in-process: {error}').format(path=apk, error=e))
+    if verifier == 'native' and result is not None:
+        if error:
+            logging.error('\n' + apk + ': ' + str(error))
+        return result
+
+    expected = _verify_apk_signature_apksigner(apk, min_sdk_version)
+    if result is not None and result != expected:
+        logging.warning(
+            _('In-process APK signature verification of {path} disagrees with apksigner: {result}').format(
+                path=apk, result=error or result
+            )
+        )
+    return expected
+
+
+def _verify_apk_signature_apksigner(apk, min_sdk_version=None):
+    """Verify the signature on an APK with apksigner.
+
     Try to use apksigner whenever possible since jarsigner is very
     shitty: unsigned APKs pass as "verified"!  Warning, this does
     not work on JARs with apksigner >= 0.7 (build-tools 26.0.1)
@@ -3576,6 +4028,11 @@ apk_badchars = re.compile('''[/ :;'"]''')
 def compare_apks(apk1, apk2, tmp_dir, log_dir=None):
     """Compare two apks.
 
+    The ZIP entries are compared first with compare_apk_entries(), the
+    APKs are only unpacked and run through diffoscope, apktool and
+    diff when they differ.  The report of differing entries is written
+    to log_dir as JSON.
+
     Returns
     -------
     None if the APK content is the same (apart from the signing key),
@@ -3587,9 +4044,19 @@ def compare_apks(apk1, apk2, tmp_dir, log_dir=None):
 
     absapk1 = os.path.abspath(apk1)
     absapk2 = os.path.abspath(apk2)
+    logfilename = os.path.join(log_dir, os.path.basename(absapk1))
+
+    # only unpack and run the slow tools when there is something to see
+    try:
+        report = compare_apk_entries(absapk1, absapk2)
+    except (zipfile.BadZipFile, OSError) as e:
+        return 'Failed to compare {0} and {1}: {2}'.format(apk1, apk2, e)
+    if not report:
+        return None
+    with open(logfilename + '.entries.json', 'w') as fp:
+        json.dump(report, fp, indent=2, sort_keys=True)
 
     if set_command_in_config('diffoscope'):
-        logfilename = os.path.join(log_dir, os.path.basename(absapk1))
         htmlfile = logfilename + '.diffoscope.html'
         textfile = logfilename + '.diffoscope.txt'
         if subprocess.call([config['diffoscope'],
@@ -3631,8 +4098,65 @@ def compare_apks(apk1, apk2, tmp_dir, log_dir=None):
     shutil.rmtree(apk1dir)
     shutil.rmtree(apk2dir)
 
-    # If we get here, it seems like they're the same!
-    return None
+    return 'APK entries differ: ' + json.dumps(report, sort_keys=True)
+
+
+def compare_apk_entries(apk1, apk2):
+    """Compare the entries of two APKs without extracting them.
+
+    Entries are matched by name and compared by the CRC-32 and the
+    size recorded in the ZIP central directories.  Only the entries
+    where those differ are read, to find the first differing byte.
+    JAR signature files are ignored, like the APK Signing Block.
+
+    Returns
+    -------
+    dict
+        the entries that are only in apk1, only in apk2, or differ,
+        only the keys with entries are set, so it is empty if the
+        contents match.
+    """
+    report = dict()
+    with ZipFile(apk1) as zip1, ZipFile(apk2) as zip2:
+        infos1 = {i.filename: i for i in zip1.infolist() if not apksigcopier.is_meta(i.filename)}
+        infos2 = {i.filename: i for i in zip2.infolist() if not apksigcopier.is_meta(i.filename)}
+        only1 = sorted(set(infos1) - set(infos2))
+        only2 = sorted(set(infos2) - set(infos1))
+        if only1:
+            report['only_in_apk1'] = only1
+        if only2:
+            report['only_in_apk2'] = only2
+        differ = []
+        for name in sorted(set(infos1) & set(infos2)):
+            info1 = infos1[name]
+            info2 = infos2[name]
+            if info1.CRC == info2.CRC and info1.file_size == info2.file_size:
+                continue
+            entry = {
+                'name': name,
+                'crc': ['%08x' % info1.CRC, '%08x' % info2.CRC],
+                'size': [info1.file_size, info2.file_size],
+                'offset': None,
+            }
+            offset = 0
+            with zip1.open(info1) as fp1, zip2.open(info2) as fp2:
+                while True:
+                    chunk1 = fp1.read(65536)
+                    chunk2 = fp2.read(65536)
+                    if chunk1 != chunk2:
+                        length = min(len(chunk1), len(chunk2))
+                        i = 0
+                        while i < length and chunk1[i] == chunk2[i]:
+                            i += 1
+                        entry['offset'] = offset + i
+                        break
+                    if not chunk1:
+                        break
+                    offset += len(chunk1)
+            differ.append(entry)
+        if differ:
+            report['differ'] = differ
+    return report
 
 
 def set_command_in_config(command):
@@ -3932,6 +4456,117 @@ def get_app_display_name(app):
     return app.get('AutoName') or app['id']
 
 
+def _clone_or_copy_file(src, dst):
+    """Copy the contents of src into the new file dst.
+
+    This first tries a copy-on-write clone (btrfs, XFS, etc.), then
+    lets the kernel copy the data with copy_file_range(), and finally
+    falls back to a plain streaming copy.
+
+    Returns
+    -------
+    The number of bytes that had to be copied, 0 if the file was cloned.
+    """
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        if fcntl is not None:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                return 0
+            except OSError:
+                pass
+        size = os.fstat(fsrc.fileno()).st_size
+        copied = 0
+        if hasattr(os, 'copy_file_range'):
+            try:
+                while copied < size:
+                    n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), size - copied)
+                    if n == 0:
+                        break
+                    copied += n
+            except OSError:
+                copied = 0
+            if copied == size:
+                return copied
+            # some filesystems copy nothing instead of failing, so
+            # stream the rest from wherever copy_file_range() stopped
+            fsrc.seek(copied)
+            fdst.seek(copied)
+            fdst.truncate()
+        while True:
+            buf = fsrc.read(1024 * 1024)
+            if not buf:
+                break
+            fdst.write(buf)
+            copied += len(buf)
+        return copied
+
+
+def place_file(src, dst, move=False, hardlink=True):
+    """Put the file src at dst, copying the actual data only as a last resort.
+
+    When moving, this is a rename if both are on the same filesystem.
+    Otherwise, a hardlink is made if allowed, then a copy-on-write
+    clone is tried before falling back to copying the bytes.  Only use
+    hardlinks for files that are never modified in place, like APKs,
+    signatures and source tarballs.  If dst is already the same file
+    as src, nothing is done.  dst is replaced atomically.
+
+    Parameters
+    ----------
+    src
+        path to the source file
+    dst
+        path to the destination file, or the directory to put it in
+    move
+        remove src once it is in place
+    hardlink
+        allow dst to be a hardlink to src
+
+    Returns
+    -------
+    The number of bytes that actually had to be copied.
+    """
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        if move and os.path.abspath(src) != os.path.abspath(dst):
+            os.remove(src)
+        return 0
+    if move:
+        try:
+            os.replace(src, dst)
+            return 0
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+
+    tmp = os.path.join(os.path.dirname(dst), '.' + os.path.basename(dst) + '.tmp')
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    copied = 0
+    try:
+        if os.path.islink(src) and not move:
+            os.symlink(os.readlink(src), tmp)
+        else:
+            linked = False
+            if hardlink:
+                try:
+                    os.link(src, tmp)
+                    linked = True
+                except OSError as e:
+                    logging.debug('Cannot hardlink %s: %s' % (src, e))
+            if not linked:
+                copied = _clone_or_copy_file(src, tmp)
+                shutil.copystat(src, tmp)
+        os.replace(tmp, dst)
+    finally:
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+    if move:
+        os.remove(src)
+    return copied
+
+
 def local_rsync(options, fromdir, todir):
     """Rsync method for local to local copying of things.
 
@@ -4048,12 +4683,15 @@ def is_repo_file(filename):
     """Whether the file in a repo is a build product to be delivered to users."""
     if isinstance(filename, str):
         filename = filename.encode('utf-8', errors="surrogateescape")
+    name = os.path.basename(filename)
+    if name.endswith((b'.gz', b'.br', b'.zst')):
+        name = name.rsplit(b'.', 1)[0]  # precompressed index variants
     return os.path.isfile(filename) \
         and not filename.endswith(b'.asc') \
         and not filename.endswith(b'.sig') \
         and not filename.endswith(b'.idsig') \
         and not filename.endswith(b'.log.gz') \
-        and os.path.basename(filename) not in [
+        and name not in [
             b'index.css',
             b'index.jar',
             b'index_unsigned.jar',
@@ -4062,6 +4700,8 @@ def is_repo_file(filename):
             b'index.png',
             b'index-v1.jar',
             b'index-v1.json',
+            b'entry-v1.jar',
+            b'entry-v1.json',
             b'categories.txt',
         ]
 
@@ -63,6 +63,15 @@ def update_awsbucket(repo_section):
         update_awsbucket_libcloud(repo_section)
 
 
+def _get_compressed_index_excludes(repo_section):
+    """Exclude the precompressed index variants, so they are uploaded with the indexes."""
+    excludes = []
+    for f in ('index.xml', 'index-v1.json', 'entry-v1.json'):
+        for ext in index.INDEX_COMPRESSION_EXTENSIONS:
+            excludes += ['--exclude', os.path.join(repo_section, f + '.' + ext)]
+    return excludes
+
+
 def update_awsbucket_s3cmd(repo_section):
     """Upload using the CLI tool s3cmd, which provides rsync-like sync.
 
@@ -109,6 +118,8 @@ def update_awsbucket_s3cmd(repo_section):
     indexv1jar = os.path.join(repo_section, 'index-v1.jar')
     indexv1json = os.path.join(repo_section, 'index-v1.json')
     indexv1jsonasc = os.path.join(repo_section, 'index-v1.json.asc')
+    entryv1jar = os.path.join(repo_section, 'entry-v1.jar')
+    entryv1json = os.path.join(repo_section, 'entry-v1.json')
 
     s3url = s3bucketurl + '/fdroid/'
     logging.debug('s3cmd sync new files in ' + repo_section + ' to ' + s3url)
@@ -120,7 +131,10 @@ def update_awsbucket_s3cmd(repo_section):
                           '--exclude', indexv1jar,
                           '--exclude', indexv1json,
                           '--exclude', indexv1jsonasc,
-                          repo_section, s3url]) != 0:
+                          '--exclude', entryv1jar,
+                          '--exclude', entryv1json]
+                       + _get_compressed_index_excludes(repo_section)
+                       + [repo_section, s3url]) != 0:
         raise FDroidException()
     logging.debug('s3cmd sync all files in ' + repo_section + ' to ' + s3url)
     if subprocess.call(s3cmd_sync
@@ -130,7 +144,10 @@ def update_awsbucket_s3cmd(repo_section):
                           '--exclude', indexv1jar,
                           '--exclude', indexv1json,
                           '--exclude', indexv1jsonasc,
-                          repo_section, s3url]) != 0:
+                          '--exclude', entryv1jar,
+                          '--exclude', entryv1json]
+                       + _get_compressed_index_excludes(repo_section)
+                       + [repo_section, s3url]) != 0:
         raise FDroidException()
 
     logging.debug(_('s3cmd sync indexes {path} to {url} and delete')
@@ -259,6 +276,8 @@ def update_serverwebroot(serverwebroot, repo_section):
     indexv1jar = os.path.join(repo_section, 'index-v1.jar')
     indexv1json = os.path.join(repo_section, 'index-v1.json')
     indexv1jsonasc = os.path.join(repo_section, 'index-v1.json.asc')
+    entryv1jar = os.path.join(repo_section, 'entry-v1.jar')
+    entryv1json = os.path.join(repo_section, 'entry-v1.json')
     # Upload the first time without the index files and delay the deletion as
     # much as possible, that keeps the repo functional while this update is
     # running.  Then once it is complete, rerun the command again to upload
@@ -273,7 +292,10 @@ def update_serverwebroot(serverwebroot, repo_section):
                           '--exclude', indexv1jar,
                           '--exclude', indexv1json,
                           '--exclude', indexv1jsonasc,
-                          repo_section, serverwebroot]) != 0:
+                          '--exclude', entryv1jar,
+                          '--exclude', entryv1json]
+                       + _get_compressed_index_excludes(repo_section)
+                       + [repo_section, serverwebroot]) != 0:
         raise FDroidException()
     if subprocess.call(rsyncargs + [repo_section, serverwebroot]) != 0:
         raise FDroidException()
@@ -21,6 +21,8 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import collections
+import contextlib
+import hashlib
 import json
 import logging
 import os
@@ -29,8 +31,10 @@ import shutil
 import tempfile
 import urllib.parse
 import zipfile
+import zlib
 import calendar
 import qrcode
+import requests
 from binascii import hexlify, unhexlify
 from datetime import datetime, timezone
 from xml.dom.minidom import Document
@@ -40,11 +44,11 @@ from . import common
 from . import metadata
 from . import net
 from . import signindex
-from fdroidserver.common import FDroidPopen, FDroidPopenBytes, load_stats_fdroid_signing_key_fingerprints
+from fdroidserver.common import FDroidPopenBytes, load_stats_fdroid_signing_key_fingerprints
 from fdroidserver.exception import FDroidException, VerificationException
 
 
-def make(apps, apks, repodir, archive):
+def make(apps, apks, repodir, archive, fdroid_signing_key_fingerprints=None):
     """Generate the repo index files.
 
     This requires properly initialized options and config objects.
@@ -61,6 +65,9 @@ def make(apps, apks, repodir, archive):
     archive
       True if this is the archive repo, False if it's the
       main one.
+    fdroid_signing_key_fingerprints
+      the data from load_stats_fdroid_signing_key_fingerprints(), it
+      is loaded here if not given.
     """
     from fdroidserver.update import METADATA_VERSION
 
@@ -130,7 +137,8 @@ def make(apps, apks, repodir, archive):
                 raise TypeError(_('only accepts strings, lists, and tuples'))
         requestsdict[command] = packageNames
 
-    fdroid_signing_key_fingerprints = load_stats_fdroid_signing_key_fingerprints()
+    if fdroid_signing_key_fingerprints is None:
+        fdroid_signing_key_fingerprints = load_stats_fdroid_signing_key_fingerprints()
 
     make_v0(sortedapps, apks, repodir, repodict, requestsdict,
             fdroid_signing_key_fingerprints)
@@ -562,32 +570,351 @@ def make_v1(apps, packages, repodir, repodict, requestsdict, fdroid_signing_key_
 
     json_name = 'index-v1.json'
     index_file = os.path.join(repodir, json_name)
-    with open(index_file, 'w') as fp:
+    with IndexWriter(index_file) as fp:
         if common.options.pretty:
             json.dump(output, fp, default=_index_encoder_default, indent=2)
         else:
             json.dump(output, fp, default=_index_encoder_default)
 
+    diff_names = []
+    if common.config.get('index_diffs', 0) > 0:
+        with open(index_file) as fp:
+            diff_names = make_v1_diffs(repodir, json.load(fp), common.config['index_diffs'])
+    elif os.path.isdir(os.path.join(repodir, 'diff')):
+        shutil.rmtree(os.path.join(repodir, 'diff'))
+
+    shard_names = []
+    if common.config.get('index_shards'):
+        shard_names = make_v1_shards(repodir, output, _index_encoder_default)
+    else:
+        remove_index_file(os.path.join(repodir, 'entry-v1.json'))
+        if os.path.exists(os.path.join(repodir, 'entry-v1.jar')):
+            os.remove(os.path.join(repodir, 'entry-v1.jar'))
+        if os.path.isdir(os.path.join(repodir, 'shards')):
+            shutil.rmtree(os.path.join(repodir, 'shards'))
+
     if common.options.nosign:
         _copy_to_local_copy_dir(repodir, index_file)
+        for name in diff_names + shard_names:
+            _copy_to_local_copy_dir(repodir, os.path.join(repodir, name))
         logging.debug(_('index-v1 must have a signature, use `fdroid signindex` to create it!'))
     else:
         signindex.config = common.config
         signindex.sign_index_v1(repodir, json_name)
+        for diff_name in diff_names:
+            signindex.sign_index_json(repodir, diff_name)
+        if shard_names:
+            signindex.sign_index_json(repodir, 'entry-v1.json')
+
+
+def make_v1_shards(repodir, output, encoder_default):
+    """Write the index-v1 data split up into one shard per app.
+
+    Each shard has the app's entry from "apps" as "app", and its list
+    from "packages" as "packages".  Shards are named after the SHA-256
+    of their contents, e.g. repo/shards/<sha256>.json, so a shard file
+    is only written when its contents changed, and unchanged shards
+    keep their mtime and are skipped by deploy.  entry-v1.json has the
+    "repo" and "requests" data, and the name, SHA-256 and size of the
+    shard of each app, keyed by packageName.  Only the entry needs to
+    be signed, the shards are verified by their SHA-256.
+
+    Shards that are in neither the current nor the previous entry are
+    removed, so clients still using the previous entry keep working
+    while the new one is being deployed.
+
+    Returns
+    -------
+    the list of files written, relative to repodir
+    """
+    shardsdir = os.path.join(repodir, 'shards')
+    os.makedirs(shardsdir, exist_ok=True)
+    entry_name = 'entry-v1.json'
+    entry_file = os.path.join(repodir, entry_name)
+
+    keep = set()
+    if os.path.exists(entry_file):
+        try:
+            with open(entry_file) as fp:
+                for shard in json.load(fp).get('shards', dict()).values():
+                    keep.add(os.path.basename(shard['name']))
+        except (ValueError, KeyError, AttributeError) as e:
+            logging.warning(_('Ignoring invalid {path}: {error}').format(path=entry_file, error=e))
+
+    written = []
+    shards = collections.OrderedDict()
+    for app in output['apps']:
+        packageName = app['packageName']
+        shard = collections.OrderedDict()
+        shard['app'] = app
+        shard['packages'] = output['packages'].get(packageName, [])
+        data = json.dumps(shard, default=encoder_default, separators=(',', ':')).encode()
+        sha256 = hashlib.sha256(data).hexdigest()
+        name = 'shards/%s.json' % sha256
+        path = os.path.join(repodir, name)
+        if not os.path.exists(path):
+            with open(path + '.tmp', 'wb') as fp:
+                fp.write(data)
+            os.replace(path + '.tmp', path)
+            written.append(name)
+        keep.add(os.path.basename(name))
+        shards[packageName] = collections.OrderedDict(
+            [('name', name), ('sha256', sha256), ('size', len(data))]
+        )
+
+    for f in os.listdir(shardsdir):
+        if f not in keep:
+            os.remove(os.path.join(shardsdir, f))
+
+    entry = collections.OrderedDict()
+    entry['repo'] = output['repo']
+    entry['requests'] = output['requests']
+    entry['shards'] = shards
+    with IndexWriter(entry_file) as fp:
+        json.dump(entry, fp, default=encoder_default)
+    written.append(entry_name)
+    logging.debug('Wrote %d of %d index-v1 shards in %s'
+                  % (len(written) - 1, len(shards), shardsdir))
+    return written
+
+
+def _index_v1_to_patchable(data):
+    """Key the "apps" list by packageName so each app can be patched on its own."""
+    data = collections.OrderedDict(data)
+    data['apps'] = collections.OrderedDict(
+        (app['packageName'], app) for app in data.get('apps', [])
+    )
+    return data
+
+
+def _index_v1_from_patchable(data):
+    data['apps'] = list(data.get('apps', dict()).values())
+    return data
+
+
+def make_json_merge_patch(old, new):
+    """Return the RFC 7386 JSON Merge Patch that turns old into new.
+
+    Lists are replaced as a whole, and since null means "delete" in a
+    merge patch, new must not contain any null values.
+    """
+    patch = collections.OrderedDict()
+    for k in old:
+        if k not in new:
+            patch[k] = None
+    for k, v in new.items():
+        if k not in old:
+            patch[k] = v
+        elif isinstance(v, dict) and isinstance(old[k], dict):
+            subpatch = make_json_merge_patch(old[k], v)
+            if subpatch:
+                patch[k] = subpatch
+        elif v != old[k]:
+            patch[k] = v
+    return patch
+
+
+def apply_json_merge_patch(target, patch):
+    """Apply an RFC 7386 JSON Merge Patch to target, and return the result."""
+    if not isinstance(patch, dict):
+        return patch
+    if not isinstance(target, dict):
+        target = collections.OrderedDict()
+    for k, v in patch.items():
+        if v is None:
+            target.pop(k, None)
+        else:
+            target[k] = apply_json_merge_patch(target.get(k), v)
+    return target
+
+
+def make_v1_diffs(repodir, index, count):
+    """Write index-v1 diffs from the previous indexes to the current one.
+
+    The last count published indexes are kept in tmp/.  For each of
+    them, repo/diff/<timestamp>.json is written, named after the
+    timestamp of that old index.  It is a JSON Merge Patch (RFC 7386)
+    to the current index, where "apps" is a dict keyed by packageName
+    rather than a list.  A client that has the index with that
+    timestamp can then fetch only the changes.  Diffs from indexes
+    that are no longer kept are removed.
+
+    Returns
+    -------
+    the list of the diff files written, relative to repodir
+    """
+    timestamp = index['repo']['timestamp']
+    historydir = os.path.join('tmp', 'index-v1-history', repodir)
+    diffdir = os.path.join(repodir, 'diff')
+    os.makedirs(historydir, exist_ok=True)
+    os.makedirs(diffdir, exist_ok=True)
+
+    history = []
+    for f in os.listdir(historydir):
+        name, ext = os.path.splitext(f)
+        if ext == '.json' and name.isdigit() and int(name) < timestamp:
+            history.append(int(name))
+    history.sort()
+    for old_timestamp in history[:-count]:
+        os.remove(os.path.join(historydir, '%d.json' % old_timestamp))
+    history = history[-count:]
+
+    for f in os.listdir(diffdir):
+        name, ext = os.path.splitext(f)
+        if not name.isdigit() or int(name) not in history:
+            os.remove(os.path.join(diffdir, f))
+
+    current = _index_v1_to_patchable(index)
+    diff_names = []
+    for old_timestamp in history:
+        with open(os.path.join(historydir, '%d.json' % old_timestamp)) as fp:
+            old = _index_v1_to_patchable(json.load(fp))
+        diff_name = os.path.join('diff', '%d.json' % old_timestamp)
+        with open(os.path.join(repodir, diff_name), 'w') as fp:
+            json.dump(make_json_merge_patch(old, current), fp, separators=(',', ':'))
+        diff_names.append(diff_name)
+
+    with open(os.path.join(historydir, '%d.json' % timestamp), 'w') as fp:
+        json.dump(index, fp, separators=(',', ':'))
+    logging.debug('Wrote %d index-v1 diffs in %s' % (len(diff_names), diffdir))
+    return diff_names
 
 
 def _copy_to_local_copy_dir(repodir, f):
     local_copy_dir = common.config.get('local_copy_dir', '')
     if os.path.exists(local_copy_dir):
-        destdir = os.path.join(local_copy_dir, repodir)
+        destdir = os.path.join(local_copy_dir, repodir,
+                               os.path.dirname(os.path.relpath(f, repodir)))
         if not os.path.exists(destdir):
-            os.mkdir(destdir)
-        shutil.copy2(f, destdir, follow_symlinks=False)
+            os.makedirs(destdir)
+        # index files are rewritten in place, so they must never be hardlinked
+        common.place_file(f, destdir, hardlink=False)
     elif local_copy_dir:
         raise FDroidException(_('"local_copy_dir" {path} does not exist!')
                               .format(path=local_copy_dir))
 
 
+INDEX_COMPRESSION_EXTENSIONS = ('gz', 'br', 'zst')
+# better compression takes much longer, but hardly makes the index smaller
+BROTLI_QUALITY = 9
+ZSTD_LEVEL = 12
+
+
+def _get_index_compressors():
+    """Return (extension, compress, flush) for each enabled compression that is available.
+
+    gzip is always available, brotli and zstandard are only used when
+    their Python modules are installed.
+    """
+    compressors = []
+    for ext in common.config.get('index_compression', ['gz']):
+        if ext == 'gz':
+            c = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            compressors.append((ext, c.compress, c.flush))
+        elif ext == 'br':
+            try:
+                import brotli
+            except ImportError:
+                logging.debug('brotli is not installed, not writing .br indexes')
+                continue
+            c = brotli.Compressor(quality=BROTLI_QUALITY)
+            compressors.append((ext, c.process, c.finish))
+        elif ext == 'zst':
+            try:
+                import zstandard
+            except ImportError:
+                logging.debug('zstandard is not installed, not writing .zst indexes')
+                continue
+            c = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+            compressors.append((ext, c.compress, c.flush))
+        else:
+            raise FDroidException(_('Unknown index_compression: {ext}').format(ext=ext))
+    return compressors
+
+
+class IndexWriter:
+    """Write an index file and its precompressed variants in a single pass.
+
+    Web servers can then serve the .gz, .br and .zst files as they are,
+    e.g. with nginx's gzip_static, instead of compressing the index for
+    every request.  All files are written to temporary files first, and
+    only replace the old files when the writer is closed without error.
+    Stale variants, e.g. from a compression that was disabled, are
+    removed.
+    """
+
+    BUFFER_SIZE = 1 << 16
+
+    def __init__(self, path):
+        self.path = path
+        self._buffer = []
+        self._buffered = 0
+        self._outputs = []
+        with contextlib.ExitStack() as stack:
+            stack.callback(self._remove_tmp_files)
+            self._open(stack, path, None, None)
+            for ext, compress, flush in _get_index_compressors():
+                self._open(stack, path + '.' + ext, compress, flush)
+            self._stack = stack.pop_all()
+
+    def _open(self, stack, f, compress, flush):
+        fp = stack.enter_context(open(f + '.tmp', 'wb'))
+        self._outputs.append((f, fp, compress, flush))
+
+    def _remove_tmp_files(self):
+        for f, fp, compress, flush in self._outputs:
+            if os.path.exists(f + '.tmp'):
+                os.remove(f + '.tmp')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._stack.close()
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.BUFFER_SIZE:
+            self._flush_buffer()
+
+    def _flush_buffer(self):
+        data = b''.join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        for f, fp, compress, flush in self._outputs:
+            fp.write(compress(data) if compress else data)
+
+    def close(self):
+        written = []
+        try:
+            self._flush_buffer()
+            for f, fp, compress, flush in self._outputs:
+                if flush:
+                    fp.write(flush())
+                fp.close()
+                os.replace(f + '.tmp', f)
+                written.append(f)
+        finally:
+            self._stack.close()
+        for ext in INDEX_COMPRESSION_EXTENSIONS:
+            f = self.path + '.' + ext
+            if f not in written and os.path.exists(f):
+                os.remove(f)
+
+
+def remove_index_file(path):
+    """Remove an index file along with its precompressed variants."""
+    for f in [path] + [path + '.' + ext for ext in INDEX_COMPRESSION_EXTENSIONS]:
+        if os.path.exists(f):
+            os.remove(f)
+
+
 def v1_sort_packages(packages, fdroid_signing_key_fingerprints):
     """Sort the supplied list to ensure a deterministic sort order for package entries in the index file.
 
@@ -923,7 +1250,7 @@ def make_v0(apps, apks, repodir, repodict, requestsdict, fdroid_signing_key_fing
     else:
         output = doc.toxml(encoding='utf-8')
 
-    with open(os.path.join(repodir, 'index.xml'), 'wb') as f:
+    with IndexWriter(os.path.join(repodir, 'index.xml')) as f:
         f.write(output)
 
     if 'repo_keyalias' in common.config \
@@ -937,9 +1264,8 @@ def make_v0(apps, apks, repodir, repodict, requestsdict, fdroid_signing_key_fing
 
         # Create a jar of the index...
         jar_output = 'index_unsigned.jar' if common.options.nosign else 'index.jar'
-        p = FDroidPopen(['jar', 'cf', jar_output, 'index.xml'], cwd=repodir)
-        if p.returncode != 0:
-            raise FDroidException("Failed to create {0}".format(jar_output))
+        with zipfile.ZipFile(os.path.join(repodir, jar_output), 'w', zipfile.ZIP_DEFLATED) as jar:
+            jar.write(os.path.join(repodir, 'index.xml'), 'index.xml')
 
         # Sign the index...
         signed = os.path.join(repodir, 'index.jar')
@@ -970,17 +1296,37 @@ def make_v0(apps, apks, repodir, repodict, requestsdict, fdroid_signing_key_fing
             shutil.copy(exampleicon, iconfilename)
 
 
+# keystore, alias and mtime -> the result of extract_pubkey() via keytool
+_keytool_pubkey_cache = dict()
+
+
 def extract_pubkey():
     """Extract and return the repository's public key from the keystore.
 
+    When keytool has to be used, the result is cached as long as the
+    keystore does not change, since this is needed for every index.
+
     Returns
     -------
     public key in hex
     repository fingerprint
     """
+    signindex.config = common.config
+    signing_key = None
+    if 'repo_pubkey' not in common.config:
+        signing_key = signindex.load_signing_key()
+
     if 'repo_pubkey' in common.config:
         pubkey = unhexlify(common.config['repo_pubkey'])
+    elif signing_key:
+        from cryptography.hazmat.primitives.serialization import Encoding
+        pubkey = signing_key[1].public_bytes(Encoding.DER)
     else:
+        keystore = common.config['keystore']
+        cache_key = (keystore, common.config['repo_keyalias'],
+                     os.path.getmtime(keystore) if os.path.isfile(keystore) else None)
+        if cache_key in _keytool_pubkey_cache:
+            return _keytool_pubkey_cache[cache_key]
         env_vars = {'LC_ALL': 'C.UTF-8',
                     'FDROID_KEY_STORE_PASS': common.config['keystorepass']}
         p = FDroidPopenBytes([common.config['keytool'], '-exportcert',
@@ -995,6 +1341,9 @@ def extract_pubkey():
                 msg += ' Is your crypto smartcard plugged in?'
             raise FDroidException(msg)
         pubkey = p.output
+        repo_pubkey_fingerprint = common.get_cert_fingerprint(pubkey)
+        _keytool_pubkey_cache[cache_key] = (hexlify(pubkey), repo_pubkey_fingerprint)
+        return _keytool_pubkey_cache[cache_key]
     repo_pubkey_fingerprint = common.get_cert_fingerprint(pubkey)
     return hexlify(pubkey), repo_pubkey_fingerprint
 
@@ -1057,13 +1406,18 @@ def get_mirror_service_urls(url):
     return urls
 
 
-def download_repo_index(url_str, etag=None, verify_fingerprint=True, timeout=600):
+def download_repo_index(url_str, etag=None, verify_fingerprint=True, timeout=600,
+                        old_index=None):
     """Download and verifies index file, then returns its data.
 
     Downloads the repository index from the given :param url_str and
     verifies the repository's fingerprint if :param verify_fingerprint
     is not False.
 
+    If :param old_index is a previously downloaded index, this first
+    tries to fetch the signed diff from it to the current index, and
+    only falls back to the full index when there is no such diff.
+
     Raises
     ------
     VerificationException() if the repository could not be verified
@@ -1090,6 +1444,17 @@ def download_repo_index(url_str, etag=None, verify_fingerprint=True, timeout=600
         path = url.path.rstrip('/')
 
     url = urllib.parse.SplitResult(url.scheme, url.netloc, path + '/index-v1.jar', '', '')
+
+    if old_index:
+        diff_url = urllib.parse.SplitResult(
+            url.scheme, url.netloc,
+            path + '/diff/%d.jar' % old_index['repo']['timestamp'], '', '')
+        index = download_repo_index_diff(diff_url.geturl(), old_index,
+                                         fingerprint or old_index['repo'].get('fingerprint'),
+                                         timeout)
+        if index is not None:
+            return index, net.http_get_etag(url.geturl(), timeout)
+
     download, new_etag = net.http_get(url.geturl(), etag, timeout)
 
     if download is None:
@@ -1105,13 +1470,72 @@ def download_repo_index(url_str, etag=None, verify_fingerprint=True, timeout=600
         return index, new_etag
 
 
-def get_index_from_jar(jarfile, fingerprint=None):
+def download_repo_index_diff(url, old_index, fingerprint, timeout=600):
+    """Download a signed index-v1 diff and apply it to old_index.
+
+    Parameters
+    ----------
+    url
+      the URL of diff/<timestamp>.jar, named after the timestamp of old_index
+    old_index
+      the index to apply the diff to, as returned by download_repo_index()
+    fingerprint
+      the SHA-256 fingerprint of the signing key.  Without it, the
+      diff must be signed by the key in old_index["repo"]["pubkey"].
+
+    Returns
+    -------
+    The updated index, or None if there is no diff available, or it
+    could not be used, so the full index needs to be downloaded.
+    """
+    try:
+        return _download_repo_index_diff(url, old_index, fingerprint, timeout)
+    except requests.exceptions.HTTPError as e:
+        if e.response is not None and e.response.status_code == 404:
+            logging.debug('No index diff available at %s' % url)
+        else:
+            logging.warning(_('Cannot use index diff {url}: {error}').format(url=url, error=e))
+    except Exception as e:
+        logging.warning(_('Cannot use index diff {url}: {error}').format(url=url, error=e))
+    return None
+
+
+def _download_repo_index_diff(url, old_index, fingerprint, timeout):
+    download, _etag = net.http_get(url, timeout=timeout)
+    json_name = os.path.basename(urllib.parse.urlsplit(url).path)[:-4] + '.json'
+    with tempfile.NamedTemporaryFile() as fp:
+        fp.write(download)
+        fp.flush()
+        patch, public_key, public_key_fingerprint = get_index_from_jar(
+            fp.name, fingerprint, json_name=json_name
+        )
+    pubkey = hexlify(public_key).decode()
+    if not fingerprint and pubkey != old_index['repo'].get('pubkey'):
+        raise VerificationException(
+            _("The index diff is not signed by the key of the index.")
+        )
+
+    index = json.loads(json.dumps(old_index))
+    index = _index_v1_from_patchable(
+        apply_json_merge_patch(_index_v1_to_patchable(index), patch)
+    )
+    if index['repo']['timestamp'] <= old_index['repo']['timestamp']:
+        raise VerificationException(_("The index diff does not lead to a newer index."))
+    index["repo"]["pubkey"] = pubkey
+    index["repo"]["fingerprint"] = public_key_fingerprint
+    index["apps"] = [metadata.App(app) for app in index["apps"]]
+    return index
+
+
+def get_index_from_jar(jarfile, fingerprint=None, json_name='index-v1.json'):
     """Return the data, public key, and fingerprint from index-v1.jar.
 
     Parameters
     ----------
     fingerprint is the SHA-256 fingerprint of signing key. Only
       hex digits count, all other chars will can be discarded.
+    json_name
+      the name of the signed JSON file inside the JAR
 
     Raises
     ------
@@ -1126,7 +1550,7 @@ def get_index_from_jar(jarfile, fingerprint=None):
             fingerprint = re.sub(r'[^0-9A-F]', r'', fingerprint.upper())
             if fingerprint != public_key_fingerprint:
                 raise VerificationException(_("The repository's fingerprint does not match."))
-        data = json.loads(jar.read('index-v1.json').decode())
+        data = json.loads(jar.read(json_name).decode())
         return data, public_key, public_key_fingerprint
 
 
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+#
+# mavencache.py - part of the FDroid server tools
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""A caching proxy for the Maven repos that builds are allowed to use.
+
+Gradle downloads the same AndroidX, Kotlin, etc. artifacts for every
+app it builds.  This runs a small HTTP server on localhost that Gradle
+gets them from instead, through an init script that points the repos
+from scanner.MAVEN_REPOS at it.  Artifacts are kept in a local
+directory, so each is only downloaded once.  Requests for anything
+that is not in one of those repos are refused.
+
+maven-metadata.xml files and snapshots change upstream, so those are
+always downloaded, and never cached.
+"""
+
+import http.server
+import logging
+import os
+import shutil
+import socketserver
+import tempfile
+import threading
+import urllib.parse
+
+import requests
+
+from . import _
+from . import net
+from . import scanner
+
+INIT_SCRIPT = '''// written by fdroidserver, see fdroidserver/mavencache.py
+def mirror = System.getenv('FDROID_MAVEN_MIRROR')
+def mirrored = [%s]
+
+def useMirror = { repos ->
+    repos.withType(MavenArtifactRepository).all { repo ->
+        def url = repo.url.toString().replaceAll('/+$', '')
+        if (mirror && mirrored.any { url == it || url.startsWith(it + '/') }) {
+            repo.url = mirror + '/' + url.substring('https://'.length())
+            if (repo.hasProperty('allowInsecureProtocol')) {
+                repo.allowInsecureProtocol = true
+            }
+        }
+    }
+}
+
+settingsEvaluated { settings ->
+    if (settings.hasProperty('pluginManagement')) {
+        useMirror(settings.pluginManagement.repositories)
+    }
+    if (settings.hasProperty('dependencyResolutionManagement')) {
+        useMirror(settings.dependencyResolutionManagement.repositories)
+    }
+}
+
+allprojects {
+    useMirror(buildscript.repositories)
+    useMirror(repositories)
+}
+'''
+
+
+def is_cacheable(url):
+    """Check whether a file in a Maven repo never changes once it is there."""
+    name = url.rsplit('/', 1)[-1]
+    if not name or name.startswith('maven-metadata'):
+        return False
+    return '-SNAPSHOT/' not in url
+
+
+class _Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self._serve(True)
+
+    def do_HEAD(self):
+        self._serve(False)
+
+    def _serve(self, send_body):
+        cache = self.server.cache
+        url = cache.upstream_url(self.path)
+        if url is None:
+            self.send_error(403, 'Not in an allowed Maven repo')
+            return
+        try:
+            path, temporary = cache.fetch(url)
+        except requests.exceptions.HTTPError as e:
+            status = 502
+            if e.response is not None:
+                status = e.response.status_code
+            self.send_error(status)
+            return
+        except (requests.exceptions.RequestException, OSError) as e:
+            logging.warning(
+                _('Maven cache could not get {url}: {error}').format(url=url, error=e)
+            )
+            self.send_error(502)
+            return
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(os.path.getsize(path)))
+            self.end_headers()
+            if send_body:
+                with open(path, 'rb') as fp:
+                    shutil.copyfileobj(fp, self.wfile, net.CHUNK_SIZE)
+        finally:
+            if temporary:
+                os.remove(path)
+
+    def log_message(self, format, *args):
+        logging.debug('Maven cache: ' + format % args)
+
+
+class MavenCache:
+    """A caching proxy on localhost for the allowed Maven repos.
+
+    Parameters
+    ----------
+    cache_dir
+        where the artifacts are kept, in a dir per host, like the repos
+    repos
+        the base URLs of the repos to proxy, otherwise the https ones
+        from scanner.MAVEN_REPOS
+    """
+
+    def __init__(self, cache_dir, repos=None):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        if repos is None:
+            repos = scanner.MAVEN_REPOS
+        self.repos = [r.rstrip('/') for r in repos if r.startswith('https://')]
+        self.url = None
+        self.init_script = os.path.join(self.cache_dir, 'init.gradle')
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.bytes_downloaded = 0
+        self._lock = threading.Lock()
+        self._server = None
+
+    def upstream_url(self, path):
+        """Get the URL in an allowed repo of a path on the proxy, or None."""
+        path = urllib.parse.unquote(urllib.parse.urlsplit(path).path).lstrip('/')
+        parts = path.split('/')
+        if path.endswith('/'):  # a dir listing, for dynamic versions
+            parts.pop()
+        if any(part in ('', '.', '..') for part in parts):
+            return None
+        url = 'https://' + path
+        for repo in self.repos:
+            if url.startswith(repo + '/'):
+                return url
+        return None
+
+    def fetch(self, url):
+        """Get a file from the cache, downloading it if it is not there yet.
+
+        Returns
+        -------
+        the path to the file, and whether it is a temporary file that
+        should be deleted after use, since it cannot be cached
+        """
+        path = os.path.join(self.cache_dir, url[len('https://') :])
+        cacheable = is_cacheable(url)
+        if cacheable and os.path.isfile(path):
+            with self._lock:
+                self.hits += 1
+                self.bytes_saved += os.path.getsize(path)
+            return path, False
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.')
+        os.close(fd)
+        try:
+            net.download_file(url, local_filename=tmp)
+        except BaseException:
+            for f in (tmp, tmp + '.part', tmp + '.part.validator'):
+                if os.path.exists(f):
+                    os.remove(f)
+            raise
+        with self._lock:
+            self.misses += 1
+            self.bytes_downloaded += os.path.getsize(tmp)
+        if not cacheable:
+            return tmp, True
+        os.replace(tmp, path)
+        return path, False
+
+    def stats(self):
+        """Get the hits and misses, and the bytes downloaded and saved so far."""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'bytesDownloaded': self.bytes_downloaded,
+                'bytesSaved': self.bytes_saved,
+            }
+
+    def start(self):
+        """Start serving, and write the Gradle init script that uses it."""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # written next to it and renamed, since other runs may use it
+        tmp = self.init_script + '.%d.tmp' % os.getpid()
+        with open(tmp, 'w') as fp:
+            fp.write(INIT_SCRIPT % ', '.join("'%s'" % r for r in self.repos))
+        os.replace(tmp, self.init_script)
+
+        self._server = _Server(('127.0.0.1', 0), _Handler)
+        self._server.cache = self
+        self.url = 'http://127.0.0.1:%d' % self._server.server_address[1]
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        logging.debug(_('Serving Maven cache on {url}').format(url=self.url))
+
+    def stop(self):
+        """Stop serving, and log how much was downloaded."""
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._server = None
+        stats = self.stats()
+        logging.info(
+            _(
+                'Maven cache: {hits} hits, {misses} misses, '
+                '{downloaded:.1f} MiB downloaded, {saved:.1f} MiB saved'
+            ).format(
+                hits=stats['hits'],
+                misses=stats['misses'],
+                downloaded=stats['bytesDownloaded'] / 1024**2,
+                saved=stats['bytesSaved'] / 1024**2,
+            )
+        )
@@ -1,50 +1,129 @@
 #!/usr/bin/env python3
 
+import concurrent.futures
 import ipaddress
+import json
 import logging
 import os
 import posixpath
+import requests
 import socket
-import subprocess
 import sys
 from argparse import ArgumentParser
+from binascii import hexlify
 import urllib.parse
 
 from . import _
 from . import common
 from . import index
+from . import net
 from . import update
+from .exception import VerificationException
 
 options = None
 
 
-def _run_wget(path, urls):
-    if options.verbose:
-        verbose = '--verbose'
-    else:
-        verbose = '--no-verbose'
-
-    if not urls:
-        return
-    logging.debug(_('Running wget in {path}').format(path=path))
-    cwd = os.getcwd()
-    os.makedirs(path, exist_ok=True)
-    os.chdir(path)
-    urls_file = '.fdroid-mirror-wget-input-file'
-    with open(urls_file, 'w') as fp:
-        for url in urls:
-            fp.write(url.split('?')[0] + '\n')  # wget puts query string in the filename
-    subprocess.call(
-        [
-            'wget',
-            verbose,
-            '--continue',
-            '--user-agent="fdroid mirror"',
-            '--input-file=' + urls_file,
-        ]
-    )
-    os.remove(urls_file)
-    os.chdir(cwd)  # leave the working env the way we found it
+MIRROR_STATE_FILE = '.fdroid-mirror-state.json'
+
+
+def _load_state(statefile):
+    """Load what the last run mirrored: the SHA-256 and size of each file from the index."""
+    if os.path.exists(statefile):
+        try:
+            with open(statefile) as fp:
+                return json.load(fp)
+        except (OSError, ValueError) as e:
+            logging.warning(
+                _('Ignoring invalid {path}: {error}').format(path=statefile, error=e)
+            )
+    return dict()
+
+
+def _write_state(statefile, state):
+    with open(statefile + '.tmp', 'w') as fp:
+        json.dump(state, fp, indent=2, sort_keys=True)
+    os.replace(statefile + '.tmp', statefile)
+
+
+def _is_up_to_date(path, sha256, size, entry):
+    """Whether the file is already mirrored, without making any request.
+
+    A file is up-to-date when the last run mirrored the same SHA-256 and
+    size that the index lists now, and it still has that size.  Files
+    that were mirrored before there was a state file, or by other tools,
+    are checked against the SHA-256 from the index so they do not need
+    to be downloaded again.  Files without a SHA-256 in the index, like
+    graphics, are never up-to-date, they are checked with a conditional
+    GET instead.  Files that were missing on the server are tried again.
+    """
+    if sha256 is None or not os.path.exists(path):
+        return False
+    if size is not None and os.path.getsize(path) != size:
+        return False
+    if entry and not entry.get('missing') and entry.get('sha256') == sha256:
+        return True
+    return common.sha256sum(path) == sha256
+
+
+def _get_validators(entry):
+    """Get the ETag and Last-Modified that the last run stored for a file."""
+    validators = dict()
+    if entry and not entry.get('missing'):
+        validators['ETag'] = entry.get('etag')
+        validators['Last-Modified'] = entry.get('lastModified')
+    return validators
+
+
+def _download_file(url, path, sha256=None, required=False, validators=None):
+    """Download a single file of the mirror.
+
+    Files that have a SHA-256 in the index are verified while they are
+    downloaded, the others are only downloaded again when the server has
+    a newer copy, based on the validators from _get_validators().  Files
+    that do not exist on the server are only an error if they are
+    required, like the APKs listed in the index.
+
+    Returns
+    -------
+    True if the file was mirrored, None if it is optional and does not
+    exist on the server, or False if it failed.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        net.download_file(
+            url.split('?')[0],
+            path,
+            conditional=sha256 is None,
+            sha256=sha256,
+            validators=validators,
+        )
+    except requests.exceptions.HTTPError as e:
+        if not required and e.response is not None and e.response.status_code == 404:
+            logging.debug('%s does not exist, skipping' % url)
+            return None
+        logging.error(_('Failed to mirror {url}: {error}').format(url=url, error=e))
+        return False
+    except (requests.exceptions.RequestException, VerificationException) as e:
+        logging.error(_('Failed to mirror {url}: {error}').format(url=url, error=e))
+        return False
+    logging.debug('Mirrored ' + url)
+    return True
+
+
+def _download_files(files):
+    """Download files in parallel, with at most --jobs downloads at a time.
+
+    Parameters
+    ----------
+    files
+      A list of tuples of the arguments for _download_file().
+
+    Returns
+    -------
+    The results of _download_file(), in the same order.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=options.jobs) as executor:
+        return list(executor.map(lambda f: _download_file(*f), files))
 
 
 def main():
@@ -93,6 +172,19 @@ def main():
     parser.add_argument(
         "--output-dir", default=None, help=_("The directory to write the mirror to")
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=4,
+        help=_("The number of files to download in parallel"),
+    )
+    parser.add_argument(
+        "--prune",
+        action='store_true',
+        default=False,
+        help=_("Delete files that are no longer in the index"),
+    )
     options = parser.parse_args()
 
     if options.all:
@@ -124,25 +216,128 @@ def main():
             )
             sys.exit(1)
 
+        def _get_index_from_shards(section):
+            """Get the index from entry-v1.jar, and only the shards that changed.
+
+            The shards that are already mirrored are used as they are,
+            the others are downloaded and verified against the SHA-256
+            from the signed entry.
+
+            Returns
+            -------
+            The index and the shards from the entry, or None, None if the
+            repo has no shards or they could not be used.
+            """
+            sectiondir = os.path.join(basedir, section)
+            entry_jar = os.path.join(sectiondir, 'entry-v1.jar')
+            if not _download_file(
+                _append_to_url_path(section, 'entry-v1.jar'), entry_jar
+            ):
+                return None, None
+            try:
+                entry = index.get_index_from_jar(
+                    entry_jar, fingerprint[0], json_name='entry-v1.json'
+                )[0]
+                shards = entry['shards']
+                for shard in shards.values():
+                    if shard['name'] != 'shards/%s.json' % shard['sha256']:
+                        raise VerificationException('Invalid shard ' + shard['name'])
+            except Exception as e:
+                logging.warning(
+                    _('Cannot use {path}: {error}').format(path=entry_jar, error=e)
+                )
+                os.remove(entry_jar)
+                return None, None
+
+            to_fetch = []
+            for shard in shards.values():
+                path = os.path.join(sectiondir, shard['name'])
+                relpath = os.path.relpath(path, basedir)
+                if not _is_up_to_date(
+                    path, shard['sha256'], shard['size'], state.get(relpath)
+                ):
+                    url = _append_to_url_path(section, shard['name'])
+                    to_fetch.append((url, path, shard['sha256'], True))
+            logging.info(
+                _('Downloading {count} of {total} index shards').format(
+                    count=len(to_fetch), total=len(shards)
+                )
+            )
+            if not all(_download_files(to_fetch)):
+                return None, None
+
+            data = {
+                'repo': entry['repo'],
+                'requests': entry.get('requests', dict()),
+                'apps': [],
+                'packages': dict(),
+            }
+            for packageName, shard in shards.items():
+                with open(os.path.join(sectiondir, shard['name'])) as fp:
+                    shard_data = json.load(fp)
+                data['apps'].append(shard_data['app'])
+                if shard_data['packages']:
+                    data['packages'][packageName] = shard_data['packages']
+            return data, shards
+
         def _get_index(section, etag=None):
-            url = _append_to_url_path(section)
-            data, etag = index.download_repo_index(url, etag=etag)
-            return data, etag, _append_to_url_path(section, 'index-v1.jar')
+            """Get the verified index, downloading as little as possible.
+
+            If the repo is sharded, only the shards that changed are
+            downloaded.  Otherwise, a diff to the mirrored index is
+            tried.  When a diff applies, the new index-v1.jar is still
+            mirrored, since clients only use that, but it does not need
+            to be parsed and verified again.
+
+            Returns
+            -------
+            The index, its ETag, the URL of the index-v1.jar to mirror,
+            the name of the diff that was applied, if any, and the
+            shards from entry-v1.json.
+            """
+            data, shards = _get_index_from_shards(section)
+            if data is not None:
+                index_url = _append_to_url_path(section, 'index-v1.jar')
+                return data, None, index_url, None, shards
+
+            old_jar = os.path.join(basedir, section, 'index-v1.jar')
+            if os.path.exists(old_jar):
+                # only fetch what changed since the last mirror run
+                try:
+                    old_index, public_key, _ignored = index.get_index_from_jar(
+                        old_jar, fingerprint[0]
+                    )
+                    old_index['repo']['pubkey'] = hexlify(public_key).decode()
+                except Exception as e:
+                    logging.debug('Not using %s for index diffs: %s' % (old_jar, e))
+                else:
+                    diff_name = '%d.jar' % old_index['repo']['timestamp']
+                    data = index.download_repo_index_diff(
+                        _append_to_url_path(section, 'diff', diff_name),
+                        old_index,
+                        fingerprint[0],
+                    )
+                    if data is not None:
+                        index_url = _append_to_url_path(section, 'index-v1.jar')
+                        return data, None, index_url, diff_name, None
+            data, etag = index.download_repo_index(
+                _append_to_url_path(section), etag=etag
+            )
+            index_url = _append_to_url_path(section, 'index-v1.jar')
+            return data, etag, index_url, None, None
 
     else:
 
         def _get_index(section, etag=None):
             import io
-            import json
             import zipfile
-            from . import net
 
             url = _append_to_url_path(section, 'index-v1.jar')
             content, etag = net.http_get(url)
             with zipfile.ZipFile(io.BytesIO(content)) as zip:
                 jsoncontents = zip.open('index-v1.json').read()
             data = json.loads(jsoncontents.decode('utf-8'))
-            return data, etag, None  # no verified index file to return
+            return data, etag, None, None, None  # no verified index file to return
 
     ip = None
     try:
@@ -177,7 +372,7 @@ def main():
         icondirs.append('icons-' + density)
 
     if options.output_dir:
-        basedir = options.output_dir
+        basedir = os.path.abspath(options.output_dir)
     else:
         basedir = os.path.join(os.getcwd(), hostname, path.strip('/'))
         os.makedirs(basedir, exist_ok=True)
@@ -187,86 +382,150 @@ def main():
     else:
         sections = ('repo',)
 
+    statefile = os.path.join(basedir, MIRROR_STATE_FILE)
+    state = _load_state(statefile)
+    failed = 0
     for section in sections:
         sectiondir = os.path.join(basedir, section)
 
-        urls = []
-        data, etag, index_url = _get_index(section)
-        if index_url:
-            urls.append(index_url)
-
-        os.makedirs(sectiondir, exist_ok=True)
-        os.chdir(sectiondir)
-        for icondir in icondirs:
-            os.makedirs(os.path.join(sectiondir, icondir), exist_ok=True)
+        files = []
+        data, etag, index_url, diff_name, shards = _get_index(section)
+
+        def _want(components, sha256=None, size=None, required=False):
+            files.append(
+                (
+                    _append_to_url_path(section, *components),
+                    os.path.join(sectiondir, *components),
+                    sha256,
+                    size,
+                    required,
+                )
+            )
 
         for packageName, packageList in data['packages'].items():
             for package in packageList:
-                to_fetch = []
-                keys = ['apkName']
-                if options.src_tarballs:
-                    keys.append('srcname')
-                for k in keys:
-                    if k in package:
-                        to_fetch.append(package[k])
-                    elif k == 'apkName':
-                        logging.error(
-                            _('{appid} is missing {name}').format(
-                                appid=package['packageName'], name=k
-                            )
+                if 'apkName' not in package:
+                    logging.error(
+                        _('{appid} is missing {name}').format(
+                            appid=package['packageName'], name='apkName'
                         )
-                for f in to_fetch:
-                    if not os.path.exists(f) or (
-                        f.endswith('.apk') and os.path.getsize(f) != package['size']
-                    ):
-                        urls.append(_append_to_url_path(section, f))
-                        if options.pgp_signatures:
-                            urls.append(_append_to_url_path(section, f + '.asc'))
-                        if options.build_logs and f.endswith('.apk'):
-                            urls.append(
-                                _append_to_url_path(section, f[:-4] + '.log.gz')
-                            )
-
-        _run_wget(sectiondir, urls)
+                    )
+                    continue
+                f = package['apkName']
+                sha256 = None
+                if package.get('hashType') == 'sha256':
+                    sha256 = package.get('hash')
+                _want((f,), sha256, package.get('size'), required=True)
+                if options.pgp_signatures:
+                    _want((f + '.asc',))
+                if options.build_logs and f.endswith('.apk'):
+                    _want((f[:-4] + '.log.gz',))
+                if options.src_tarballs and 'srcname' in package:
+                    _want((package['srcname'],), required=True)
+                    if options.pgp_signatures:
+                        _want((package['srcname'] + '.asc',))
 
         for app in data['apps']:
             localized = app.get('localized')
             if localized:
                 for locale, d in localized.items():
-                    urls = []
-                    components = (section, app['packageName'], locale)
+                    components = (app['packageName'], locale)
                     for k in update.GRAPHIC_NAMES:
                         f = d.get(k)
                         if f:
-                            filepath_tuple = components + (f,)
-                            urls.append(_append_to_url_path(*filepath_tuple))
-                    _run_wget(os.path.join(basedir, *components), urls)
+                            _want(components + (f,))
                     for k in update.SCREENSHOT_DIRS:
-                        urls = []
-                        filelist = d.get(k)
-                        if filelist:
-                            components = (section, app['packageName'], locale, k)
-                            for f in filelist:
-                                filepath_tuple = components + (f,)
-                                urls.append(_append_to_url_path(*filepath_tuple))
-                            _run_wget(os.path.join(basedir, *components), urls)
-
-        urls = dict()
+                        for f in d.get(k, []):
+                            _want(components + (k, f))
+
+        if shards:
+            _want(('entry-v1.jar',))
+            for shard in shards.values():
+                _want(
+                    tuple(shard['name'].split('/')),
+                    shard['sha256'],
+                    shard['size'],
+                    required=True,
+                )
+
         for app in data['apps']:
             if 'icon' not in app:
                 logging.error(
                     _('no "icon" in {appid}').format(appid=app['packageName'])
                 )
                 continue
-            icon = app['icon']
             for icondir in icondirs:
-                url = _append_to_url_path(section, icondir, icon)
-                if icondir not in urls:
-                    urls[icondir] = []
-                urls[icondir].append(url)
+                _want((icondir, app['icon']))
+
+        wanted = dict()
+        to_fetch = []
+        for url, filepath, sha256, size, required in files:
+            relpath = os.path.relpath(filepath, basedir)
+            wanted[relpath] = {'sha256': sha256, 'size': size}
+            entry = state.get(relpath)
+            if not _is_up_to_date(filepath, sha256, size, entry):
+                validators = _get_validators(entry)
+                to_fetch.append((url, filepath, sha256, required, validators))
+                state.pop(relpath, None)
+        logging.info(
+            _('Mirroring {count} of {total} files in {path}').format(
+                count=len(to_fetch), total=len(files), path=sectiondir
+            )
+        )
 
-        for icondir in icondirs:
-            _run_wget(os.path.join(basedir, section, icondir), urls[icondir])
+        # the index diffs are mirrored too, as long as the server has them
+        diffdir = os.path.join(section, 'diff')
+        diff_names = {
+            os.path.basename(r) for r in state if os.path.dirname(r) == diffdir
+        }
+        if diff_name:
+            diff_names.add(diff_name)
+        for name in sorted(diff_names):
+            filepath = os.path.join(sectiondir, 'diff', name)
+            relpath = os.path.relpath(filepath, basedir)
+            wanted[relpath] = {'sha256': None, 'size': None}
+            url = _append_to_url_path(section, 'diff', name)
+            validators = _get_validators(state.get(relpath))
+            to_fetch.append((url, filepath, None, False, validators))
+
+        for relpath in sorted(state):
+            if relpath.split(os.sep)[0] != section or relpath in wanted:
+                continue
+            if options.prune:
+                path = os.path.join(basedir, relpath)
+                if os.path.exists(path):
+                    logging.info(_('Removing obsolete {path}').format(path=path))
+                    os.remove(path)
+                del state[relpath]
+            elif not os.path.exists(os.path.join(basedir, relpath)):
+                del state[relpath]
+
+        if index_url:
+            filepath = os.path.join(sectiondir, 'index-v1.jar')
+            to_fetch.append((index_url, filepath, None, True, dict()))
+        for (url, filepath, sha256, required, validators), result in zip(
+            to_fetch, _download_files(to_fetch)
+        ):
+            relpath = os.path.relpath(filepath, basedir)
+            if result is False:
+                failed += 1
+            elif result is None and os.path.dirname(relpath) == diffdir:
+                if os.path.exists(filepath):
+                    os.remove(filepath)
+                state.pop(relpath, None)
+            elif relpath in wanted:
+                entry = dict(wanted[relpath])
+                if result is None:
+                    entry['missing'] = True
+                elif sha256 is None:
+                    entry['etag'] = validators.get('ETag')
+                    entry['lastModified'] = validators.get('Last-Modified')
+                state[relpath] = entry
+        _write_state(statefile, state)
+
+    if failed:
+        logging.error(_('{count} files could not be mirrored!').format(count=failed))
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -16,31 +16,244 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import email.utils
+import hashlib
+import logging
 import os
+import threading
+import time
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .exception import VerificationException
 
 HEADERS = {'User-Agent': 'F-Droid'}
 
+# size of the chunks that downloads are streamed and written to disk in
+CHUNK_SIZE = 1024 * 1024
+
+# how often failed requests are retried, with exponential back-off
+RETRIES = 3
+
+# the most connections that are kept open to a single host
+POOL_MAXSIZE = 16
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """Get the shared HTTP session that all requests should be made with.
+
+    It keeps a pool of open connections to each host and sends the
+    F-Droid User-Agent.  Requests that fail on connecting or with an
+    HTTP status that is likely to be temporary (429 or 5xx) are retried
+    with exponential back-off, honoring any Retry-After header.  The
+    session can be shared between threads.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            retry = Retry(
+                total=RETRIES,
+                backoff_factor=1,
+                status_forcelist=(429, 500, 502, 503, 504),
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(
+                pool_connections=POOL_MAXSIZE,
+                pool_maxsize=POOL_MAXSIZE,
+                max_retries=retry,
+            )
+            session = requests.Session()
+            session.headers.update(HEADERS)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+    return _session
+
 
-def download_file(url, local_filename=None, dldir='tmp'):
+def download_file(
+    url,
+    local_filename=None,
+    dldir='tmp',
+    timeout=600,
+    conditional=False,
+    sha256=None,
+    validators=None,
+):
+    """Download a file, streaming it to disk in large chunks.
+
+    The file is first downloaded to a .part file next to it, which is
+    renamed when the download is complete.  If the download is
+    interrupted, or a .part file was left over from an earlier run, the
+    download is resumed with an HTTP Range request.  The ETag or
+    Last-Modified of the .part file is kept next to it and sent as
+    If-Range, so a file that changed on the server is downloaded from
+    the start.  A .part file without either is never resumed.
+
+    Parameters
+    ----------
+    url
+      The URL to download from.
+    local_filename
+      The path to save the file to, otherwise the name from the URL in dldir.
+    conditional
+      If the file already exists, only download it when the server has a
+      newer one, using If-Modified-Since.  The mtime of downloaded files
+      is then set from the Last-Modified header.
+    validators
+      For conditional downloads, a dict with the ETag and Last-Modified
+      headers from the last download of the file, which are then sent
+      as If-None-Match and If-Modified-Since.  It is updated with the
+      headers of the new file when it is downloaded.
+    sha256
+      The expected SHA-256 of the file.  It is checked while the file is
+      written, and a file that does not match is deleted.
+
+    Returns
+    -------
+    The path to the file.
+    """
     filename = url.split('/')[-1]
     if local_filename is None:
         local_filename = os.path.join(dldir, filename)
-    # the stream=True parameter keeps memory usage low
-    r = requests.get(url, stream=True, allow_redirects=True, headers=HEADERS)
-    r.raise_for_status()
-    with open(local_filename, 'wb') as f:
-        for chunk in r.iter_content(chunk_size=1024):
-            if chunk:  # filter out keep-alive new chunks
-                f.write(chunk)
-                f.flush()
+    partfile = local_filename + '.part'
+    validatorfile = partfile + '.validator'
+
+    headers = dict()
+    if conditional and os.path.exists(local_filename):
+        if validators and validators.get('ETag'):
+            headers['If-None-Match'] = validators['ETag']
+        if validators and validators.get('Last-Modified'):
+            headers['If-Modified-Since'] = validators['Last-Modified']
+        else:
+            mtime = os.path.getmtime(local_filename)
+            headers['If-Modified-Since'] = email.utils.formatdate(mtime, usegmt=True)
+
+    attempt = 0
+    while True:
+        offset = os.path.getsize(partfile) if os.path.exists(partfile) else 0
+        validator = None
+        if offset and os.path.exists(validatorfile):
+            with open(validatorfile) as f:
+                validator = f.read().strip()
+        if offset and not validator:
+            # nothing says the .part file is from the same file on the server
+            _remove_partfile(partfile)
+            offset = 0
+        if offset:
+            headers['Range'] = 'bytes=%d-' % offset
+            headers['If-Range'] = validator
+        else:
+            headers.pop('Range', None)
+            headers.pop('If-Range', None)
+        try:
+            with get_session().get(
+                url, stream=True, headers=headers, timeout=timeout
+            ) as r:
+                if r.status_code == 304:
+                    _remove_partfile(partfile)
+                    return local_filename
+                complete = False
+                if r.status_code == 416 and offset:
+                    # the .part file might already have all of the file
+                    size = _get_content_range_size(r)
+                    if size != offset or _get_validator(r) not in (None, validator):
+                        # the .part file is not a prefix of this file, start over
+                        _remove_partfile(partfile)
+                        continue
+                    complete = True
+                else:
+                    r.raise_for_status()
+                if r.status_code == 206 and _get_validator(r) not in (None, validator):
+                    # the server ignored If-Range
+                    _remove_partfile(partfile)
+                    continue
+                resume = complete or r.status_code == 206
+                if not resume:
+                    _remove_partfile(partfile)
+                    validator = _get_validator(r)
+                    if validator:
+                        with open(validatorfile, 'w') as f:
+                            f.write(validator)
+                digest = hashlib.sha256()
+                if sha256 and resume:
+                    with open(partfile, 'rb') as f:
+                        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                            digest.update(chunk)
+                with open(partfile, 'ab' if resume else 'wb') as f:
+                    for chunk in [] if complete else r.iter_content(CHUNK_SIZE):
+                        f.write(chunk)
+                        if sha256:
+                            digest.update(chunk)
+                last_modified = r.headers.get('Last-Modified')
+                etag = r.headers.get('ETag')
+            break
+        except (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.ChunkedEncodingError,
+            requests.exceptions.Timeout,
+        ) as e:
+            if attempt >= RETRIES:
+                raise
+            logging.debug('Retrying interrupted download of %s: %s' % (url, e))
+            time.sleep(2**attempt)
+            attempt += 1
+
+    if sha256 and digest.hexdigest() != sha256:
+        _remove_partfile(partfile)
+        raise VerificationException('%s does not match its SHA-256 %s' % (url, sha256))
+    os.replace(partfile, local_filename)
+    _remove_partfile(partfile)
+    if validators is not None:
+        validators['ETag'] = etag
+        validators['Last-Modified'] = last_modified
+    if conditional and last_modified:
+        try:
+            mtime = email.utils.parsedate_to_datetime(last_modified).timestamp()
+            os.utime(local_filename, (mtime, mtime))
+        except (TypeError, ValueError):
+            pass
     return local_filename
 
 
+def _remove_partfile(partfile):
+    """Remove a .part file and the validator that is kept next to it."""
+    for f in (partfile, partfile + '.validator'):
+        if os.path.exists(f):
+            os.remove(f)
+
+
+def _get_validator(r):
+    """Get what can be sent as If-Range to resume a download of this response.
+
+    Weak ETags cannot be used for that, so Last-Modified is used then.
+    """
+    etag = r.headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return r.headers.get('Last-Modified')
+
+
+def _get_content_range_size(r):
+    """Get the size of the file from the Content-Range of a 416 response."""
+    content_range = r.headers.get('Content-Range', '')
+    if content_range.startswith('bytes */'):
+        try:
+            return int(content_range[len('bytes */') :])
+        except ValueError:
+            pass
+    return None
+
+
 def http_get(url, etag=None, timeout=600):
     """Download the content from the given URL by making a GET request.
 
-    If an ETag is given, it will do a HEAD request first, to see if the content changed.
+    If an ETag is given, it is sent as a conditional GET with
+    If-None-Match, so an unchanged file is not downloaded again.
 
     Parameters
     ----------
@@ -57,17 +270,29 @@ def http_get(url, etag=None, timeout=600):
     """
     # TODO disable TLS Session IDs and TLS Session Tickets
     #      (plain text cookie visible to anyone who can see the network traffic)
+    headers = dict()
     if etag:
-        r = requests.head(url, headers=HEADERS, timeout=timeout)
-        r.raise_for_status()
-        if 'ETag' in r.headers and etag == r.headers['ETag']:
-            return None, etag
-
-    r = requests.get(url, headers=HEADERS, timeout=timeout)
+        headers['If-None-Match'] = etag
+    r = get_session().get(url, headers=headers, timeout=timeout)
+    if r.status_code == 304:
+        return None, etag
     r.raise_for_status()
 
-    new_etag = None
-    if 'ETag' in r.headers:
-        new_etag = r.headers['ETag']
+    new_etag = r.headers.get('ETag')
+    if etag and etag == new_etag:
+        # the server ignored If-None-Match
+        return None, etag
 
     return r.content, new_etag
+
+
+def http_get_etag(url, timeout=600):
+    """Get the current ETag of the given URL with a HEAD request.
+
+    Returns
+    -------
+    The ETag, or None if the server did not send one.
+    """
+    r = get_session().head(url, timeout=timeout)
+    r.raise_for_status()
+    return r.headers.get('ETag')
@@ -18,6 +18,7 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import concurrent.futures
 import sys
 import os
 import re
@@ -74,8 +75,8 @@ def key_alias(appid):
         return m.hexdigest()[:8]
 
 
-def read_fingerprints_from_keystore():
-    """Obtain a dictionary containing all singning-key fingerprints which are managed by F-Droid, grouped by appid."""
+def _keytool_list_fingerprints(keyalias=None):
+    """Run keytool to get the SHA-256 fingerprints of all keys, or just one."""
     env_vars = {'LC_ALL': 'C.UTF-8', 'FDROID_KEY_STORE_PASS': config['keystorepass']}
     cmd = [
         config['keytool'],
@@ -86,6 +87,8 @@ def read_fingerprints_from_keystore():
         '-storepass:env',
         'FDROID_KEY_STORE_PASS',
     ]
+    if keyalias:
+        cmd += ['-alias', keyalias]
     if config['keystore'] == 'NONE':
         cmd += config['smartcardoptions']
     p = FDroidPopen(cmd, envs=env_vars, output=False)
@@ -104,6 +107,65 @@ def read_fingerprints_from_keystore():
     return fps
 
 
+def _keystore_index_path():
+    """Get where the alias index of this keystore is cached, if it can be."""
+    if config['keystore'] == 'NONE' or not config.get('cachedir'):
+        return None
+    keystore = os.path.realpath(config['keystore'])
+    name = hashlib.sha256(keystore.encode()).hexdigest() + '.json'
+    return os.path.join(config['cachedir'], 'keystore-fingerprints', name)
+
+
+def _keystore_state():
+    stat = os.stat(config['keystore'])
+    return [os.path.realpath(config['keystore']), stat.st_mtime_ns, stat.st_size]
+
+
+def load_keystore_index():
+    """Load the cached alias -> fingerprint index of the keystore.
+
+    Returns
+    -------
+    dict of alias -> SHA-256 fingerprint, or None if there is no
+    index or the keystore changed since it was written
+    """
+    path = _keystore_index_path()
+    if not path:
+        return None
+    try:
+        with open(path) as fp:
+            index = json.load(fp)
+        if index.get('keystore') == _keystore_state():
+            return index['fingerprints']
+    except (OSError, ValueError, KeyError):
+        pass
+    return None
+
+
+def save_keystore_index(fps):
+    """Cache the alias -> fingerprint index for the keystore as it is now."""
+    path = _keystore_index_path()
+    if not path:
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'w') as fp:
+        json.dump({'keystore': _keystore_state(), 'fingerprints': fps}, fp)
+    os.replace(path + '.tmp', path)
+
+
+def read_fingerprints_from_keystore():
+    """Obtain a dictionary containing all singning-key fingerprints which are managed by F-Droid, grouped by appid.
+
+    Running keytool on a keystore with lots of keys takes a long
+    time, so the result is cached until the keystore file changes.
+    """
+    fps = load_keystore_index()
+    if fps is None:
+        fps = _keytool_list_fingerprints()
+        save_keystore_index(fps)
+    return fps
+
+
 def sign_sig_key_fingerprint_list(jar_file):
     """Sign the list of app-signing key fingerprints.
 
@@ -187,13 +249,15 @@ def check_for_key_collisions(allapps):
     a list of all aliases corresponding to allapps
     """
     allaliases = []
+    seen = set()
     for appid in allapps:
         m = hashlib.md5()  # nosec just used to generate a keyalias
         m.update(appid.encode('utf-8'))
         keyalias = m.hexdigest()[:8]
-        if keyalias in allaliases:
+        if keyalias in seen:
             logging.error(_("There is a keyalias collision - publishing halted"))
             sys.exit(1)
+        seen.add(keyalias)
         allaliases.append(keyalias)
     return allaliases
 
@@ -206,146 +270,92 @@ def create_key_if_not_existing(keyalias):
     boolean
       True if a new key was created, False otherwise
     """
-    # See if we already have a key for this application, and
-    # if not generate one...
-    env_vars = {
-        'LC_ALL': 'C.UTF-8',
-        'FDROID_KEY_STORE_PASS': config['keystorepass'],
-        'FDROID_KEY_PASS': config.get('keypass', ""),
-    }
-    cmd = [
-        config['keytool'],
-        '-list',
-        '-alias',
-        keyalias,
-        '-keystore',
-        config['keystore'],
-        '-storepass:env',
-        'FDROID_KEY_STORE_PASS',
-    ]
-    if config['keystore'] == 'NONE':
-        cmd += config['smartcardoptions']
-    p = FDroidPopen(cmd, envs=env_vars)
-    if p.returncode != 0:
-        logging.info("Key does not exist - generating...")
+    with common.keystore_lock.write():
+        fps = load_keystore_index()
+        if fps is not None and keyalias in fps:
+            return False
+
+        # See if we already have a key for this application, and
+        # if not generate one...
+        env_vars = {
+            'LC_ALL': 'C.UTF-8',
+            'FDROID_KEY_STORE_PASS': config['keystorepass'],
+            'FDROID_KEY_PASS': config.get('keypass', ""),
+        }
         cmd = [
             config['keytool'],
-            '-genkey',
-            '-keystore',
-            config['keystore'],
+            '-list',
             '-alias',
             keyalias,
-            '-keyalg',
-            'RSA',
-            '-keysize',
-            '2048',
-            '-validity',
-            '10000',
+            '-keystore',
+            config['keystore'],
             '-storepass:env',
             'FDROID_KEY_STORE_PASS',
-            '-dname',
-            config['keydname'],
         ]
         if config['keystore'] == 'NONE':
             cmd += config['smartcardoptions']
-        else:
-            cmd += '-keypass:env', 'FDROID_KEY_PASS'
         p = FDroidPopen(cmd, envs=env_vars)
         if p.returncode != 0:
-            raise BuildException("Failed to generate key", p.output)
-        return True
-    else:
-        return False
-
-
-def main():
-    global config, options
-
-    # Parse command line...
-    parser = ArgumentParser(
-        usage="%(prog)s [options] " "[APPID[:VERCODE] [APPID[:VERCODE] ...]]"
-    )
-    common.setup_global_opts(parser)
-    parser.add_argument(
-        "appid",
-        nargs='*',
-        help=_("application ID with optional versionCode in the form APPID[:VERCODE]"),
-    )
-    metadata.add_metadata_arguments(parser)
-    options = parser.parse_args()
-    metadata.warnings_action = options.W
+            logging.info("Key does not exist - generating...")
+            cmd = [
+                config['keytool'],
+                '-genkey',
+                '-keystore',
+                config['keystore'],
+                '-alias',
+                keyalias,
+                '-keyalg',
+                'RSA',
+                '-keysize',
+                '2048',
+                '-validity',
+                '10000',
+                '-storepass:env',
+                'FDROID_KEY_STORE_PASS',
+                '-dname',
+                config['keydname'],
+            ]
+            if config['keystore'] == 'NONE':
+                cmd += config['smartcardoptions']
+            else:
+                cmd += '-keypass:env', 'FDROID_KEY_PASS'
+            p = FDroidPopen(cmd, envs=env_vars)
+            if p.returncode != 0:
+                raise BuildException("Failed to generate key", p.output)
+            if fps is not None:
+                # the index was up to date before adding this key
+                fps.update(_keytool_list_fingerprints(keyalias))
+                save_keystore_index(fps)
+            return True
+        else:
+            return False
 
-    config = common.read_config(options)
 
-    if not ('jarsigner' in config and 'keytool' in config):
-        logging.critical(
-            _('Java JDK not found! Install in standard location or set java_paths!')
-        )
-        sys.exit(1)
+def publish_app(app, apkfiles, unsigned_dir, output_dir, tmp_dir):
+    """Verify, sign and publish all the unsigned files of one app, in order.
 
-    common.assert_config_keystore(config)
+    This runs for many apps in parallel, so it only touches the files
+    of this app, and returns what happened for main() to record.
 
-    log_dir = 'logs'
-    if not os.path.isdir(log_dir):
-        logging.info(_("Creating log directory"))
-        os.makedirs(log_dir)
-
-    tmp_dir = 'tmp'
-    if not os.path.isdir(tmp_dir):
-        logging.info(_("Creating temporary directory"))
-        os.makedirs(tmp_dir)
-
-    output_dir = 'repo'
-    if not os.path.isdir(output_dir):
-        logging.info(_("Creating output directory"))
-        os.makedirs(output_dir)
-
-    unsigned_dir = 'unsigned'
-    if not os.path.isdir(unsigned_dir):
-        logging.warning(_("No unsigned directory - nothing to do"))
-        sys.exit(1)
+    Returns
+    -------
+    generated_key
+        the key alias if a new signing key was created, otherwise None
+    signed_apks
+        list of the APKs that were signed, for the status JSON
+    failed
+        dict of each file that could not be published -> the exception
+    """
     binaries_dir = os.path.join(unsigned_dir, 'binaries')
-
-    if not config['keystore'] == "NONE" and not os.path.exists(config['keystore']):
-        logging.error("Config error - missing '{0}'".format(config['keystore']))
-        sys.exit(1)
-
-    allapps = metadata.read_metadata()
-    vercodes = common.read_pkg_args(options.appid, True)
-    common.get_metadata_files(vercodes)  # only check appids
-    signed_apks = dict()
-    generated_keys = dict()
-    allaliases = check_for_key_collisions(allapps)
-    logging.info(
-        ngettext(
-            '{0} app, {1} key aliases', '{0} apps, {1} key aliases', len(allapps)
-        ).format(len(allapps), len(allaliases))
-    )
-
-    # Process any APKs or ZIPs that are waiting to be signed...
-    for apkfile in sorted(
-        glob.glob(os.path.join(unsigned_dir, '*.apk'))
-        + glob.glob(os.path.join(unsigned_dir, '*.zip'))
-    ):
-
+    generated_key = None
+    signed_apks = []
+    failed = dict()
+    to_sign = []
+    for apkfile in apkfiles:
         appid, vercode = common.publishednameinfo(apkfile)
         apkfilename = os.path.basename(apkfile)
-        if vercodes and appid not in vercodes:
-            continue
-        if appid in vercodes and vercodes[appid]:
-            if vercode not in vercodes[appid]:
-                continue
         logging.info(_("Processing {apkfilename}").format(apkfilename=apkfile))
 
-        # There ought to be valid metadata for this app, otherwise why are we
-        # trying to publish it?
-        if appid not in allapps:
-            logging.error(
-                "Unexpected {0} found in unsigned directory".format(apkfilename)
-            )
-            sys.exit(1)
-        app = allapps[appid]
-
         if app.Binaries:
 
             # It's an app where we build from source, and verify the apk
@@ -418,28 +428,170 @@ def main():
                 logging.info("Key alias: " + keyalias)
 
                 if create_key_if_not_existing(keyalias):
-                    generated_keys[appid] = keyalias
+                    generated_key = keyalias
 
                 signed_apk_path = os.path.join(output_dir, apkfilename)
                 if os.path.exists(signed_apk_path):
-                    raise BuildException("Refusing to sign '{0}' file exists in both "
-                                         "{1} and {2} folder.".format(apkfilename,
-                                                                      unsigned_dir,
-                                                                      output_dir))
+                    failed[apkfile] = BuildException(
+                        "Refusing to sign '{0}' file exists in both "
+                        "{1} and {2} folder.".format(
+                            apkfilename, unsigned_dir, output_dir
+                        )
+                    )
+                    continue
+
+                to_sign.append((apkfile, signed_apk_path, keyalias))
+
+    # Sign and zipalign all of this app's APKs in one go
+    failed.update(common.sign_apks(to_sign))
+    for apkfile, signed_apk_path, keyalias in to_sign:
+        if apkfile in failed:
+            continue
+        signed_apks.append({"keyalias": keyalias, "filename": apkfile})
+        apkfilename = os.path.basename(apkfile)
+        publish_source_tarball(apkfilename, unsigned_dir, output_dir)
+        logging.info('Published ' + apkfilename)
+
+    return generated_key, signed_apks, failed
+
+
+def main():
+    global config, options
+
+    # Parse command line...
+    parser = ArgumentParser(
+        usage="%(prog)s [options] " "[APPID[:VERCODE] [APPID[:VERCODE] ...]]"
+    )
+    common.setup_global_opts(parser)
+    parser.add_argument(
+        "appid",
+        nargs='*',
+        help=_("application ID with optional versionCode in the form APPID[:VERCODE]"),
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help=_("Number of apps to publish in parallel"),
+    )
+    metadata.add_metadata_arguments(parser)
+    options = parser.parse_args()
+    metadata.warnings_action = options.W
+
+    config = common.read_config(options)
+
+    if not ('jarsigner' in config and 'keytool' in config):
+        logging.critical(
+            _('Java JDK not found! Install in standard location or set java_paths!')
+        )
+        sys.exit(1)
+
+    common.assert_config_keystore(config)
+
+    log_dir = 'logs'
+    if not os.path.isdir(log_dir):
+        logging.info(_("Creating log directory"))
+        os.makedirs(log_dir)
+
+    tmp_dir = 'tmp'
+    if not os.path.isdir(tmp_dir):
+        logging.info(_("Creating temporary directory"))
+        os.makedirs(tmp_dir)
+
+    output_dir = 'repo'
+    if not os.path.isdir(output_dir):
+        logging.info(_("Creating output directory"))
+        os.makedirs(output_dir)
+
+    unsigned_dir = 'unsigned'
+    if not os.path.isdir(unsigned_dir):
+        logging.warning(_("No unsigned directory - nothing to do"))
+        sys.exit(1)
+
+    if not config['keystore'] == "NONE" and not os.path.exists(config['keystore']):
+        logging.error("Config error - missing '{0}'".format(config['keystore']))
+        sys.exit(1)
+
+    allapps = metadata.read_metadata()
+    vercodes = common.read_pkg_args(options.appid, True)
+    common.get_metadata_files(vercodes)  # only check appids
+    signed_apks = dict()
+    generated_keys = dict()
+    allaliases = check_for_key_collisions(allapps)
+    logging.info(
+        ngettext(
+            '{0} app, {1} key aliases', '{0} apps, {1} key aliases', len(allapps)
+        ).format(len(allapps), len(allaliases))
+    )
 
-                # Sign and zipalign the application...
-                common.sign_apk(apkfile, signed_apk_path, keyalias)
-                if appid not in signed_apks:
-                    signed_apks[appid] = []
-                signed_apks[appid].append({"keyalias": keyalias, "filename": apkfile})
+    # Process any APKs or ZIPs that are waiting to be signed, grouped by
+    # app so that different apps run in parallel but each app in order
+    apkfiles_by_app = OrderedDict()
+    for apkfile in sorted(
+        glob.glob(os.path.join(unsigned_dir, '*.apk'))
+        + glob.glob(os.path.join(unsigned_dir, '*.zip'))
+    ):
 
-                publish_source_tarball(apkfilename, unsigned_dir, output_dir)
-                logging.info('Published ' + apkfilename)
+        appid, vercode = common.publishednameinfo(apkfile)
+        apkfilename = os.path.basename(apkfile)
+        if vercodes and appid not in vercodes:
+            continue
+        if appid in vercodes and vercodes[appid]:
+            if vercode not in vercodes[appid]:
+                continue
+
+        # There ought to be valid metadata for this app, otherwise why are we
+        # trying to publish it?
+        if appid not in allapps:
+            logging.error(
+                "Unexpected {0} found in unsigned directory".format(apkfilename)
+            )
+            sys.exit(1)
+        apkfiles_by_app.setdefault(appid, []).append(apkfile)
+
+    failed = dict()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=options.jobs) as executor:
+        futures = {
+            executor.submit(
+                publish_app, allapps[appid], apkfiles, unsigned_dir, output_dir, tmp_dir
+            ): appid
+            for appid, apkfiles in apkfiles_by_app.items()
+        }
+        for future in concurrent.futures.as_completed(futures):
+            appid = futures[future]
+            try:
+                generated_key, signed, app_failed = future.result()
+            except FDroidException as e:
+                generated_key, signed = None, []
+                app_failed = {apkfiles_by_app[appid][0]: e}
+            if generated_key:
+                generated_keys[appid] = generated_key
+            if signed:
+                signed_apks[appid] = signed
+            for apkfile, error in app_failed.items():
+                logging.error(
+                    _('Failed to publish {apkfilename}: {error}').format(
+                        apkfilename=os.path.basename(apkfile), error=error
+                    )
+                )
+            failed.update(app_failed)
+            # write the results so far, while the other apps are still running
+            status_update_json(generated_keys, signed_apks)
 
     store_stats_fdroid_signing_key_fingerprints(allapps.keys())
     status_update_json(generated_keys, signed_apks)
     logging.info('published list signing-key fingerprints')
 
+    if failed:
+        raise BuildException(
+            ngettext(
+                'Failed to publish {count} file',
+                'Failed to publish {count} files',
+                len(failed),
+            ).format(count=len(failed))
+        )
+
 
 if __name__ == "__main__":
     main()
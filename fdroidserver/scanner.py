@@ -57,6 +57,24 @@ CODE_SIGNATURES = {
     ]
 }
 
+# the Maven repos that builds are allowed to get their dependencies from
+MAVEN_REPOS = [
+    'https://repo1.maven.org/maven2',  # mavenCentral()
+    'https://jcenter.bintray.com',     # jcenter()
+    'https://jitpack.io',
+    'https://www.jitpack.io',
+    'https://repo.maven.apache.org/maven2',
+    'https://oss.jfrog.org/artifactory/oss-snapshot-local',
+    'https://oss.sonatype.org/content/repositories/snapshots',
+    'https://oss.sonatype.org/content/repositories/releases',
+    'https://oss.sonatype.org/content/groups/public',
+    'https://clojars.org/repo',  # Clojure free software libs
+    'https://s3.amazonaws.com/repo.commonsware.com',  # CommonsWare
+    'https://plugins.gradle.org/m2',  # Gradle plugin repo
+    'https://maven.google.com',  # Google Maven Repo, https://developer.android.com/studio/build/dependencies.html#google-maven
+    'file:///usr/share/maven-repo',  # local repo on Debian installs
+]
+
 # Common known non-free blobs (always lower case):
 NON_FREE_GRADLE_LINES = {
     exp: re.compile(r'.*' + exp, re.IGNORECASE) for exp in [
@@ -152,25 +170,7 @@ def scan_source(build_dir, build=metadata.Build()):
             if r.match(s) and not is_allowlisted(s):
                 yield n
 
-    allowed_repos = [re.compile(r'^https://' + re.escape(repo) + r'/*') for repo in [
-        'repo1.maven.org/maven2',  # mavenCentral()
-        'jcenter.bintray.com',     # jcenter()
-        'jitpack.io',
-        'www.jitpack.io',
-        'repo.maven.apache.org/maven2',
-        'oss.jfrog.org/artifactory/oss-snapshot-local',
-        'oss.sonatype.org/content/repositories/snapshots',
-        'oss.sonatype.org/content/repositories/releases',
-        'oss.sonatype.org/content/groups/public',
-        'clojars.org/repo',  # Clojure free software libs
-        's3.amazonaws.com/repo.commonsware.com',  # CommonsWare
-        'plugins.gradle.org/m2',  # Gradle plugin repo
-        'maven.google.com',  # Google Maven Repo, https://developer.android.com/studio/build/dependencies.html#google-maven
-        ]
-    ] + [re.compile(r'^file://' + re.escape(repo) + r'/*') for repo in [
-        '/usr/share/maven-repo',  # local repo on Debian installs
-        ]
-    ]
+    allowed_repos = [re.compile(r'^' + re.escape(repo) + r'/*') for repo in MAVEN_REPOS]
 
     scanignore = common.getpaths_map(build_dir, build.scanignore)
     scandelete = common.getpaths_map(build_dir, build.scandelete)
@@ -16,8 +16,12 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import glob
+import base64
+import hashlib
 import json
 import os
+import re
 import time
 import zipfile
 from argparse import ArgumentParser
@@ -32,17 +36,35 @@ config = None
 options = None
 start_timestamp = time.gmtime()
 
+# keystore path, mtime and alias -> (private key, certificate)
+_signing_key_cache = dict()
+
+OID_SHA1 = '1.3.14.3.2.26'
+OID_SHA256 = '2.16.840.1.101.3.4.2.1'
+OID_RSA_ENCRYPTION = '1.2.840.113549.1.1.1'
+OID_PKCS7_DATA = '1.2.840.113549.1.7.1'
+OID_PKCS7_SIGNED_DATA = '1.2.840.113549.1.7.2'
+
 
 def sign_jar(jar):
-    """Sign a JAR file with Java's jarsigner.
+    """Sign a JAR file with the repo signing key.
 
     This method requires a properly initialized config object.
 
+    If the key is in a PKCS#12 keystore, the JAR is signed in-process.
+    Otherwise, e.g. for smartcards or JKS keystores, this falls back
+    to Java's jarsigner.
+
     This does use old hashing algorithms, i.e. SHA1, but that's not
     broken yet for file verification.  This could be set to SHA256,
     but then Android < 4.3 would not be able to verify it.
     https://code.google.com/p/android/issues/detail?id=38321
     """
+    signing_key = load_signing_key()
+    if signing_key:
+        sign_jar_v1(jar, *signing_key)
+        return
+
     args = [
         config['jarsigner'],
         '-keystore',
@@ -69,6 +91,208 @@ def sign_jar(jar):
         raise FDroidException("Failed to sign %s!" % jar)
 
 
+def load_signing_key():
+    """Load the repo signing key for signing in-process, if possible.
+
+    This only works with PKCS#12 keystores holding an RSA key under
+    repo_keyalias, like `fdroid init` creates.  Other keys in the
+    keystore are ignored.  The key is cached as long as the keystore
+    file does not change.
+
+    Returns
+    -------
+    A tuple of the private key and the certificate, or None if
+    jarsigner has to be used.
+    """
+    keystore = config.get('keystore')
+    if not keystore or keystore == 'NONE' or not os.path.isfile(keystore):
+        return None
+    try:
+        from . import apksign
+    except ImportError:
+        return None
+
+    cache_key = (
+        os.path.realpath(keystore),
+        os.path.getmtime(keystore),
+        config.get('repo_keyalias'),
+    )
+    if cache_key in _signing_key_cache:
+        return _signing_key_cache[cache_key]
+
+    try:
+        keys = apksign.load_pkcs12_keys(
+            keystore, config['keystorepass'], config.get('keypass')
+        )
+    except (apksign.UnsupportedKeystore, KeyError) as e:
+        # e.g. a JKS keystore
+        logging.debug('Cannot load %s in-process, using jarsigner: %s' % (keystore, e))
+        return None
+    signing_key = keys.get(config.get('repo_keyalias'))
+    if signing_key is None:
+        logging.debug(
+            'No RSA key %s in %s, using jarsigner'
+            % (config.get('repo_keyalias'), keystore)
+        )
+        return None
+    _signing_key_cache[cache_key] = signing_key
+    return signing_key
+
+
+def _der(tag, content):
+    """Encode one DER TLV with the given tag byte."""
+    length = len(content)
+    if length < 0x80:
+        return bytes([tag, length]) + content
+    length_bytes = length.to_bytes((length.bit_length() + 7) // 8, 'big')
+    return bytes([tag, 0x80 | len(length_bytes)]) + length_bytes + content
+
+
+def _der_oid(oid):
+    values = [int(v) for v in oid.split('.')]
+    body = bytes([40 * values[0] + values[1]])
+    for v in values[2:]:
+        chunk = [v & 0x7F]
+        v >>= 7
+        while v:
+            chunk.insert(0, 0x80 | (v & 0x7F))
+            v >>= 7
+        body += bytes(chunk)
+    return _der(0x06, body)
+
+
+def _der_int(value):
+    return _der(0x02, value.to_bytes(value.bit_length() // 8 + 1, 'big', signed=True))
+
+
+def _der_algorithm(oid):
+    return _der(0x30, _der_oid(oid) + b'\x05\x00')
+
+
+def _pkcs7_signature_block(data, key, cert, sha256=False):
+    """Make a detached PKCS#7 SignedData of data with SHA1withRSA.
+
+    The structure is the same as jarsigner makes, without any signed
+    attributes, so it is accepted by every version of Android.  APKs
+    for Android 4.3 and newer can use SHA256withRSA instead.
+    """
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import padding
+
+    if sha256:
+        algorithm, digest_oid = hashes.SHA256(), OID_SHA256
+    else:
+        algorithm, digest_oid = hashes.SHA1(), OID_SHA1  # nosec see sign_jar()
+    signature = key.sign(data, padding.PKCS1v15(), algorithm)
+    signer_info = _der(
+        0x30,
+        _der_int(1)
+        + _der(0x30, cert.issuer.public_bytes() + _der_int(cert.serial_number))
+        + _der_algorithm(digest_oid)
+        + _der_algorithm(OID_RSA_ENCRYPTION)
+        + _der(0x04, signature),
+    )
+    signed_data = _der(
+        0x30,
+        _der_int(1)
+        + _der(0x31, _der_algorithm(digest_oid))
+        + _der(0x30, _der_oid(OID_PKCS7_DATA))
+        + _der(0xA0, cert.public_bytes(serialization.Encoding.DER))
+        + _der(0x31, signer_info),
+    )
+    return _der(0x30, _der_oid(OID_PKCS7_SIGNED_DATA) + _der(0xA0, signed_data))
+
+
+def _manifest_header(name, value):
+    """Format one manifest header, wrapped to 72 bytes per line."""
+    line = ('%s: %s' % (name, value)).encode('utf-8')
+    lines = []
+    width = 72
+    while len(line) > width:
+        cut = width
+        while cut > 1 and (line[cut] & 0xC0) == 0x80:  # not inside a UTF-8 char
+            cut -= 1
+        lines.append(line[:cut])
+        line = b' ' + line[cut:]
+        width = 72
+    lines.append(line)
+    return b'\r\n'.join(lines) + b'\r\n'
+
+
+def _b64sha1(data):
+    digest = hashlib.sha1(data).digest()  # nosec see sign_jar()
+    return base64.b64encode(digest).decode()
+
+
+def sign_jar_v1(jar, key, cert):
+    """Sign a JAR file in-process with a JAR v1 signature, like jarsigner.
+
+    Any existing META-INF/ entries are replaced by the new
+    MANIFEST.MF, .SF and .RSA files.  The signature file is named
+    after the repo key alias, like jarsigner does.
+
+    Parameters
+    ----------
+    jar
+        path to the JAR file, it is replaced with the signed one
+    key
+        the RSA private key
+    cert
+        the X.509 certificate of the key
+    """
+    alias = re.sub(r'[^A-Za-z0-9_-]', '_', config.get('repo_keyalias') or 'signer')
+    alias = alias[:8].upper()
+    created_by = 'fdroidserver'
+
+    with zipfile.ZipFile(jar) as zf:
+        entries = [
+            (info, zf.read(info))
+            for info in zf.infolist()
+            if not info.filename.upper().startswith('META-INF/')
+        ]
+
+    manifest_main = (
+        _manifest_header('Manifest-Version', '1.0')
+        + _manifest_header('Created-By', created_by)
+        + b'\r\n'
+    )
+    manifest = manifest_main
+    sf_entries = b''
+    for info, data in entries:
+        if info.is_dir():
+            continue
+        section = (
+            _manifest_header('Name', info.filename)
+            + _manifest_header('SHA1-Digest', _b64sha1(data))
+            + b'\r\n'
+        )
+        manifest += section
+        sf_entries += (
+            _manifest_header('Name', info.filename)
+            + _manifest_header('SHA1-Digest', _b64sha1(section))
+            + b'\r\n'
+        )
+    sf = (
+        _manifest_header('Signature-Version', '1.0')
+        + _manifest_header(
+            'SHA1-Digest-Manifest-Main-Attributes', _b64sha1(manifest_main)
+        )
+        + _manifest_header('SHA1-Digest-Manifest', _b64sha1(manifest))
+        + _manifest_header('Created-By', created_by)
+        + b'\r\n'
+        + sf_entries
+    )
+
+    tmp_jar = jar + '.tmp'
+    with zipfile.ZipFile(tmp_jar, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr('META-INF/MANIFEST.MF', manifest)
+        zf.writestr('META-INF/%s.SF' % alias, sf)
+        zf.writestr('META-INF/%s.RSA' % alias, _pkcs7_signature_block(sf, key, cert))
+        for info, data in entries:
+            zf.writestr(info, data)
+    os.replace(tmp_jar, jar)
+
+
 def sign_index_v1(repodir, json_name):
     """Sign index-v1.json to make index-v1.jar.
 
@@ -92,6 +316,25 @@ def sign_index_v1(repodir, json_name):
     sign_jar(jar_file)
 
 
+def sign_index_json(repodir, json_name):
+    """Sign an extra index JSON file, e.g. diff/1234.json to make diff/1234.jar.
+
+    This is used for the index-v1 diffs and the sharded index entry.
+    The JSON file is put into the JAR by its basename.  Unlike
+    index-v1.json, these are only checked to be valid JSON.
+    """
+    name, ext = common.get_extension(json_name)
+    json_file = os.path.join(repodir, json_name)
+
+    with open(json_file, encoding="utf-8") as fp:
+        json.load(fp)
+
+    jar_file = os.path.join(repodir, name + '.jar')
+    with zipfile.ZipFile(jar_file, 'w', zipfile.ZIP_DEFLATED) as jar:
+        jar.write(json_file, os.path.basename(json_file))
+    sign_jar(jar_file)
+
+
 def status_update_json(signed):
     """Output a JSON file with metadata about this run."""
     logging.debug(_('Outputting JSON'))
@@ -111,7 +354,7 @@ def main():
 
     config = common.read_config(options)
 
-    if 'jarsigner' not in config:
+    if 'jarsigner' not in config and not load_signing_key():
         raise FDroidException(
             _(
                 'Java jarsigner not found! Install in standard location or set java_paths!'
@@ -142,6 +385,13 @@ def main():
             logging.info('Signed ' + index_file)
             signed.append(index_file)
 
+        extra_files = sorted(glob.glob(os.path.join(output_dir, 'diff', '*.json')))
+        extra_files += glob.glob(os.path.join(output_dir, 'entry-v1.json'))
+        for extra_file in extra_files:
+            sign_index_json(output_dir, os.path.relpath(extra_file, output_dir))
+            logging.info('Signed ' + extra_file)
+            signed.append(extra_file)
+
     if not signed:
         logging.info(_("Nothing to do"))
     status_update_json(signed)
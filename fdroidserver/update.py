@@ -20,6 +20,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
+import concurrent.futures
 import sys
 import os
 import shutil
@@ -1821,35 +1822,50 @@ def archive_old_apks(apps, apks, archapks, repodir, archivedir, defaultkeepversi
 
 
 def move_apk_between_sections(from_dir, to_dir, apk):
-    """Move an APK from repo to archive or vice versa."""
+    """Move an APK from repo to archive or vice versa.
+
+    Returns
+    -------
+    The number of bytes that had to be copied, 0 if everything was renamed.
+    """
     def _move_file(from_dir, to_dir, filename, ignore_missing):
         from_path = os.path.join(from_dir, filename)
         if ignore_missing and not os.path.exists(from_path):
-            return
+            return 0
         to_path = os.path.join(to_dir, filename)
         if not os.path.exists(to_dir):
             os.mkdir(to_dir)
-        shutil.move(from_path, to_path)
+        return common.place_file(from_path, to_path, move=True)
 
     if from_dir == to_dir:
-        return
+        return 0
 
     logging.info("Moving %s from %s to %s" % (apk['apkName'], from_dir, to_dir))
-    _move_file(from_dir, to_dir, apk['apkName'], False)
-    _move_file(from_dir, to_dir, apk['apkName'] + '.asc', True)
-    _move_file(from_dir, to_dir, apk['apkName'][:-4] + '.log.gz', True)
+    copied = _move_file(from_dir, to_dir, apk['apkName'], False)
+    copied += _move_file(from_dir, to_dir, apk['apkName'] + '.asc', True)
+    copied += _move_file(from_dir, to_dir, apk['apkName'][:-4] + '.log.gz', True)
     for density in all_screen_densities:
         from_icon_dir = get_icon_dir(from_dir, density)
         to_icon_dir = get_icon_dir(to_dir, density)
         if density not in apk.get('icons', []):
             continue
-        _move_file(from_icon_dir, to_icon_dir, apk['icons'][density], True)
+        copied += _move_file(from_icon_dir, to_icon_dir, apk['icons'][density], True)
     if 'srcname' in apk:
-        _move_file(from_dir, to_dir, apk['srcname'], False)
+        copied += _move_file(from_dir, to_dir, apk['srcname'], False)
+    if copied:
+        logging.debug('Copied %d bytes moving %s' % (copied, apk['apkName']))
+    return copied
 
 
 def add_apks_to_per_app_repos(repodir, apks):
+    """Hardlink or copy each APK and its signatures into its per-app repo.
+
+    Returns
+    -------
+    The number of bytes that had to be copied.
+    """
     apks_per_app = dict()
+    copied = 0
     for apk in apks:
         apk['per_app_dir'] = os.path.join(apk['packageName'], 'fdroid')
         apk['per_app_repo'] = os.path.join(apk['per_app_dir'], 'repo')
@@ -1861,13 +1877,85 @@ def add_apks_to_per_app_repos(repodir, apks):
             os.makedirs(apk['per_app_icons'])
 
         apkpath = os.path.join(repodir, apk['apkName'])
-        shutil.copy(apkpath, apk['per_app_repo'])
+        copied += common.place_file(apkpath, apk['per_app_repo'])
         apksigpath = apkpath + '.sig'
         if os.path.exists(apksigpath):
-            shutil.copy(apksigpath, apk['per_app_repo'])
+            copied += common.place_file(apksigpath, apk['per_app_repo'])
         apkascpath = apkpath + '.asc'
         if os.path.exists(apkascpath):
-            shutil.copy(apkascpath, apk['per_app_repo'])
+            copied += common.place_file(apkascpath, apk['per_app_repo'])
+    logging.debug('Copied %d bytes into per-app repos' % copied)
+    return copied
+
+
+def _per_app_repos_json_default(obj):
+    if isinstance(obj, set):
+        return sorted(obj)
+    return str(obj)
+
+
+def make_per_app_repos(apps, apks):
+    """Generate the index of each per-app repo, in parallel.
+
+    Each per-app index is only given the APKs of its own app, and the
+    F-Droid signing key fingerprints are loaded once for all of them.
+    An app is skipped when its metadata, its APKs and the config are
+    unchanged since the last run and its index files still exist.  The
+    hashes of the last run are stored in tmp/per_app_repos.json.
+    """
+    apks_per_app = collections.defaultdict(list)
+    for apk in apks:
+        apks_per_app[apk['packageName']].append(apk)
+
+    cachefile = os.path.join('tmp', 'per_app_repos.json')
+    cache = dict()
+    if not options.clean and os.path.exists(cachefile):
+        with open(cachefile) as fp:
+            cache = json.load(fp)
+
+    fdroid_signing_key_fingerprints = common.load_stats_fdroid_signing_key_fingerprints()
+    if not options.nosign and config.get('keystore') != 'NONE':
+        index.extract_pubkey()  # fill the cache before starting the threads
+    confighash = hashlib.sha256()
+    confighash.update(json.dumps(
+        [{k: v for k, v in config.items() if 'pass' not in k}, options.nosign, options.pretty],
+        sort_keys=True, default=_per_app_repos_json_default).encode())
+    maxage = config.get('repo_maxage', 0) * 86400 / 2
+
+    todo = dict()
+    for appid, app in apps.items():
+        repodir = os.path.join(appid, 'fdroid', 'repo')
+        if not os.path.isdir(repodir):
+            logging.info(_('Skipping index generation for {appid}').format(appid=appid))
+            continue
+        h = confighash.copy()
+        h.update(json.dumps([app, apks_per_app[appid], fdroid_signing_key_fingerprints.get(appid)],
+                            sort_keys=True, default=_per_app_repos_json_default).encode())
+        sha256 = h.hexdigest()
+        entry = cache.get(appid, dict())
+        if (entry.get('sha256') == sha256
+                and os.path.exists(os.path.join(repodir, 'index-v1.json'))
+                and (options.nosign or os.path.exists(os.path.join(repodir, 'index-v1.jar')))
+                and (not maxage or time.time() - entry.get('timestamp', 0) < maxage)):
+            logging.debug('Skipping unchanged per-app repo for ' + appid)
+            continue
+        todo[appid] = (repodir, sha256)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=options.jobs) as executor:
+        futures = dict()
+        for appid, (repodir, sha256) in todo.items():
+            future = executor.submit(index.make, {appid: apps[appid]}, apks_per_app[appid],
+                                     repodir, False, fdroid_signing_key_fingerprints)
+            futures[future] = appid
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                appid = futures[future]
+                future.result()
+                cache[appid] = {'sha256': todo[appid][1], 'timestamp': int(time.time())}
+        finally:
+            os.makedirs('tmp', exist_ok=True)
+            with open(cachefile, 'w') as fp:
+                json.dump(cache, fp, indent=2, sort_keys=True)
 
 
 def create_metadata_from_template(apk):
@@ -2092,6 +2180,8 @@ def main():
                         help=_("Rename APK files that do not match package.name_123.apk"))
     parser.add_argument("--allow-disabled-algorithms", action="store_true", default=False,
                         help=_("Include APKs that are signed with disabled algorithms like MD5"))
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                        help=_("Number of per-app repo indexes to generate in parallel"))
     metadata.add_metadata_arguments(parser)
     options = parser.parse_args()
     metadata.warnings_action = options.W
@@ -2251,14 +2341,7 @@ def main():
     # per-app subscription feeds for nightly builds and things like it
     if config['per_app_repos']:
         add_apks_to_per_app_repos(repodirs[0], apks)
-        for appid, app in apps.items():
-            repodir = os.path.join(appid, 'fdroid', 'repo')
-            appdict = dict()
-            appdict[appid] = app
-            if os.path.isdir(repodir):
-                index.make(appdict, apks, repodir, False)
-            else:
-                logging.info(_('Skipping index generation for {appid}').format(appid=appid))
+        make_per_app_repos(apps, apks)
         return
 
     # Make the index for the main repo...
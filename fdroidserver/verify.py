@@ -16,6 +16,7 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import concurrent.futures
 import sys
 import os
 import glob
@@ -27,12 +28,18 @@ from collections import OrderedDict
 
 from . import _
 from . import common
+from . import index
 from . import net
 from .exception import FDroidException
 
 options = None
 config = None
 
+REPO_URL = 'https://f-droid.org/repo/'
+
+# downloaded APKs, named after their SHA-256
+CACHE_DIR = os.path.join('tmp', 'verify-cache')
+
 
 class hashabledict(OrderedDict):
     def __key(self):
@@ -160,6 +167,61 @@ def write_json_report(url, remote_apk, unsigned_apk, compare_result):
             json.dump(data, fp, cls=common.Encoder, sort_keys=True)
 
 
+def get_expected_hashes(repo_url):
+    """Get the SHA-256 of each APK in the repo and its archive from their indexes.
+
+    The indexes are only used to find and check the APKs in the cache,
+    the signatures of the APKs themselves are still verified, so this
+    does not need to verify the signing key of the indexes.
+
+    Returns
+    -------
+    A dict of apkName to SHA-256, without the APKs of an index that is
+    not available.
+    """
+    hashes = dict()
+    for url in (repo_url, repo_url.replace('/repo', '/archive')):
+        try:
+            data, _ignored = index.download_repo_index(url, verify_fingerprint=False)
+        except (FDroidException, requests.exceptions.RequestException) as e:
+            logging.warning(_('Cannot get the APK hashes from {url}: {error}')
+                            .format(url=url, error=e))
+            continue
+        for packages in data['packages'].values():
+            for package in packages:
+                if package.get('hashType') == 'sha256' and 'apkName' in package:
+                    hashes.setdefault(package['apkName'], package['hash'])
+    return hashes
+
+
+def download_apk(url, remote_apk, sha256=None):
+    """Download an APK, falling back to the archive, via the download cache.
+
+    When the SHA-256 is known, the APK is stored in the cache by its
+    SHA-256, and checked against it while it is downloaded.  Then it is
+    hardlinked or copied to remote_apk.  Otherwise, it is always
+    downloaded again, replacing remote_apk.
+    """
+    dlfile = remote_apk
+    if sha256:
+        dlfile = os.path.join(CACHE_DIR, sha256 + '.apk')
+        os.makedirs(CACHE_DIR, exist_ok=True)
+    elif os.path.exists(remote_apk):
+        os.remove(remote_apk)
+    if not os.path.exists(dlfile):
+        logging.info("...retrieving " + url)
+        try:
+            net.download_file(url, dlfile, sha256=sha256)
+        except requests.exceptions.HTTPError:
+            try:
+                net.download_file(url.replace('/repo', '/archive'), dlfile, sha256=sha256)
+            except requests.exceptions.HTTPError as e:
+                raise FDroidException(_('Downloading {url} failed. {error}')
+                                      .format(url=url, error=e))
+    if dlfile != remote_apk:
+        common.place_file(dlfile, remote_apk)
+
+
 def main():
 
     global options, config
@@ -172,6 +234,10 @@ def main():
                         help=_("Verify against locally cached copy rather than redownloading."))
     parser.add_argument("--output-json", action="store_true", default=False,
                         help=_("Output JSON report to file named after APK."))
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                        help=_("Number of APKs to verify in parallel"))
+    parser.add_argument("--download-jobs", type=int, default=4,
+                        help=_("Number of APKs to download in parallel"))
     options = parser.parse_args()
 
     config = common.read_config(options)
@@ -192,50 +258,76 @@ def main():
 
     vercodes = common.read_pkg_args(options.appid, True)
 
+    apks = []
     for apkfile in sorted(glob.glob(os.path.join(unsigned_dir, '*.apk'))):
 
         apkfilename = os.path.basename(apkfile)
-        url = 'https://f-droid.org/repo/' + apkfilename
         appid, vercode = common.publishednameinfo(apkfile)
 
         if vercodes and appid not in vercodes:
             continue
-        if vercodes[appid] and vercode not in vercodes[appid]:
+        if vercodes.get(appid) and vercode not in vercodes[appid]:
             continue
 
         processed.add(appid)
-
-        try:
-
+        apks.append(apkfilename)
+
+    to_download = []
+    for apkfilename in apks:
+        remote_apk = os.path.join(tmp_dir, apkfilename)
+        if not options.reuse_remote_apk or not os.path.exists(remote_apk):
+            to_download.append(apkfilename)
+    hashes = dict()
+    if to_download:
+        hashes = get_expected_hashes(REPO_URL)
+
+    # APKs are downloaded and verified in two pools, so each APK is
+    # verified as soon as it is downloaded, while the others download.
+    # The reports are only written from this thread.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=options.download_jobs) as downloader, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=options.jobs) as verifier:
+        pending = dict()
+        for apkfilename in apks:
             logging.info("Processing {apkfilename}".format(apkfilename=apkfilename))
-
+            url = REPO_URL + apkfilename
             remote_apk = os.path.join(tmp_dir, apkfilename)
-            if not options.reuse_remote_apk or not os.path.exists(remote_apk):
-                if os.path.exists(remote_apk):
-                    os.remove(remote_apk)
-                logging.info("...retrieving " + url)
-                try:
-                    net.download_file(url, dldir=tmp_dir)
-                except requests.exceptions.HTTPError:
-                    try:
-                        net.download_file(url.replace('/repo', '/archive'), dldir=tmp_dir)
-                    except requests.exceptions.HTTPError as e:
-                        raise FDroidException(_('Downloading {url} failed. {error}')
-                                              .format(url=url, error=e))
-
             unsigned_apk = os.path.join(unsigned_dir, apkfilename)
-            compare_result = common.verify_apks(remote_apk, unsigned_apk, tmp_dir)
-            if options.output_json:
-                write_json_report(url, remote_apk, unsigned_apk, compare_result)
-            if compare_result:
-                raise FDroidException(compare_result)
-
-            logging.info("...successfully verified")
-            verified += 1
-
-        except FDroidException as e:
-            logging.info("...NOT verified - {0}".format(e))
-            notverified += 1
+            job = (apkfilename, url, remote_apk, unsigned_apk)
+            if apkfilename in to_download:
+                future = downloader.submit(download_apk, url, remote_apk, hashes.get(apkfilename))
+                pending[future] = ('download', job)
+            else:
+                future = verifier.submit(common.verify_apks, remote_apk, unsigned_apk, tmp_dir)
+                pending[future] = ('verify', job)
+
+        while pending:
+            done, _ignored = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                stage, job = pending.pop(future)
+                apkfilename, url, remote_apk, unsigned_apk = job
+                try:
+                    if stage == 'download':
+                        future.result()
+                        future = verifier.submit(common.verify_apks,
+                                                 remote_apk, unsigned_apk, tmp_dir)
+                        pending[future] = ('verify', job)
+                        continue
+
+                    compare_result = future.result()
+                    if options.output_json:
+                        write_json_report(url, remote_apk, unsigned_apk, compare_result)
+                    if compare_result:
+                        raise FDroidException(compare_result)
+
+                    logging.info("{apkfilename} successfully verified"
+                                 .format(apkfilename=apkfilename))
+                    verified += 1
+
+                except FDroidException as e:
+                    logging.info("{apkfilename} NOT verified - {error}"
+                                 .format(apkfilename=apkfilename, error=e))
+                    notverified += 1
 
     for appid in options.appid:
         package = appid.split(":")[0]
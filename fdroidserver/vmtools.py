@@ -25,6 +25,7 @@ import shutil
 import subprocess
 import textwrap
 import logging
+import queue
 from .common import FDroidException
 
 from fdroidserver import _
@@ -33,7 +34,7 @@ import threading
 lock = threading.Lock()
 
 
-def get_clean_builder(serverdir):
+def _write_vagrantfile(serverdir):
     if not os.path.isdir(serverdir):
         if os.path.islink(serverdir):
             os.unlink(serverdir)
@@ -54,7 +55,10 @@ def get_clean_builder(serverdir):
                 """
                 )
             )
-    vm = get_build_vm(serverdir)
+
+
+def _start_clean(vm):
+    """Start a build VM from scratch, and return its ssh connection info."""
     logging.info('destroying buildserver before build')
     vm.destroy()
     logging.info('starting buildserver')
@@ -72,6 +76,112 @@ def get_clean_builder(serverdir):
     return sshinfo
 
 
+def get_clean_builder(serverdir):
+    _write_vagrantfile(serverdir)
+    vm = get_build_vm(serverdir)
+    return _start_clean(vm)
+
+
+class PooledBuildVm:
+    """A build VM from a BuildVmPool, to be given back with BuildVmPool.release()."""
+
+    def __init__(self, srvdir):
+        self.srvdir = srvdir
+        self.vm = None
+        self.sshinfo = None
+        self.error = None
+        self.released = threading.Event()
+
+
+class BuildVmPool:
+    """Keep clean build VMs started in the background, ready for builds.
+
+    Starting a build VM from scratch takes minutes, and used to happen
+    right before each build.  The pool has a thread for each of its
+    VMs, which starts the VM, waits until a build got it and gave it
+    back, then destroys it and starts it again from scratch.  So a build
+    only waits when all VMs are in use or still starting.
+
+    Each VM has its own Vagrant dir, named after serverdir with a
+    number, e.g. builder-1, builder-2.
+
+    Parameters
+    ----------
+    serverdir
+        base name of the Vagrant dirs
+    size
+        the number of VMs to keep
+    get_vm
+        function to get the FDroidBuildVm for a Vagrant dir, by default
+        get_build_vm()
+    """
+
+    def __init__(self, serverdir, size, get_vm=None):
+        self.get_vm = get_vm or get_build_vm
+        self._ready = queue.Queue()
+        self._closed = threading.Event()
+        self._threads = []
+        self._current = dict()
+        for i in range(1, size + 1):
+            srvdir = '%s-%d' % (serverdir, i)
+            thread = threading.Thread(target=self._keep_vm, args=(srvdir,), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _keep_vm(self, srvdir):
+        vm = None
+        while not self._closed.is_set():
+            pooled = PooledBuildVm(srvdir)
+            self._current[srvdir] = pooled
+            try:
+                if vm is None:
+                    _write_vagrantfile(srvdir)
+                    vm = self.get_vm(srvdir)
+                pooled.vm = vm
+                pooled.sshinfo = _start_clean(vm)
+            except Exception as e:
+                logging.error(
+                    _('Could not start build VM in {path}: {error}').format(
+                        path=srvdir, error=e
+                    )
+                )
+                pooled.error = e
+            if self._closed.is_set():
+                break
+            self._ready.put(pooled)
+            pooled.released.wait()
+        if vm is not None:
+            vm.destroy()
+
+    def acquire(self):
+        """Get a clean build VM, waiting until one is ready.
+
+        Returns
+        -------
+        PooledBuildVm
+        """
+        pooled = self._ready.get()
+        if pooled.error is not None:
+            # the VM is tried again from scratch
+            self.release(pooled)
+            raise FDroidBuildVmException(
+                _('Could not start build VM in {path}').format(path=pooled.srvdir)
+            ) from pooled.error
+        return pooled
+
+    def release(self, pooled):
+        """Give back a used build VM, which is then destroyed and started again."""
+        pooled.released.set()
+
+    def close(self):
+        """Destroy all VMs of the pool."""
+        self._closed.set()
+        for pooled in list(self._current.values()):
+            pooled.released.set()
+        for thread in self._threads:
+            thread.join()
+
+
 def _check_call(cmd, cwd=None):
     logging.debug(' '.join(cmd))
     return subprocess.check_call(cmd, shell=False, cwd=cwd)
@@ -90,7 +90,7 @@ setup(
     author_email='team@f-droid.org',
     url='https://f-droid.org',
     license='AGPL-3.0',
-    packages=['fdroidserver', 'fdroidserver.asynchronousfilereader'],
+    packages=['fdroidserver'],
     scripts=['makebuildserver'],
     entry_points={'console_scripts': ['fdroid=fdroidserver.__main__:main']},
     data_files=get_data_files(),